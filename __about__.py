@@ -46,3 +46,8 @@ REQUIRES = [
     'numpy >= 1.13.1',
     'bioread >= 1.0.4',
 ]
+
+# Optional dependencies, e.g. pip install fmrif_tools[columnar]
+EXTRAS_REQUIRE = {
+    'columnar': ['pyarrow >= 0.17.0'],
+}
@@ -0,0 +1,131 @@
+"""End-to-end benchmarks of the fmrif_tools pipeline, for airspeed velocity (asv).
+
+Run them from the repository root with ``asv run`` (or ``asv dev`` to benchmark the working tree). The synthetic
+datasets are generated once per scale under $FMRIF_BENCH_DATA (defaults to the system temporary directory) and reused
+by later runs, and dcm2niix is replaced by benchmarks.stub_dcm2niix so only the orchestration done by oxy2bids is
+timed.
+"""
+
+from __future__ import division, print_function, unicode_literals
+
+import os
+import io
+import sys
+import shutil
+import logging
+import tempfile
+
+from benchmarks.synthetic import SCALES, cached_dataset, write_physio_files
+from benchmarks.stub_dcm2niix import install_stub
+from common_utils.utils import get_config
+
+
+DATA_DIR = os.environ.get("FMRIF_BENCH_DATA", os.path.join(tempfile.gettempdir(), "fmrif_tools_benchmarks"))
+
+NTHREADS = int(os.environ.get("FMRIF_BENCH_NTHREADS", 4))
+
+
+def quiet_log(name="fmrif_benchmarks"):
+    """Logger accepted by the tools that drops everything below ERROR, so logging does not dominate the timings."""
+
+    log = logging.getLogger(name)
+    log.setLevel(logging.ERROR)
+    log.propagate = False
+
+    if not log.handlers:
+        log.addHandler(logging.NullHandler())
+
+    return log
+
+
+class _ScaledBenchmark(object):
+
+    params = list(SCALES.keys())
+    param_names = ['scale']
+    number = 1
+    repeat = 3
+    warmup_time = 0
+    timeout = 3600
+
+    def setup(self, scale):
+        self.dicom_dir, self.manifest = cached_dataset(scale, DATA_DIR)
+        self.config = get_config()
+        self.log = quiet_log()
+
+
+class GenMap(_ScaledBenchmark):
+
+    def time_gen_map(self, scale):
+
+        from bidsmapper.mapper import gen_map
+
+        gen_map(self.dicom_dir, self.config['BIDS_TAGS'], self.config['DICOM_TAGS'], NTHREADS, self.log)
+
+
+class ExploreDicoms(_ScaledBenchmark):
+
+    def setup(self, scale):
+        super(ExploreDicoms, self).setup(scale)
+        self.out_dir = tempfile.mkdtemp(prefix="dcmexplorer_")
+
+    def teardown(self, scale):
+        shutil.rmtree(self.out_dir, ignore_errors=True)
+
+    def time_explore_dicoms(self, scale):
+
+        from dcmexplorer.explorer import explore_dicoms
+
+        explore_dicoms(self.dicom_dir, self.out_dir, self.config['DICOM_TAGS'], NTHREADS, self.log)
+
+
+class MapToBids(_ScaledBenchmark):
+
+    def setup(self, scale):
+
+        from bidsmapper.mapper import gen_map
+        from oxy2bids.converters import BIDSConverter
+
+        super(MapToBids, self).setup(scale)
+
+        self.work_dir = tempfile.mkdtemp(prefix="oxy2bids_")
+        self.bids_dir = os.path.join(self.work_dir, "bids")
+        self.bids_map = os.path.join(self.work_dir, "bids_map.csv")
+
+        install_stub(os.path.join(self.work_dir, "bin"))
+        self.orig_path = os.environ.get("PATH", "")
+        os.environ["PATH"] = os.pathsep.join([os.path.join(self.work_dir, "bin"), self.orig_path])
+
+        mapping_df = gen_map(self.dicom_dir, self.config['BIDS_TAGS'], self.config['DICOM_TAGS'], NTHREADS, self.log)
+        mapping_df.to_csv(self.bids_map, index=False)
+
+        self.converter = BIDSConverter(log=self.log)
+
+    def teardown(self, scale):
+        os.environ["PATH"] = self.orig_path
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def time_map_to_bids(self, scale):
+
+        # BIDSConverter prints the paths of the moved files, keep them out of the benchmark output
+        orig_stdout, sys.stdout = sys.stdout, io.StringIO()
+
+        try:
+            self.converter.map_to_bids(self.bids_map, self.bids_dir, self.dicom_dir, None, NTHREADS, False)
+        finally:
+            sys.stdout = orig_stdout
+
+
+class PhysioToBids(object):
+
+    params = [60, 900, 3600]
+    param_names = ['seconds']
+
+    def setup(self, seconds):
+
+        from oxy2bids.converters import BIDSConverter
+
+        self.physio = write_physio_files(os.path.join(DATA_DIR, "physio"), seconds)
+        self.converter = BIDSConverter(log=quiet_log())
+
+    def time_physio_to_bids(self, seconds):
+        self.converter._physio_to_bids(resp_physio=self.physio['resp'], cardiac_physio=self.physio['ecg'])
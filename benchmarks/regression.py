@@ -0,0 +1,372 @@
+from __future__ import division, print_function, unicode_literals
+
+import os
+import gc
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import pkg_resources
+import numpy as np
+import pandas as pd
+import pydicom
+
+from glob import glob
+from functools import partial
+from collections import OrderedDict
+from benchmarks.synthetic import generate_dataset, write_physio_files
+from benchmarks.bench_pipeline import quiet_log
+from bidsmapper.mapper import assign_bids_labels
+from bidsmapper.utils import DicomScan, dicom_parser, get_unique_dicoms_from_compressed, _match_bids_tags
+from bidsmapper.classifier import BidsClassifier
+from common_utils.utils import get_config, get_datetime
+from common_utils.dicom_utils import get_tag_values
+
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+CONFIGS = ['bids', '3Ta', '3Tb', '3Tc', '3Td']
+
+DEFAULT_TOLERANCE = 0.25
+
+MIN_SAMPLE_SECONDS = 0.2
+
+
+def _archive_indexing(work_dir):
+
+    dicom_dir = os.path.join(work_dir, "archive_indexing")
+    generate_dataset(dicom_dir, n_subjects=4, series_per_session=64, instances_per_series=8, matrix=16,
+                     private_bytes=0, physio_seconds=30, compressed_fraction=1.0)
+    archives = glob(os.path.join(dicom_dir, "*.tgz"))
+    log = quiet_log()
+
+    def run():
+        for archive in archives:
+            get_unique_dicoms_from_compressed(archive, dicom_dir, log)
+
+    return run
+
+
+def _header_samples(work_dir):
+
+    dicom_dir = os.path.join(work_dir, "headers")
+
+    if not os.path.isdir(dicom_dir):
+        generate_dataset(dicom_dir, n_subjects=1, series_per_session=96, instances_per_series=1, matrix=64,
+                         private_bytes=64 * 1024, private_elements=255, physio_seconds=0, compressed_fraction=0.0)
+
+    return dicom_dir, sorted(glob(os.path.join(dicom_dir, "*/*/*/*.dcm")))
+
+
+def _header_parsing(work_dir):
+
+    dicom_dir, dicom_files = _header_samples(work_dir)
+    config = get_config()
+    log = quiet_log()
+    scans = [DicomScan(scan_path=dcm_file, dicom_dir=dicom_dir, compressed=False) for dcm_file in dicom_files]
+
+    def run():
+        # Like gen_map, share one classifier between the series of a run
+        classifier = BidsClassifier(config['BIDS_TAGS'])
+        for scan in scans:
+            dicom_parser(scan, classifier, config['DICOM_TAGS'], log)
+
+    return run
+
+
+def _rule_classification(work_dir, config_name):
+
+    dicom_dir, dicom_files = _header_samples(work_dir)
+    config = get_config(None if config_name == 'bids' else config_name)
+    log = quiet_log()
+
+    samples = []
+
+    for dcm_file in dicom_files:
+        samples.append((DicomScan(scan_path=dcm_file, dicom_dir=dicom_dir, compressed=False),
+                        pydicom.dcmread(dcm_file, stop_before_pixels=True)))
+
+    # Without the cache, so the rules are evaluated for every series rather than looked up
+    classifier = BidsClassifier(config['BIDS_TAGS'], cache_size=0)
+
+    def run():
+        # Classification alone is too fast to time reliably on a single pass over the series
+        for _ in range(20):
+            for scan, curr_dcm in samples:
+                _match_bids_tags(scan, curr_dcm, get_tag_values(curr_dcm, config['DICOM_TAGS']), classifier, log)
+
+    return run
+
+
+def _run_numbering(work_dir, n_rows):
+
+    rng = np.random.RandomState(0)
+    n_patients = max(1, n_rows // 50)
+
+    mapping_df = pd.DataFrame(OrderedDict([
+        ('subject', ""),
+        ('session', ""),
+        ('bids_type', "func"),
+        ('task', rng.choice(["task-rest_", "task-nback_", ""], n_rows)),
+        ('acq', rng.choice(["", "_acq-mb_"], n_rows)),
+        ('rec', ""),
+        ('run', ""),
+        ('modality', rng.choice(["bold", "T1w", "T2w", "dwi"], n_rows)),
+        ('patient_id', rng.randint(0, n_patients, n_rows).astype(str)),
+        ('scan_datetime', ["20170101_{:06d}".format(val) for val in rng.randint(0, 4, n_rows)]),
+    ]))
+
+    def run():
+        assign_bids_labels(mapping_df.copy())
+
+    return run
+
+
+def _physio_formatting(work_dir):
+
+    from oxy2bids.converters import BIDSConverter
+
+    physio = write_physio_files(os.path.join(work_dir, "physio"), 3600)
+    converter = BIDSConverter(log=quiet_log())
+    out_fpath = os.path.join(work_dir, "physio", "physio.tsv.gz")
+
+    def run():
+        physio_df, _ = converter._physio_to_bids(resp_physio=physio['resp'], cardiac_physio=physio['ecg'])
+        physio_df.to_csv(out_fpath, sep="\t", index=False, header=False, compression="gzip")
+
+    return run
+
+
+BENCHMARKS = OrderedDict(
+    [('archive_indexing', _archive_indexing),
+     ('header_parsing', _header_parsing)] +
+    [('rule_classification:{}'.format(config), partial(_rule_classification, config_name=config))
+     for config in CONFIGS] +
+    [('run_numbering:10k', partial(_run_numbering, n_rows=10000)),
+     ('run_numbering:100k', partial(_run_numbering, n_rows=100000)),
+     ('physio_formatting', _physio_formatting)]
+)
+
+
+def _calibration():
+    """Fixed pure-Python workload, timed alongside the benchmarks to normalise away the speed of the machine."""
+
+    total = 0
+
+    for i in range(300000):
+        total += (i * i) % 7
+
+    sorted(str(i) for i in range(100000))
+
+    return total
+
+
+def time_callable(func, repeat):
+    """Best time of one call of func over repeat samples, with the garbage collector disabled like timeit does.
+
+    Fast benchmarks are called several times per sample, so every sample lasts at least MIN_SAMPLE_SECONDS.
+    """
+
+    start = _clock()
+    func()  # Warm up caches and lazy imports
+    number = max(1, int(MIN_SAMPLE_SECONDS / max(_clock() - start, 1e-6)))
+
+    timings = []
+    gc_enabled = gc.isenabled()
+    gc.collect()
+    gc.disable()
+
+    try:
+        for _ in range(repeat):
+            start = _clock()
+            for _ in range(number):
+                func()
+            timings.append((_clock() - start) / number)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    return min(timings)
+
+
+def run_benchmarks(names, repeat, work_dir):
+
+    results = OrderedDict()
+    calibrations = []
+
+    for name in names:
+
+        print("Running {}...".format(name))
+
+        func = BENCHMARKS[name](work_dir)
+
+        # Calibrate right before each benchmark, so changes in the load of the machine during the run affect both
+        calibration = time_callable(_calibration, repeat)
+        seconds = time_callable(func, repeat)
+        calibrations.append(calibration)
+
+        results[name] = OrderedDict([
+            ('seconds', seconds),
+            ('calibration_seconds', calibration),
+            ('normalized', seconds / calibration),
+        ])
+
+    return OrderedDict([
+        ('created', get_datetime()),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('calibration_seconds', min(calibrations) if calibrations else None),
+        ('benchmarks', results),
+    ])
+
+
+def compare(current, baseline, tolerance):
+    """Return one row per benchmark with its baseline and current normalized time, and whether it regressed."""
+
+    rows = []
+
+    for name, result in current['benchmarks'].items():
+
+        base = baseline['benchmarks'].get(name) if baseline else None
+
+        if not base:
+            rows.append((name, None, result['normalized'], None, "new"))
+            continue
+
+        ratio = result['normalized'] / base['normalized']
+
+        if ratio > 1 + tolerance:
+            status = "REGRESSED"
+        elif ratio < 1 - tolerance:
+            status = "improved"
+        else:
+            status = "ok"
+
+        rows.append((name, base['normalized'], result['normalized'], ratio, status))
+
+    return rows
+
+
+def format_comparison(rows, tolerance):
+
+    header = "{:<28} {:>12} {:>12} {:>8}  {}".format("benchmark", "baseline", "current", "ratio", "status")
+    lines = ["Normalized times (multiples of the calibration loop), tolerance {:.0f}%".format(tolerance * 100), "",
+             header, "-" * len(header)]
+
+    for name, base, curr, ratio, status in rows:
+        lines.append("{:<28} {:>12} {:>12.3f} {:>8}  {}".format(
+            name, "{:.3f}".format(base) if base is not None else "-", curr,
+            "{:.2f}".format(ratio) if ratio is not None else "-", status))
+
+    return "\n".join(lines) + "\n"
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Run the fmrif_tools microbenchmarks and compare them against a stored baseline."
+    )
+
+    parser.add_argument(
+        "--baseline",
+        help="Path to the baseline JSON file. Defaults to the baseline shipped with the package.",
+        default=pkg_resources.resource_filename("benchmarks", "data/baseline.json")
+    )
+
+    parser.add_argument(
+        "--tolerance",
+        help="Allowed slowdown relative to the baseline before a benchmark counts as a regression, as a fraction. "
+             "Defaults to the tolerance stored in the baseline, or {}.".format(DEFAULT_TOLERANCE),
+        type=float,
+        default=None
+    )
+
+    parser.add_argument(
+        "--repeat",
+        help="Number of timed repetitions of each benchmark, the fastest one is kept.",
+        type=int,
+        default=7
+    )
+
+    parser.add_argument(
+        "--only",
+        help="Run only the listed benchmarks.",
+        nargs="+",
+        choices=list(BENCHMARKS.keys()),
+        default=None
+    )
+
+    parser.add_argument(
+        "--update_baseline",
+        help="Store the results as the new baseline instead of comparing against it.",
+        action="store_true",
+        default=False
+    )
+
+    parser.add_argument(
+        "--results",
+        help="Also write the results of this run to the given JSON file.",
+        default=None
+    )
+
+    settings = parser.parse_args()
+
+    baseline = None
+
+    if os.path.isfile(settings.baseline):
+        with open(settings.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    elif not settings.update_baseline:
+        print("Baseline file {} not found, run with --update_baseline to create it.".format(settings.baseline))
+        sys.exit(2)
+
+    tolerance = settings.tolerance
+
+    if tolerance is None:
+        tolerance = baseline.get('tolerance', DEFAULT_TOLERANCE) if baseline else DEFAULT_TOLERANCE
+
+    work_dir = tempfile.mkdtemp(prefix="fmrif_benchmarks_")
+
+    try:
+        current = run_benchmarks(settings.only or list(BENCHMARKS.keys()), settings.repeat, work_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    current['tolerance'] = tolerance
+
+    if settings.results:
+        with open(settings.results, 'w') as results_file:
+            json.dump(current, results_file, indent=2)
+
+    if settings.update_baseline:
+
+        # Benchmarks that were not run keep their previous baseline
+        if baseline and settings.only:
+            merged = OrderedDict(baseline['benchmarks'])
+            merged.update(current['benchmarks'])
+            current['benchmarks'] = merged
+
+        with open(settings.baseline, 'w') as baseline_file:
+            json.dump(current, baseline_file, indent=2)
+
+        print("Baseline stored in {}".format(settings.baseline))
+        return
+
+    rows = compare(current, baseline, tolerance)
+
+    print(format_comparison(rows, tolerance))
+
+    regressed = [row[0] for row in rows if row[4] == "REGRESSED"]
+
+    if regressed:
+        print("Performance regressions detected in: {}".format(", ".join(regressed)))
+        sys.exit(1)
+
+    print("No performance regressions detected.")
+
+
+if __name__ == '__main__':
+    main()
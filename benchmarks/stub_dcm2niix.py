@@ -0,0 +1,102 @@
+from __future__ import division, print_function, unicode_literals
+
+import os
+import sys
+import gzip
+import json
+import stat
+import time
+import argparse
+
+from glob import glob
+
+
+STUB_VERSION = "v1.0.20170624 (fmrif_tools benchmark stub)"
+
+# Seconds of simulated conversion work per input file, to model dcm2niix CPU time when needed
+DELAY_ENV = "FMRIF_STUB_DCM2NIIX_DELAY"
+
+
+def main(argv=None):
+    """Minimal stand-in for dcm2niix, accepting the options used by oxy2bids.
+
+    Writes small .nii.gz/.json outputs (and .bval/.bvec for DWI series) and prints the "Convert" line BIDSConverter
+    parses, so the orchestration overhead of map_to_bids can be measured without the real converter.
+    """
+
+    parser = argparse.ArgumentParser(prog="dcm2niix")
+    parser.add_argument("-z", default="n")
+    parser.add_argument("-b", default="y")
+    parser.add_argument("-f", default="%f_%p_%t_%s")
+    parser.add_argument("-o", default=None)
+    parser.add_argument("-v", action="store_true", default=False)
+    parser.add_argument("in_dir", nargs="?", default=None)
+
+    args = parser.parse_args(argv)
+
+    print("Chris Rorden's dcm2niiX version {}".format(STUB_VERSION))
+
+    if args.v or not args.in_dir:
+        return 0
+
+    dicoms = glob(os.path.join(args.in_dir, "*.dcm"))
+
+    if not dicoms:
+        print("Error: Unable to find any DICOM images in {}".format(args.in_dir))
+        return 2
+
+    delay = float(os.environ.get(DELAY_ENV, 0))
+
+    if delay:
+        time.sleep(delay * len(dicoms))
+
+    out_dir = args.o or args.in_dir
+    out_base = os.path.join(out_dir, args.f)
+
+    # A nifti header and one byte per input file is enough for the moves and size accounting downstream
+    with gzip.open("{}.nii.gz".format(out_base), 'wb') as nii_file:
+        nii_file.write(b"\x5c\x01\x00\x00" + b"\x00" * (348 - 4 + len(dicoms)))
+
+    with open("{}.json".format(out_base), 'w') as json_file:
+        json.dump({"ConversionSoftware": "dcm2niix", "ConversionSoftwareVersion": STUB_VERSION}, json_file)
+
+    if "_dwi" in args.f:
+
+        with open("{}.bval".format(out_base), 'w') as bval_file:
+            bval_file.write(" ".join(["0"] + ["1000"] * (len(dicoms) - 1)) + "\n")
+
+        with open("{}.bvec".format(out_base), 'w') as bvec_file:
+            for _ in range(3):
+                bvec_file.write(" ".join(["0"] * len(dicoms)) + "\n")
+
+    print("Convert {} DICOM as {} (64x64x{}x1)".format(len(dicoms), out_base, len(dicoms)))
+
+    return 0
+
+
+def install_stub(bin_dir):
+    """Write a dcm2niix executable running this stub into bin_dir, and return its path.
+
+    Prepend bin_dir to PATH for the stub to take the place of the real converter.
+    """
+
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    stub_fpath = os.path.join(bin_dir, "dcm2niix")
+
+    if not os.path.isdir(bin_dir):
+        os.makedirs(bin_dir)
+
+    with open(stub_fpath, 'w') as stub_file:
+        stub_file.write("#!{}\n"
+                        "import sys\n"
+                        "sys.path.insert(0, {!r})\n"
+                        "from benchmarks.stub_dcm2niix import main\n"
+                        "sys.exit(main())\n".format(sys.executable, repo_dir))
+
+    os.chmod(stub_fpath, os.stat(stub_fpath).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+    return stub_fpath
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,413 @@
+from __future__ import division, print_function, unicode_literals
+
+import os
+import io
+import json
+import tarfile
+import argparse
+import warnings
+import numpy as np
+import pydicom
+
+from collections import OrderedDict
+from pydicom.dataset import Dataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+from common_utils.utils import create_path
+
+
+MR_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.4"
+
+# Series written for every session, chosen so that the shipped heuristics (bids.json and the 3Tx scanner configs)
+# classify most of them, and a localizer that matches nothing. The physio flag marks the series that get realtime
+# ECG/Resp .1D files, as the SIEMENS scanners only record them for EPI runs.
+PROTOCOLS = [
+    OrderedDict([('series_description', "T1w_MPRAGE"), ('sequence_name', "tfl3d1_16ns"), ('physio', False)]),
+    OrderedDict([('series_description', "T2w_SPACE"), ('sequence_name', "spcR_282ns"), ('physio', False)]),
+    OrderedDict([('series_description', "task-rest_acq-mb_bold"), ('sequence_name', "epiRT"), ('physio', True)]),
+    OrderedDict([('series_description', "task-nback_bold"), ('sequence_name', "epiRTnih"), ('physio', True)]),
+    OrderedDict([('series_description', "dwi_acq-64dir"), ('sequence_name', "ep_b1000#1"), ('physio', False)]),
+    OrderedDict([('series_description', "localizer"), ('sequence_name', "fl2d1"), ('physio', False)]),
+]
+
+STATIONS = [
+    ('MRC35343', "SIEMENS"),
+    ('MRC18977', "SIEMENS"),
+    ('fmrif3ta', "GE MEDICAL SYSTEMS"),
+    ('fmrif3tb', "GE MEDICAL SYSTEMS"),
+]
+
+# Dataset sizes used by the benchmark suite
+SCALES = OrderedDict([
+    ('small', OrderedDict([
+        ('n_subjects', 2), ('sessions_per_subject', 1), ('series_per_session', 6), ('instances_per_series', 4),
+        ('matrix', 32), ('private_bytes', 8 * 1024), ('private_elements', 64), ('physio_seconds', 60),
+    ])),
+    ('medium', OrderedDict([
+        ('n_subjects', 6), ('sessions_per_subject', 2), ('series_per_session', 12), ('instances_per_series', 16),
+        ('matrix', 64), ('private_bytes', 32 * 1024), ('private_elements', 128),
+        ('physio_seconds', 300),
+    ])),
+    ('large', OrderedDict([
+        ('n_subjects', 16), ('sessions_per_subject', 2), ('series_per_session', 24), ('instances_per_series', 48),
+        ('matrix', 128), ('private_bytes', 96 * 1024), ('private_elements', 255),
+        ('physio_seconds', 900),
+    ])),
+])
+
+PHYSIO_RATE = 50  # Hz, the sampling rate assumed by BIDSConverter._physio_to_bids
+
+
+def _file_meta():
+
+    file_meta_cls = getattr(pydicom.dataset, 'FileMetaDataset', Dataset)
+
+    file_meta = file_meta_cls()
+    file_meta.MediaStorageSOPClassUID = MR_IMAGE_STORAGE
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    return file_meta
+
+
+def _write_dataset(ds):
+
+    fobj = io.BytesIO()
+
+    with warnings.catch_warnings():
+
+        # pydicom 3 deprecates setting the encoding on the dataset (it is taken from the transfer syntax), older
+        # releases need it to write the file
+        warnings.simplefilter("ignore")
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+
+        try:
+            pydicom.dcmwrite(fobj, ds, enforce_file_format=True)
+        except TypeError:
+            pydicom.dcmwrite(fobj, ds, write_like_original=False)
+
+    return fobj.getvalue()
+
+
+def make_dicom(patient_id, study_date, study_time, station, protocol, series_number, instance_number, series_uid,
+               study_uid, matrix=64, private_bytes=0, private_elements=0, rng=None):
+    """Build one MR instance with the tags read by bidsmapper and dcmexplorer, and return its encoded bytes.
+
+    private_bytes sets the size of a SIEMENS CSA-like private blob stored before the pixel data, and private_elements
+    the number of short vendor elements added next to it. Together with the referenced image sequence, these are what
+    make real Oxygen/Gold headers expensive to parse.
+    """
+
+    rng = rng or np.random.RandomState(0)
+    station_name, manufacturer = station
+
+    ds = Dataset()
+    ds.file_meta = _file_meta()
+
+    ds.SOPClassUID = MR_IMAGE_STORAGE
+    ds.SOPInstanceUID = generate_uid()
+    ds.StudyDate = study_date
+    ds.SeriesDate = study_date
+    ds.StudyTime = study_time
+    ds.Modality = "MR"
+    ds.Manufacturer = manufacturer
+    ds.StationName = station_name
+    ds.SeriesDescription = protocol['series_description']
+    ds.ProtocolName = protocol['series_description']
+    ds.PatientName = "SYNTHETIC^{}".format(patient_id)
+    ds.PatientID = patient_id
+    ds.SequenceName = protocol['sequence_name']
+    ds.RepetitionTime = 2000
+    ds.EchoTime = 30
+
+    if private_elements:
+
+        ds.ReferencedImageSequence = []
+
+        for _ in range(3):
+            ref_item = Dataset()
+            ref_item.ReferencedSOPClassUID = MR_IMAGE_STORAGE
+            ref_item.ReferencedSOPInstanceUID = generate_uid()
+            ds.ReferencedImageSequence.append(ref_item)
+
+    # GE stores the pulse sequence name in a private tag, which the shipped configs check first
+    ds.add_new((0x0019, 0x0010), 'LO', "GEMS_ACQU_01")
+    ds.add_new((0x0019, 0x109c), 'LO', protocol['sequence_name'])
+
+    ds.StudyInstanceUID = study_uid
+    ds.SeriesInstanceUID = series_uid
+    ds.StudyID = "1"
+    ds.SeriesNumber = series_number
+    ds.InstanceNumber = instance_number
+
+    if private_bytes:
+        ds.add_new((0x0029, 0x0010), 'LO', "SIEMENS CSA HEADER")
+        ds.add_new((0x0029, 0x1010), 'OB', rng.bytes(private_bytes))
+
+    if private_elements:
+
+        ds.add_new((0x0051, 0x0010), 'LO', "SIEMENS MR HEADER")
+
+        for elem_idx in range(min(private_elements, 0xff)):
+            ds.add_new((0x0051, 0x1000 + elem_idx), 'LO', "value_{}".format(elem_idx))
+
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.Rows = matrix
+    ds.Columns = matrix
+    ds.BitsAllocated = 16
+    ds.BitsStored = 12
+    ds.HighBit = 11
+    ds.PixelRepresentation = 0
+    ds.PixelData = rng.randint(0, 4096, size=(matrix, matrix)).astype('<u2').tobytes()
+
+    return _write_dataset(ds)
+
+
+def biopac_like_signals(seconds, rate=PHYSIO_RATE, seed=0):
+    """Respiratory, cardiac and trigger channels resembling a Biopac recording.
+
+    bioread can only read AcqKnowledge files, so the signals are returned as arrays and written as the .1D files
+    produced by biounpacker (and by the SIEMENS realtime system) instead.
+    """
+
+    rng = np.random.RandomState(seed)
+    t = np.arange(int(seconds * rate)) / float(rate)
+
+    resp = 2.5 * np.sin(2 * np.pi * 0.25 * t) + 0.1 * rng.randn(len(t))
+
+    # Narrow peaks around 70 bpm on a slowly wandering baseline
+    cardiac = np.sin(2 * np.pi * 1.17 * t) ** 15 + 0.2 * np.sin(2 * np.pi * 0.05 * t) + 0.05 * rng.randn(len(t))
+
+    triggers = np.zeros(len(t))
+    triggers[::2 * rate] = 5.0  # One volume every 2 s (TR)
+
+    return OrderedDict([('resp', resp), ('ecg', cardiac), ('triggers', triggers)])
+
+
+def _signal_bytes(values):
+    return "".join("{:.4f}\n".format(value) for value in values).encode('ascii')
+
+
+def _session_files(subject, session, session_idx, spec, rng):
+    """Yield (relative path, bytes) for every file of one session, in the layout of an Oxygen/Gold download."""
+
+    patient_id = subject.split("-")[-1]
+    study_date = "2017{:02d}{:02d}".format(1 + session_idx % 12, 1 + (session_idx * 7) % 28)
+    study_time = "{:02d}{:02d}00".format(8 + session_idx % 10, (session_idx * 13) % 60)
+    station = STATIONS[rng.randint(len(STATIONS))]
+    study_uid = generate_uid()
+
+    for series_idx in range(spec['series_per_session']):
+
+        protocol = PROTOCOLS[series_idx % len(PROTOCOLS)]
+        scan_folder = "mr_{:04d}".format(series_idx + 1)
+        series_uid = generate_uid()
+
+        for instance_idx in range(spec['instances_per_series']):
+            yield (
+                "{}/{}/{}/{:05d}.dcm".format(subject, session, scan_folder, instance_idx + 1),
+                make_dicom(patient_id, study_date, study_time, station, protocol, series_idx + 1, instance_idx + 1,
+                           series_uid, study_uid, spec['matrix'], spec['private_bytes'], spec['private_elements'], rng)
+            )
+
+        if protocol['physio'] and spec['physio_seconds']:
+
+            signals = biopac_like_signals(spec['physio_seconds'], seed=rng.randint(2 ** 31))
+            scan_name = "scan_{}".format(scan_folder.split("_")[-1])
+
+            yield ("{}/{}/realtime/ECG_epiRT_{}_{}.1D".format(subject, session, scan_name, study_date),
+                   _signal_bytes(signals['ecg']))
+            yield ("{}/{}/realtime/Resp_epiRT_{}_{}.1D".format(subject, session, scan_name, study_date),
+                   _signal_bytes(signals['resp']))
+
+
+def _write_archive(archive_fpath, files):
+
+    with tarfile.open(archive_fpath, 'w:gz', compresslevel=1) as archive:
+
+        for rel_path, data in files:
+
+            info = tarfile.TarInfo(rel_path)
+            info.size = len(data)
+            info.mode = 0o644
+            archive.addfile(info, io.BytesIO(data))
+
+    return os.path.getsize(archive_fpath)
+
+
+def _write_tree(dicom_dir, files):
+
+    total = 0
+
+    for rel_path, data in files:
+
+        fpath = os.path.join(dicom_dir, rel_path)
+        create_path(os.path.dirname(fpath))
+
+        with open(fpath, 'wb') as out_file:
+            out_file.write(data)
+
+        total += len(data)
+
+    return total
+
+
+def generate_dataset(dicom_dir, n_subjects=2, sessions_per_subject=1, series_per_session=6, instances_per_series=4,
+                     matrix=64, private_bytes=16 * 1024, private_elements=64, physio_seconds=60,
+                     compressed_fraction=0.5, seed=0):
+    """Write a synthetic Oxygen/Gold dataset to dicom_dir and return a manifest describing it.
+
+    Each session is stored either as a {subject}-{session}-DICOM.tgz archive or as an uncompressed
+    subject/session/mr_NNNN/*.dcm tree, in the proportion given by compressed_fraction.
+    """
+
+    rng = np.random.RandomState(seed)
+
+    spec = OrderedDict([
+        ('series_per_session', series_per_session),
+        ('instances_per_series', instances_per_series),
+        ('matrix', matrix),
+        ('private_bytes', private_bytes),
+        ('private_elements', private_elements),
+        ('physio_seconds', physio_seconds),
+    ])
+
+    create_path(dicom_dir)
+
+    manifest = OrderedDict([
+        ('archives', 0),
+        ('uncompressed_sessions', 0),
+        ('series', 0),
+        ('instances', 0),
+        ('bytes', 0),
+        ('params', OrderedDict([
+            ('n_subjects', n_subjects),
+            ('sessions_per_subject', sessions_per_subject),
+            ('compressed_fraction', compressed_fraction),
+            ('seed', seed),
+        ], **spec)),
+    ])
+
+    session_idx = 0
+
+    for subject_idx in range(n_subjects):
+
+        subject = "SYNTH_SUBJ{:04d}-{}".format(subject_idx + 1, 10000 + subject_idx)
+
+        for _ in range(sessions_per_subject):
+
+            session = "20170101-{}".format(20000 + session_idx)
+            files = _session_files(subject, session, session_idx, spec, rng)
+
+            # Spread the archives evenly over the sessions, so even the smallest datasets have both layouts
+            if int((session_idx + 1) * compressed_fraction) > int(session_idx * compressed_fraction):
+                archive_fpath = os.path.join(dicom_dir, "{}-{}-DICOM.tgz".format(subject, session))
+                manifest['bytes'] += _write_archive(archive_fpath, files)
+                manifest['archives'] += 1
+            else:
+                manifest['bytes'] += _write_tree(dicom_dir, files)
+                manifest['uncompressed_sessions'] += 1
+
+            manifest['series'] += series_per_session
+            manifest['instances'] += series_per_session * instances_per_series
+            session_idx += 1
+
+    return manifest
+
+
+def cached_dataset(scale, base_dir, **overrides):
+    """Generate the dataset for one of SCALES under base_dir, or reuse it if it was already generated.
+
+    The datasets are deterministic apart from the UIDs, so runs of the benchmark suite in separate processes can
+    share them.
+    """
+
+    params = OrderedDict(SCALES[scale], **overrides)
+    dicom_dir = os.path.join(base_dir, scale, "dicom")
+    manifest_fpath = os.path.join(base_dir, scale, "manifest.json")
+
+    if os.path.isfile(manifest_fpath):
+
+        with open(manifest_fpath) as manifest_file:
+            manifest = json.load(manifest_file)
+
+        if all(manifest['params'].get(key) == val for key, val in params.items()):
+            return dicom_dir, manifest
+
+    manifest = generate_dataset(dicom_dir, **params)
+
+    with open(manifest_fpath, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+    return dicom_dir, manifest
+
+
+def write_physio_files(out_dir, seconds, seed=0):
+    """Write Biopac-like cardiac and respiratory traces as .1D files, returning their paths."""
+
+    create_path(out_dir)
+    signals = biopac_like_signals(seconds, seed=seed)
+    paths = OrderedDict()
+
+    for channel in ('ecg', 'resp', 'triggers'):
+
+        paths[channel] = os.path.join(out_dir, "{}_{}s.1D".format(channel, seconds))
+
+        with open(paths[channel], 'wb') as out_file:
+            out_file.write(_signal_bytes(signals[channel]))
+
+    return paths
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Generate a synthetic Oxygen/Gold dataset for benchmarking.")
+
+    parser.add_argument(
+        "dicom_dir",
+        help="Path to the output directory"
+    )
+
+    parser.add_argument(
+        "--scale",
+        help="Preset dataset size. Individual options below override the preset.",
+        choices=list(SCALES.keys()),
+        default="small"
+    )
+
+    for option in SCALES['small'].keys():
+        parser.add_argument(
+            "--{}".format(option),
+            type=int,
+            default=None
+        )
+
+    parser.add_argument(
+        "--compressed_fraction",
+        help="Fraction of the sessions stored as .tgz archives, the rest are written uncompressed.",
+        type=float,
+        default=0.5
+    )
+
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0
+    )
+
+    settings = vars(parser.parse_args())
+
+    params = OrderedDict(SCALES[settings['scale']])
+
+    for option in params.keys():
+        if settings[option] is not None:
+            params[option] = settings[option]
+
+    manifest = generate_dataset(settings['dicom_dir'], compressed_fraction=settings['compressed_fraction'],
+                                seed=settings['seed'], **params)
+
+    print(json.dumps(manifest, indent=2))
+
+
+if __name__ == '__main__':
+    main()
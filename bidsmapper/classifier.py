@@ -0,0 +1,266 @@
+from __future__ import print_function, unicode_literals
+
+import re
+import json
+import threading
+
+from collections import OrderedDict
+from common_utils.utils import AUTO_CONFIG, CONFIG_PRESETS, STATION_PRESETS, get_config
+
+
+# Fields of the map set by the BIDS_TAGS heuristics
+LABEL_COLUMNS = ['bids_type', 'task', 'acq', 'rec', 'modality']
+
+# Number of distinct header signatures whose classification is remembered
+DEFAULT_CACHE_SIZE = 4096
+
+# Config used by PresetClassifier for the series of unrecognized scanners
+DEFAULT_PRESET = 'bids'
+
+
+def _compile_expr(expr):
+    """(regex, substring) pair for a heuristic expression, either a 're::' regex or a case insensitive substring."""
+
+    if expr.startswith("re::"):
+        return re.compile(r"{}".format(expr[4:]), re.IGNORECASE), None
+
+    return None, expr.lower()
+
+
+class BidsClassifier(object):
+    """Classify series from their DICOM_TAGS values with a set of BIDS_TAGS heuristics.
+
+    The heuristics are compiled once, and the result for each combination of values of the tags they use is kept in
+    a bounded LRU cache, since the same protocols show up again and again across sessions. A cache_size of 0
+    disables the cache. Instances can be shared between threads.
+    """
+
+    def __init__(self, bids_tags, cache_size=DEFAULT_CACHE_SIZE):
+
+        self.bids_tags = bids_tags
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+
+        self._rules = []
+        fields = OrderedDict()
+
+        for modality in bids_tags.keys():
+
+            for bids_tag in bids_tags[modality]:
+
+                include = [(dicom_field,) + _compile_expr(expr) for dicom_field, expr in bids_tag.get("include", [])]
+                exclude = [(dicom_field,) + _compile_expr(expr) for dicom_field, expr in bids_tag.get("exclude", [])]
+
+                labels = {}
+
+                for label in ('task', 'acq', 'rec'):
+                    if bids_tag.get(label, None):
+                        label_field, label_expr = bids_tag[label]
+                        regex = _compile_expr(label_expr)[0]
+                        labels[label] = (label_field, regex, label_expr)
+
+                self._rules.append((modality, bids_tag, include, exclude, labels))
+
+                for dicom_field, _, _ in include + exclude:
+                    fields[dicom_field] = True
+
+                for label_field, _, _ in labels.values():
+                    fields[label_field] = True
+
+        # Only the tags used by the heuristics take part in the cache key, so e.g. the study date does not
+        self._fields = list(fields.keys())
+
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def classify(self, tag_values):
+        """Find the first heuristic matched by the DICOM_TAGS values of a series.
+
+        Returns the heuristic, and the LABEL_COLUMNS of the series as a dictionary, or (None, None) if nothing
+        matches.
+        """
+
+        # The heuristics only ever see the values as strings
+        values = dict((field, str(tag_values[field]) if tag_values[field] is not None else None)
+                      for field in self._fields)
+
+        if not self.cache_size:
+            return self._classify(values)
+
+        key = tuple(values[field] for field in self._fields)
+
+        with self._lock:
+
+            result = self._cache.pop(key, None)
+
+            if result is not None:
+                self._cache[key] = result
+                self.hits += 1
+
+        if result is None:
+
+            result = self._classify(values)
+
+            with self._lock:
+
+                self.misses += 1
+                self._cache[key] = result
+
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+        bids_tag, labels = result
+
+        return bids_tag, OrderedDict(labels) if labels else None
+
+    def _classify(self, values):
+
+        lowered = dict((field, value.lower() if value is not None else None) for field, value in values.items())
+
+        def matches(dicom_field, regex, substring):
+
+            if values[dicom_field] is None:
+                return False
+
+            if regex:
+                return regex.search(values[dicom_field]) is not None
+
+            return substring in lowered[dicom_field]
+
+        def get_label(label_spec, default):
+
+            if not label_spec:
+                return default
+
+            label_field, regex, label_expr = label_spec
+
+            if values[label_field] is None:
+                return default
+
+            if not regex:
+                return label_expr
+
+            re_match = regex.search(values[label_field])
+
+            return re_match.group(0).strip() if re_match else default
+
+        for modality, bids_tag, include, exclude, labels in self._rules:
+
+            # Verify that all the keywords in the 'include' fields are present, and that none of the keywords in the
+            # 'exclude' field are. Tags missing from the header never match.
+
+            if not all(matches(*rule) for rule in include):
+                continue
+
+            if any(matches(*rule) for rule in exclude):
+                continue
+
+            # Verify if there are task, acq, or rec pattern matches
+            task = ""
+            if modality == "func":
+                task = get_label(labels.get('task'), "task-NotSpecified")
+
+            return bids_tag, OrderedDict([
+                ('bids_type', modality),
+                ('task', task),
+                ('acq', get_label(labels.get('acq'), "")),
+                ('rec', get_label(labels.get('rec'), "")),
+                ('modality', bids_tag["bids_modality"]),
+            ])
+
+        return None, None
+
+
+def load_station_map(station_map_fpath):
+    """Read a JSON file mapping station names (or manufacturers) to one of the CONFIG_PRESETS."""
+
+    with open(station_map_fpath) as station_map_file:
+        station_map = json.load(station_map_file)
+
+    unknown = sorted(set(station_map.values()) - set(CONFIG_PRESETS + [DEFAULT_PRESET]))
+
+    if unknown:
+        raise ValueError("Unknown config presets {} in {}, use one of {}".format(
+            ", ".join(unknown), station_map_fpath, ", ".join(CONFIG_PRESETS + [DEFAULT_PRESET])))
+
+    return station_map
+
+
+class PresetClassifier(object):
+    """Classify series from a mix of scanners, each with the BIDS_TAGS of the preset config of its scanner.
+
+    The preset of a series is looked up by its station_name, then its manufacturer, in station_map (case
+    insensitively), then recognized from the station name itself (e.g. fmrif3ta is 3Ta), and the default bids config
+    is used for the rest. Each preset is compiled into its own BidsClassifier once, so a single pass over the headers
+    classifies every series whatever the number of presets. dicom_tags holds the DICOM_TAGS read by all of them.
+    """
+
+    def __init__(self, station_map=None, cache_size=DEFAULT_CACHE_SIZE):
+
+        self.station_map = dict(("{}".format(key).strip().lower(), preset)
+                                for key, preset in (station_map or {}).items())
+
+        self.dicom_tags = OrderedDict()
+        self._classifiers = OrderedDict()
+
+        for preset in CONFIG_PRESETS + [DEFAULT_PRESET]:
+
+            config = get_config(None if preset == DEFAULT_PRESET else preset)
+
+            for tag, hex_strs in config["DICOM_TAGS"].items():
+                if self.dicom_tags.setdefault(tag, hex_strs) != hex_strs:
+                    raise ValueError("The DICOM tag {} is defined differently by the {} preset".format(tag, preset))
+
+            self._classifiers[preset] = BidsClassifier(config["BIDS_TAGS"], cache_size)
+
+        for tag in ('station_name', 'manufacturer'):
+            if tag not in self.dicom_tags:
+                raise ValueError("The config presets must define the {} DICOM tag".format(tag))
+
+        self.series_per_preset = OrderedDict((preset, 0) for preset in self._classifiers)
+        self._lock = threading.Lock()
+
+    @property
+    def hits(self):
+        return sum(classifier.hits for classifier in self._classifiers.values())
+
+    @property
+    def misses(self):
+        return sum(classifier.misses for classifier in self._classifiers.values())
+
+    def select_preset(self, tag_values):
+
+        station = "{}".format(tag_values['station_name'] or "").strip()
+        manufacturer = "{}".format(tag_values['manufacturer'] or "").strip()
+
+        for key in (station.lower(), manufacturer.lower()):
+            if key and key in self.station_map:
+                return self.station_map[key]
+
+        for pattern, preset in STATION_PRESETS:
+            if pattern.search(station):
+                return preset
+
+        return DEFAULT_PRESET
+
+    def classify(self, tag_values):
+        """Classify a series with the preset of its scanner, see BidsClassifier.classify."""
+
+        preset = self.select_preset(tag_values)
+
+        with self._lock:
+            self.series_per_preset[preset] += 1
+
+        return self._classifiers[preset].classify(tag_values)
+
+    def __str__(self):
+        return "{} presets: {}".format(AUTO_CONFIG, ", ".join(self._classifiers.keys()))
+
+
+def get_auto_config(station_map_fpath=None):
+    """Config used with --config auto: the DICOM_TAGS of every preset, and a PresetClassifier in place of BIDS_TAGS."""
+
+    classifier = PresetClassifier(load_station_map(station_map_fpath) if station_map_fpath else None)
+
+    return {"DICOM_TAGS": classifier.dicom_tags, "BIDS_TAGS": classifier}
@@ -1,5 +1,18 @@
 LOG_MESSAGES = {
     'start_map': "Beginning generation of DICOM to BIDS map.",
     'gen_map_done': "Map generation complete. Results stored in {}",
-    'map_failure': "A mapping could not be generated. See log for details."
+    'map_failure': "A mapping could not be generated. See log for details.",
+    'explore_done': "DICOM metadata table stored in {}",
+    'snapshot_done': "Snapshot of {} series stored in {}",
+    'dry_run_done': "Dry run of {series} series: {changed} changed ({modality} modality, {task} task, {acq} acq, "
+                    "{rec} rec), {unmatched} no longer matched, {matched} newly matched. Changes stored in {}",
+    'metrics_done': "Stage metrics stored in {} and {}",
+    'trace_done': "Trace timeline stored in {}",
+    'profile_done': "CPU and memory profiles stored in {}",
+    'shard_plan': "Shard {} maps {} of the {} units of work (by {}), an estimated {:.1f} MB to read, the largest "
+                  "shard {:.1f} MB",
+    'manifest_done': "Manifest of shard {} stored in {}",
+    'shards_failed': "Shards {} of {} did not complete, run them again before merging",
+    'shards_incomplete': "The shards do not cover the DICOM directory: {} units of work not mapped by any shard, {} "
+                         "mapped by more than one ({}). Run all the shards again with the same --shard_by"
 }
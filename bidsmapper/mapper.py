@@ -6,13 +6,86 @@ import pandas as pd
 import argparse
 
 from glob import glob
-from common_utils.utils import init_log, log_shutdown, get_cpu_count, get_datetime, get_config
-from bidsmapper.utils import DicomScan, dicom_parser, get_unique_dicoms_from_compressed
+from common_utils.utils import init_log, log_shutdown, get_datetime, get_config, AUTO_CONFIG, \
+    CONFIG_PRESETS
+from common_utils.metrics import StageMetrics, NULL_METRICS
+from common_utils.profiling import StageProfiler
+from common_utils.prometheus import PrometheusTextfileExporter
+from common_utils.discovery import iter_uncompressed_series, iter_session_dirs, count_series_dirs
+from common_utils.dicom_utils import get_header_tags, HEADER_PREFIX_BYTES
+from common_utils.sharding import SHARD_BY, DEFAULT_SHARD_BY, parse_shard, get_archive_shard_key, \
+    get_session_shard_key, balance_shards, write_manifest, load_manifests, get_coverage
+from bidsmapper.utils import DicomScan, MAP_COLUMNS, dicom_parser, get_classifier, get_unique_dicoms_from_compressed, \
+    intern_str, collapse_duplicate_series
+from bidsmapper.classifier import get_auto_config
+from bidsmapper.snapshot import SnapshotWriter, dry_run
 from bidsmapper.constants import LOG_MESSAGES
-from concurrent.futures import ThreadPoolExecutor, wait
+from common_utils.concurrency import get_executor, parse_nthreads, AUTO_THREADS
+from concurrent.futures import wait
 
 
-def gen_map(dicom_dir, bids_tags, dicom_tags, nthreads, log):
+def assign_bids_labels(mapping_df):
+
+    # Set the BIDS subjects based on unique patient id, numbered in order of appearance
+    subject_codes = mapping_df.groupby('patient_id', sort=False).ngroup() + 1
+    mapping_df['subject'] = ['sub-{}'.format(str(code).rjust(5, '0')) for code in subject_codes]
+
+    # Set the BIDS sessions based on datetime stamps of each subject, numbered in order of appearance
+    session_keys = ['patient_id', 'scan_datetime']
+    session_codes = mapping_df.groupby(session_keys, sort=False).ngroup()
+    first_scans = mapping_df.drop_duplicates(session_keys)
+    session_numbers = (first_scans.groupby('patient_id', sort=False).cumcount() + 1).values[session_codes.values]
+    mapping_df['session'] = ['ses-{}'.format(str(num).rjust(5, '0')) for num in session_numbers]
+
+    # Set the runs based on unique combinations of task/acq/rec/modality fields within each session. Only repeated
+    # combinations get a run label, so the BIDS file names of single runs stay as they were
+    run_keys = mapping_df[['patient_id', 'scan_datetime', 'task', 'acq', 'rec', 'modality']].fillna('')
+    run_groups = run_keys.groupby(list(run_keys.columns), sort=False)
+    run_numbers = run_groups.cumcount() + 1
+    run_counts = run_groups['modality'].transform('size')
+
+    mapping_df['run'] = ["run-{}".format(str(num).rjust(len(str(count)) + 1, '0')) if count > 1 else ""
+                         for num, count in zip(run_numbers, run_counts)]
+
+
+def plan_map_shards(dicom_dir, count, shard_by=DEFAULT_SHARD_BY):
+    """Split the archives and uncompressed sessions of dicom_dir into count shards of about the same mapping cost.
+
+    Mapping reads all of an archive, so archives cost their size, while only the first header of each uncompressed
+    series is read, so sessions cost their number of series folders times the header prefix read from each. Returns
+    the shard index of each unit of work (see common_utils.sharding), and the estimated cost of each shard.
+    """
+
+    costs = {}
+
+    for compressed_file in glob(os.path.join(dicom_dir, "*.tgz")):
+        key = get_archive_shard_key(compressed_file, shard_by)
+        costs[key] = costs.get(key, 0) + os.path.getsize(compressed_file)
+
+    for session_dir in iter_session_dirs(dicom_dir):
+        key = get_session_shard_key(session_dir, shard_by)
+        costs[key] = costs.get(key, 0) + count_series_dirs(session_dir) * HEADER_PREFIX_BYTES
+
+    return balance_shards(costs, count)
+
+
+def gen_map(dicom_dir, bids_tags, dicom_tags, nthreads, log, metrics=None, explore=False, snapshot=None,
+            keep_duplicates=False, shard_units=None, shard_by=DEFAULT_SHARD_BY):
+    """Generate the DICOM to BIDS map of the Oxygen/Gold series in dicom_dir.
+
+    Series found more than once (same Series Instance UID) are mapped once, from their preferred copy, unless
+    keep_duplicates is set. See bidsmapper.utils.collapse_duplicate_series.
+
+    With explore, the dcmexplorer metadata table of the same series is built from the headers read for the map, and a
+    (map, metadata) tuple is returned instead of the map alone. With snapshot, a bidsmapper.snapshot.SnapshotWriter,
+    the parsed header and classification of every series are recorded to it.
+
+    With shard_units, the keys of the units of work of a shard (see plan_map_shards), only the archives and
+    uncompressed sessions of that shard are mapped. The subject, session and run labels of its map only hold within
+    the shard, until the maps of all the shards are merged with merge_shard_maps.
+    """
+
+    metrics = metrics if metrics is not None else NULL_METRICS
 
     exec_list = []
 
@@ -25,17 +98,31 @@ def gen_map(dicom_dir, bids_tags, dicom_tags, nthreads, log):
 
     log.info("Found {} compressed files".format(len(compressed_files)))
 
+    session_filter = None
+
+    if shard_units is not None:
+
+        compressed_files = [compressed_file for compressed_file in compressed_files
+                            if get_archive_shard_key(compressed_file, shard_by) in shard_units]
+
+        def session_filter(session_dir):
+            return get_session_shard_key(session_dir, shard_by) in shard_units
+
+        log.info("Mapping {} of the compressed files in this shard".format(len(compressed_files)))
+
     if compressed_files:
 
-        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        with get_executor(nthreads, 'archive_listing', metrics, io_bound=True) as executor:
 
             futures = []
 
             for compressed_file in compressed_files:
 
-                futures.append(executor.submit(get_unique_dicoms_from_compressed, compressed_file, dicom_dir, log))
+                futures.append(metrics.submit(executor, 'archive_listing', get_unique_dicoms_from_compressed,
+                                              compressed_file, dicom_dir, log, metrics))
 
-            wait(futures)
+            with metrics.waiting('archive_listing'):
+                wait(futures)
 
             for future in futures:
                 if future.result():
@@ -44,111 +131,116 @@ def gen_map(dicom_dir, bids_tags, dicom_tags, nthreads, log):
     compressed_dcm_count = len(exec_list)
     log.info("Found {} DICOM series in {} the compressed files".format(compressed_dcm_count, len(compressed_files)))
 
-    # Now do the same for uncompressed files
-    log.info("Searching for uncompressed Oxygen\Gold DICOM series in {}".format(dicom_dir))
-
-    uncompressed_dicoms = glob(os.path.join(dicom_dir, "*/*/*/*.dcm"))
-    uncompressed_rt = glob(os.path.join(dicom_dir, "*/*/realtime/*.1D"))
-
-    mr_folders_checked = []
-    uncompressed_dicom_scans = []
+    # Rules are compiled once, and the classification of each distinct header signature is reused across series
+    classifier = get_classifier(bids_tags)
 
-    for scan in uncompressed_dicoms:
+    # Parse the results. Uncompressed series are submitted as soon as they are discovered, so listing the directory
+    # tree overlaps with parsing the headers
+    with get_executor(nthreads, 'header_parsing', metrics, io_bound=True) as executor:
 
-        scan = scan.strip()
-        curr_dir = os.path.dirname(scan)
+        futures = []
 
-        if curr_dir not in mr_folders_checked and scan.endswith(".dcm"):
+        for scan in exec_list:
 
-            uncompressed_dicom_scans.append(scan)
-            mr_folders_checked.append(curr_dir)
+            futures.append(metrics.submit(executor, 'header_parsing', dicom_parser, scan, classifier, dicom_tags, log,
+                                          metrics, explore, snapshot))
 
-    for dicom_file in uncompressed_dicom_scans:
+        # Now do the same for uncompressed files
+        log.info("Searching for uncompressed Oxygen\Gold DICOM series in {}".format(dicom_dir))
 
-        dicom_scan = DicomScan(scan_path=dicom_file, dicom_dir=dicom_dir, compressed=False)
-        scan_name = "scan_{}".format(dicom_scan.get_scan_dir().split("/")[-1].split("_")[-1])
+        uncompressed_dcm_count = 0
 
-        for rt_file in uncompressed_rt:
-            if ("ECG" in rt_file) and (scan_name in rt_file):
-                dicom_scan.set_cardio(rt_file)
-            elif ("Resp" in rt_file) and (scan_name in rt_file):
-                dicom_scan.set_resp(rt_file)
+        for dicom_file, cardio, resp in iter_uncompressed_series(dicom_dir, nthreads, metrics, session_filter):
 
-        exec_list.append(dicom_scan)
+            dicom_scan = DicomScan(scan_path=dicom_file, dicom_dir=dicom_dir, compressed=False, cardio=cardio,
+                                   resp=resp)
 
-    uncompressed_dcm_count = len(exec_list) - compressed_dcm_count
-    log.info("Found {} unique DICOM series in the uncompressed directories.".format(uncompressed_dcm_count))
+            futures.append(metrics.submit(executor, 'header_parsing', dicom_parser, dicom_scan, classifier, dicom_tags,
+                                          log, metrics, explore, snapshot))
+            uncompressed_dcm_count += 1
 
-    # Parse the results
-    with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        metrics.incr('series_indexed', uncompressed_dcm_count)
+        log.info("Found {} unique DICOM series in the uncompressed directories.".format(uncompressed_dcm_count))
 
-        futures = []
-
-        for scan in exec_list:
+        with metrics.waiting('header_parsing'):
+            wait(futures)
 
-            futures.append(executor.submit(dicom_parser, scan, bids_tags, dicom_tags, log))
+    if hasattr(classifier, 'series_per_preset'):
+        log.info("Series classified per config preset: {}".format(", ".join(
+            "{} {}".format(preset, count) for preset, count in classifier.series_per_preset.items())))
 
-        wait(futures)
+    metrics.incr('classification_cache_hits', classifier.hits)
+    log.info("Classified {} distinct header signatures, reused for {} more series.".format(classifier.misses,
+                                                                                           classifier.hits))
 
+    # Keep each parsed series as a tuple of interned strings, rather than a dictionary per row
     parsed_results = []
+    metadata_list = []
     for future in futures:
-        if future.result():
-            parsed_results.append(future.result())
+        curr_map = future.result()
+        if explore:
+            curr_map, metadata = curr_map
+            metadata_list.append(metadata)
+        if curr_map:
+            parsed_results.append(tuple(intern_str(curr_map[col]) for col in MAP_COLUMNS))
 
     mapping_df = None
 
     if parsed_results:
 
-        mapping_df = pd.DataFrame(parsed_results, columns=parsed_results[0].keys())
-
-        # Set the BIDS subjects based on unique patient id
-        unique_ids = mapping_df['patient_id'].unique()
-        curr_subject = 1
-
-        for curr_id in unique_ids:
-            mapping_df.ix[mapping_df['patient_id'] == curr_id,
-                          'subject'] = 'sub-{}'.format(str(curr_subject).rjust(5, '0'))
-            curr_subject += 1
-
-            # Set the BIDS sessions based on datetime stamps of current subject
-            unique_datetime = mapping_df[mapping_df['patient_id'] == curr_id]['scan_datetime'].unique()
-            curr_session = 1
-
-            for curr_datetime in unique_datetime:
-                mapping_df.ix[(mapping_df['patient_id'] == curr_id) & (mapping_df['scan_datetime'] == curr_datetime),
-                              'session'] = 'ses-{}'.format(str(curr_session).rjust(5, '0'))
-                curr_session += 1
-
-                # Set the runs based on unique combinations of task/acq/rec/modality fields
-                filtered_df = mapping_df.ix[(mapping_df['patient_id'] == curr_id) & (mapping_df['scan_datetime'] ==
-                                                                                     curr_datetime)]
-                unique_params = []
-                for idx, row in filtered_df.iterrows():
-                    curr_params = {
-                        'task': row['task'],
-                        'acq': row['acq'],
-                        'rec': row['rec'],
-                        'modality': row['modality'],
-                    }
-                    if curr_params not in unique_params:
-                        unique_params.append(curr_params)
-
-                for params in unique_params:
-                    run_df = filtered_df.ix[(filtered_df['task'] == params['task']) &
-                                            (filtered_df['acq'] == params['acq']) &
-                                            (filtered_df['rec'] == params['rec']) &
-                                            (filtered_df['modality'] == params['modality'])]
-                    run_padding = len(str(len(run_df))) + 1
-                    curr_run = 1
-                    for idx, row in mapping_df.iterrows():
-                        if row['patient_id'] == curr_id and row['scan_datetime'] == curr_datetime and \
-                           row['task'] == params['task'] and row['acq'] == params['acq'] and \
-                           row['rec'] == params['rec'] and row['modality'] == params['modality']:
-
-                            row['run'] = "run-{}".format(str(curr_run).rjust(run_padding, '0'))
-                            curr_run += 1
+        mapping_df = pd.DataFrame.from_records(parsed_results, columns=MAP_COLUMNS)
+        del parsed_results
+
+        if not keep_duplicates:
+
+            n_rows = len(mapping_df)
+
+            with metrics.stage('deduplication', items=n_rows):
+                mapping_df = collapse_duplicate_series(mapping_df, log)
+
+            metrics.incr('duplicate_series', n_rows - len(mapping_df))
+
+        with metrics.stage('run_numbering', items=len(mapping_df)):
+            assign_bids_labels(mapping_df)
+
         mapping_df.sort_values(['subject', 'session', 'task', 'modality', 'run'],
-                               ascending=['True', 'True', 'True', 'True', 'True'], inplace=True)
+                               ascending=[True, True, True, True, True], inplace=True)
+
+    if explore:
+        metadata_df = pd.DataFrame(metadata_list, columns=metadata_list[0].keys()) if metadata_list else None
+        return mapping_df, metadata_df
+
+    return mapping_df
+
+
+def merge_shard_maps(map_fpaths, log, keep_duplicates=False):
+    """Merge the maps written by the shards of a sharded run into the map of the whole DICOM directory.
+
+    Series exported more than once may have been mapped by several shards, they are collapsed as in gen_map unless
+    keep_duplicates is set. The subject, session and run labels are assigned again over the merged map, since each
+    shard only numbered its own series. Returns the merged map, or None if no shard mapped any series.
+    """
+
+    shard_maps = [pd.read_csv(map_fpath, header=0, index_col=None, dtype=str, keep_default_na=False)
+                  for map_fpath in map_fpaths]
+
+    log.info("Merging {} shard maps".format(len(shard_maps)))
+
+    if not shard_maps:
+        return None
+
+    mapping_df = pd.concat(shard_maps, ignore_index=True)
+
+    if not len(mapping_df):
+        return None
+
+    if not keep_duplicates:
+        mapping_df = collapse_duplicate_series(mapping_df, log)
+
+    assign_bids_labels(mapping_df)
+
+    mapping_df.sort_values(['subject', 'session', 'task', 'modality', 'run'],
+                           ascending=[True, True, True, True, True], inplace=True)
 
     return mapping_df
 
@@ -186,14 +278,30 @@ def main():
 
     parser.add_argument(
         "--nthreads",
-        help="number of threads to use when running this script. Use 1 for sequential run.",
-        default=get_cpu_count(),
-        type=int
+        help="number of threads to use when running this script. Use 1 for sequential run, or {} (the default) to "
+             "adapt the number of threads of each stage to the throughput it achieves ({}:<max threads> to bound "
+             "it)".format(AUTO_THREADS, AUTO_THREADS),
+        default=AUTO_THREADS,
+        type=parse_nthreads
     )
 
     parser.add_argument(
         "--config",
-        help="Custom config file",
+        help="Custom config file, one of the scanner presets ({}), or 'auto' to pick the preset of each series from "
+             "the scanner that acquired it".format(", ".join(CONFIG_PRESETS)),
+        default=None
+    )
+
+    parser.add_argument(
+        "--station_map",
+        help="With --config auto, JSON file mapping station names (or manufacturers) to the preset to use for their "
+             "series, for scanners that are not recognized from their station name",
+        default=None
+    )
+
+    parser.add_argument(
+        "--trace",
+        help="Write a Chrome trace-event timeline of worker activity to this file (viewable in Perfetto)",
         default=None
     )
 
@@ -205,47 +313,282 @@ def main():
         default=False
     )
 
+    parser.add_argument(
+        "--prom_textfile",
+        help="Periodically write live progress metrics to this file in the Prometheus text format, for the "
+             "node_exporter textfile collector (the file name must end in .prom)",
+        default=None
+    )
+
+    parser.add_argument(
+        "--prom_interval",
+        help="Seconds between updates of the --prom_textfile file.",
+        default=15.0,
+        type=float
+    )
+
+    parser.add_argument(
+        "--profile",
+        help="Profile CPU (cProfile) and memory (tracemalloc) usage of every stage, and store the results in a "
+             "bidsmapper_profile_<timestamp> directory inside the output directory",
+        action='store_true',
+        default=False
+    )
+
+    parser.add_argument(
+        "--save_snapshot",
+        help="Also store a snapshot of the parsed DICOM tags and the classification of every series "
+             "(bidsmapper_snapshot_<timestamp>.jsonl.gz) in the output directory, for use with --dry_run",
+        action='store_true',
+        default=False
+    )
+
+    parser.add_argument(
+        "--dry_run",
+        help="Reclassify the series recorded in this snapshot file with the given config, without reading any DICOM "
+             "file, and report the series whose classification changes. No map is generated.",
+        default=None
+    )
+
+    parser.add_argument(
+        "--explore",
+        help="Also store the DICOM metadata table produced by dcmexplorer (metadata_<timestamp>.csv) in the output "
+             "directory, built from the same pass over the DICOM headers as the map",
+        action='store_true',
+        default=False
+    )
+
+    parser.add_argument(
+        "--keep_duplicates",
+        help="Map every copy of a series found more than once in the DICOM directory (e.g. in both an archive and an "
+             "uncompressed folder), instead of only its preferred copy",
+        action='store_true',
+        default=False
+    )
+
+    parser.add_argument(
+        "--shard",
+        help="Only map shard i of N (i/N, with 0 <= i < N, e.g. the index and size of a job array) of the archives "
+             "and uncompressed sessions, balanced by their estimated cost. Each shard writes its own map, manifest "
+             "and log, and the maps of all the shards are combined with --merge_shards",
+        default=None,
+        type=parse_shard
+    )
+
+    parser.add_argument(
+        "--shard_by",
+        help="Unit of work given to a single shard with --shard: 'archive' (a session) or 'subject'",
+        choices=SHARD_BY,
+        default=DEFAULT_SHARD_BY
+    )
+
+    parser.add_argument(
+        "--merge_shards",
+        help="Check that all the shards of a --shard run in out_dir completed and covered every archive and "
+             "uncompressed session of dicom_dir, and merge their maps into a single map",
+        action='store_true',
+        default=False
+    )
+
     settings = {}
 
     cli_args = parser.parse_args()
 
+    if cli_args.shard and cli_args.merge_shards:
+        parser.error("--shard and --merge_shards cannot be used together")
+
     settings["out_dir"] = os.path.abspath(cli_args.out_dir)
 
+    settings["shard"] = cli_args.shard
+
+    # Each shard has its own log, as all the shards of a job array may start within the same second
+    run_name = "{}_{}".format(start_datetime, settings["shard"].tag) if settings["shard"] else start_datetime
+
     # Init Logger
-    log_fpath = os.path.join(settings["out_dir"], "oxy2bids_{}.log".format(start_datetime))
+    log_fpath = os.path.join(settings["out_dir"], "oxy2bids_{}.log".format(run_name))
     settings["log"] = init_log(log_fpath, log_name='oxy2bids', debug=cli_args.debug)
 
     # Load config file
-    settings["config"] = get_config(cli_args.config) if cli_args.config else get_config()
+    if cli_args.station_map and cli_args.config != AUTO_CONFIG:
+        parser.error("--station_map can only be used with --config {}".format(AUTO_CONFIG))
+
+    if cli_args.config == AUTO_CONFIG:
+        settings["config"] = get_auto_config(os.path.abspath(cli_args.station_map) if cli_args.station_map else None)
+    else:
+        settings["config"] = get_config(cli_args.config) if cli_args.config else get_config()
 
     # Normalize directories
     settings["dicom_dir"] = os.path.abspath(cli_args.dicom_dir)
 
-    settings["bids_map"] = os.path.join(settings["out_dir"], "bids_map_{}.csv".format(start_datetime))
+    settings["bids_map"] = os.path.join(settings["out_dir"], "bids_map_{}.csv".format(run_name))
 
     settings["biopac_dir"] = os.path.abspath(cli_args.biopac_dir) if cli_args.biopac_dir else None
 
     settings["nthreads"] = cli_args.nthreads
 
+    settings["trace"] = os.path.abspath(cli_args.trace) if cli_args.trace else None
+
+    settings["prom_textfile"] = os.path.abspath(cli_args.prom_textfile) if cli_args.prom_textfile else None
+
+    settings["prom_interval"] = cli_args.prom_interval
+
+    settings["profile"] = os.path.join(settings["out_dir"], "bidsmapper_profile_{}".format(run_name)) \
+        if cli_args.profile else None
+
+    settings["explore"] = os.path.join(settings["out_dir"], "metadata_{}.csv".format(run_name)) \
+        if cli_args.explore else None
+
+    settings["save_snapshot"] = os.path.join(settings["out_dir"], "bidsmapper_snapshot_{}.jsonl.gz".format(
+        run_name)) if cli_args.save_snapshot else None
+
+    settings["dry_run"] = os.path.abspath(cli_args.dry_run) if cli_args.dry_run else None
+
+    settings["keep_duplicates"] = cli_args.keep_duplicates
+
+    settings["shard_by"] = cli_args.shard_by
+
+    settings["merge_shards"] = cli_args.merge_shards
+
     # settings["overwrite"] = cli_args.overwrite  # TODO: IMPLEMENT THIS
 
     settings["log"].info(json.dumps({key: settings[key] for key in settings if key != 'log'}, sort_keys=True,
-                                    indent=2))
+                                    indent=2, default=str))
+
+    if settings["dry_run"]:
+
+        # Reclassify a snapshot from a previous run instead of generating a map
+        try:
+
+            changes, summary = dry_run(settings["dry_run"], settings["config"]["BIDS_TAGS"],
+                                       settings["config"]["DICOM_TAGS"])
+
+            changes_fpath = os.path.join(settings["out_dir"], "dry_run_{}.csv".format(start_datetime))
+            changes.to_csv(changes_fpath, index=False, header=True)
+
+            settings["log"].info(LOG_MESSAGES['dry_run_done'].format(changes_fpath, **summary))
+
+        except ValueError as e:
+
+            settings["log"].error(str(e))
+
+        log_shutdown(settings["log"])
+        return
+
+    if settings["merge_shards"]:
+
+        # Combine the maps of a sharded run instead of generating a map
+        try:
+
+            manifests = load_manifests(settings["out_dir"], 'bidsmapper', dicom_dir=settings["dicom_dir"],
+                                       keep_duplicates=settings["keep_duplicates"])
+
+            failed = [manifest['shard'] for manifest in manifests if manifest['status'] != 'complete']
+
+            if failed:
+                raise ValueError(LOG_MESSAGES['shards_failed'].format(", ".join("{}".format(index) for index in failed),
+                                                                      len(manifests)))
+
+            assignment, _ = plan_map_shards(settings["dicom_dir"], len(manifests), manifests[0]['shard_by'])
+            missing, repeated = get_coverage(manifests, 'units', assignment)
+
+            if missing or repeated:
+                raise ValueError(LOG_MESSAGES['shards_incomplete'].format(len(missing), len(repeated),
+                                                                          ", ".join(missing + repeated)))
+
+            mapping = merge_shard_maps([manifest['bids_map'] for manifest in manifests if manifest['bids_map']],
+                                       settings["log"], keep_duplicates=manifests[0]['keep_duplicates'])
+
+            if mapping is not None:
+                mapping.to_csv(path_or_buf=settings["bids_map"], index=False, header=True, columns=MAP_COLUMNS)
+                settings["log"].info(LOG_MESSAGES['gen_map_done'].format(settings["bids_map"]))
+            else:
+                settings["log"].error(LOG_MESSAGES['map_failure'])
+
+        except ValueError as e:
+
+            settings["log"].error(str(e))
+
+        log_shutdown(settings["log"])
+        return
+
+    metrics = StageMetrics('bidsmapper', trace_fpath=settings["trace"],
+                           profiler=StageProfiler(settings["profile"]) if settings["profile"] else None)
+
+    exporter = None
+
+    if settings["prom_textfile"]:
+        exporter = PrometheusTextfileExporter(metrics, settings["prom_textfile"], 'bidsmapper',
+                                              settings["prom_interval"]).start()
 
     # Generate Oxygen to BIDS mapping
     settings["log"].info(LOG_MESSAGES['start_map'])
 
+    shard_units = None
+
+    if settings["shard"]:
+
+        with metrics.stage('sharding'):
+            assignment, loads = plan_map_shards(settings["dicom_dir"], settings["shard"].count, settings["shard_by"])
+
+        shard_units = sorted(key for key, index in assignment.items() if index == settings["shard"].index)
+
+        settings["log"].info(LOG_MESSAGES['shard_plan'].format(settings["shard"], len(shard_units), len(assignment),
+                                                               settings["shard_by"],
+                                                               loads[settings["shard"].index] / 1024.0 ** 2,
+                                                               max(loads) / 1024.0 ** 2))
+
+    snapshot = None
+
+    if settings["save_snapshot"]:
+        snapshot = SnapshotWriter(settings["save_snapshot"], settings["dicom_dir"], settings["config"]["DICOM_TAGS"],
+                                  get_header_tags(settings["config"]["DICOM_TAGS"]))
+
     mapping = gen_map(settings["dicom_dir"], settings["config"]["BIDS_TAGS"], settings["config"]["DICOM_TAGS"],
-                      settings["nthreads"], settings["log"])
+                      settings["nthreads"], settings["log"], metrics, explore=bool(settings["explore"]),
+                      snapshot=snapshot, keep_duplicates=settings["keep_duplicates"], shard_units=shard_units,
+                      shard_by=settings["shard_by"])
+
+    if snapshot:
+        snapshot.close()
+        settings["log"].info(LOG_MESSAGES['snapshot_done'].format(snapshot.series_written, settings["save_snapshot"]))
+
+    if settings["explore"]:
+
+        mapping, metadata = mapping
+
+        if metadata is not None:
+            metadata.to_csv(settings["explore"], sep=',', na_rep='', index=False)
+            settings["log"].info(LOG_MESSAGES['explore_done'].format(settings["explore"]))
 
     if mapping is not None:
-        col_order = ['subject', 'session', 'bids_type', 'task', 'acq', 'rec', 'run', 'modality', 'patient_id',
-                     'scan_datetime', 'scan_dir', 'resp_physio', 'cardiac_physio', 'biopac']
-        mapping.to_csv(path_or_buf=settings["bids_map"], index=False, header=True, columns=col_order)
+        mapping.to_csv(path_or_buf=settings["bids_map"], index=False, header=True, columns=MAP_COLUMNS)
         settings["log"].info(LOG_MESSAGES['gen_map_done'].format(settings["bids_map"]))
-    else:
+    elif not settings["shard"] or shard_units:
         settings["log"].error(LOG_MESSAGES['map_failure'])
 
+    if settings["shard"]:
+
+        # A shard without any series (e.g. more shards than sessions) is complete, with an empty map
+        manifest_fpath = write_manifest(settings["out_dir"], 'bidsmapper', settings["shard"], settings["shard_by"],
+                                        status='complete' if mapping is not None or not shard_units else 'failed',
+                                        dicom_dir=settings["dicom_dir"], keep_duplicates=settings["keep_duplicates"],
+                                        units=shard_units, series=len(mapping) if mapping is not None else 0,
+                                        bids_map=settings["bids_map"] if mapping is not None else None,
+                                        log=log_fpath)
+        settings["log"].info(LOG_MESSAGES['manifest_done'].format(settings["shard"], manifest_fpath))
+
+    if exporter:
+        exporter.stop()
+
+    metrics_files = metrics.write_report(settings["out_dir"], "bidsmapper_metrics_{}".format(run_name))
+    settings["log"].info(LOG_MESSAGES['metrics_done'].format(*metrics_files))
+
+    if settings["trace"]:
+        settings["log"].info(LOG_MESSAGES['trace_done'].format(metrics.write_trace()))
+
+    if settings["profile"]:
+        settings["log"].info(LOG_MESSAGES['profile_done'].format(metrics.write_profile()))
+
     # Shutdown the log
     log_shutdown(settings["log"])
 
@@ -0,0 +1,184 @@
+from __future__ import print_function, unicode_literals
+
+import os
+import gzip
+import json
+import threading
+import pandas as pd
+
+from collections import OrderedDict
+from bidsmapper.classifier import LABEL_COLUMNS
+from bidsmapper.utils import get_classifier
+from common_utils.dicom_utils import parse_dicom_hex
+from common_utils.utils import get_datetime
+
+
+SNAPSHOT_VERSION = 1
+
+DRY_RUN_COLUMNS = ['scan_dir', 'patient_id', 'scan_datetime', 'change'] + \
+                  ['old_{}'.format(col) for col in LABEL_COLUMNS] + ['new_{}'.format(col) for col in LABEL_COLUMNS]
+
+
+def _tag_key(tag):
+    return "{:08x}".format(int(tag))
+
+
+class SnapshotWriter(object):
+    """Record the parsed header tags and the classification of every series to a gzipped JSON lines file.
+
+    The first line holds the DICOM_TAGS of the run and the tags parsed from every header, and each following line
+    one series. Series can be written from several threads at once.
+    """
+
+    def __init__(self, snapshot_fpath, dicom_dir, dicom_tags, header_tags):
+
+        self.snapshot_fpath = snapshot_fpath
+        self.series_written = 0
+
+        self._lock = threading.Lock()
+        self._file = gzip.open(snapshot_fpath, 'wb')
+
+        self._write(OrderedDict([
+            ('snapshot_version', SNAPSHOT_VERSION),
+            ('created', get_datetime()),
+            ('dicom_dir', dicom_dir),
+            ('dicom_tags', dicom_tags),
+            ('tags', [_tag_key(tag) for tag in header_tags]),
+        ]))
+
+    def _write(self, record):
+
+        line = (json.dumps(record) + "\n").encode('utf-8')
+
+        with self._lock:
+            self._file.write(line)
+
+    def write(self, scan, curr_dcm, header_tags, curr_map):
+        """Record one series, from its parsed header and the row of the map it was classified into (or None)."""
+
+        tags = OrderedDict()
+
+        for tag in header_tags:
+
+            dcm_dat = curr_dcm.get(tag, None)
+
+            # Values are stored as the heuristics see them, a missing tag and an empty one are kept apart
+            if dcm_dat is not None:
+                tags[_tag_key(tag)] = str(dcm_dat.value) if dcm_dat.value is not None else None
+
+        self._write(OrderedDict([
+            ('scan_dir', os.path.dirname(scan.get_scan_path())),
+            ('patient_id', str(curr_dcm.get('PatientID', ""))),
+            ('scan_datetime', "{}_{}".format(curr_dcm.get('StudyDate', ""), curr_dcm.get('StudyTime', ""))),
+            ('tags', tags),
+            ('labels', OrderedDict((col, curr_map[col]) for col in LABEL_COLUMNS) if curr_map else None),
+        ]))
+
+        self.series_written += 1
+
+    def close(self):
+        self._file.close()
+
+
+def load_snapshot(snapshot_fpath):
+    """Header and list of series records of a snapshot written by SnapshotWriter."""
+
+    with gzip.open(snapshot_fpath, 'rb') as snapshot_file:
+        records = [json.loads(line.decode('utf-8'), object_pairs_hook=OrderedDict) for line in snapshot_file]
+
+    if not records or records[0].get('snapshot_version') != SNAPSHOT_VERSION:
+        raise ValueError("{} is not a bidsmapper snapshot".format(snapshot_fpath))
+
+    return records[0], records[1:]
+
+
+def get_snapshot_tag_values(tags, dicom_tags):
+    """Values of every entry of a DICOM_TAGS config section in the tags of a snapshot series, like get_tag_values."""
+
+    tag_values = OrderedDict()
+
+    for name, hex_strs in dicom_tags.items():
+
+        tag_values[name] = None
+
+        for hex_str in (hex_strs if isinstance(hex_strs, list) else [hex_strs]):
+
+            tag_key = _tag_key(parse_dicom_hex(hex_str))
+
+            if tag_key in tags:
+                tag_values[name] = tags[tag_key]
+                break
+
+    return tag_values
+
+
+def _describe_change(old_labels, new_labels):
+
+    if old_labels == new_labels:
+        return None
+
+    if not new_labels:
+        return "unmatched"
+
+    if not old_labels:
+        return "matched"
+
+    changes = []
+
+    if (old_labels['bids_type'], old_labels['modality']) != (new_labels['bids_type'], new_labels['modality']):
+        changes.append("modality")
+
+    changes.extend(col for col in ('task', 'acq', 'rec') if old_labels[col] != new_labels[col])
+
+    return ";".join(changes)
+
+
+def dry_run(snapshot_fpath, bids_tags, dicom_tags):
+    """Reclassify the series recorded in a snapshot with new BIDS_TAGS and DICOM_TAGS, without reading any DICOM file.
+
+    Returns a DataFrame with one row per series whose classification changed, and a summary of the changes.
+    """
+
+    header, records = load_snapshot(snapshot_fpath)
+
+    # Tags that were not parsed when the snapshot was taken cannot be told apart from missing ones
+    missing = [name for name, hex_strs in dicom_tags.items()
+               if any(_tag_key(parse_dicom_hex(hex_str)) not in header['tags']
+                      for hex_str in (hex_strs if isinstance(hex_strs, list) else [hex_strs]))]
+
+    if missing:
+        raise ValueError("The DICOM tags {} were not recorded in {}. Save a new snapshot with this config "
+                         "first.".format(", ".join(missing), snapshot_fpath))
+
+    classifier = get_classifier(bids_tags)
+    changes = []
+    summary = OrderedDict((key, 0) for key in ('series', 'changed', 'modality', 'task', 'acq', 'rec', 'unmatched',
+                                               'matched'))
+
+    for record in records:
+
+        _, labels = classifier.classify(get_snapshot_tag_values(record['tags'], dicom_tags))
+
+        old_labels = record['labels']
+        change = _describe_change(old_labels, labels)
+
+        summary['series'] += 1
+
+        if not change:
+            continue
+
+        summary['changed'] += 1
+
+        for key in change.split(";"):
+            summary[key] += 1
+
+        row = OrderedDict([('scan_dir', record['scan_dir']), ('patient_id', record['patient_id']),
+                           ('scan_datetime', record['scan_datetime']), ('change', change)])
+        row.update(('old_{}'.format(col), old_labels[col] if old_labels else "") for col in LABEL_COLUMNS)
+        row.update(('new_{}'.format(col), labels[col] if labels else "") for col in LABEL_COLUMNS)
+
+        changes.append(row)
+
+    changes_df = pd.DataFrame(changes, columns=DRY_RUN_COLUMNS).sort_values('scan_dir')
+
+    return changes_df, summary
@@ -1,23 +1,55 @@
 from __future__ import print_function, unicode_literals
 
 import os
-import re
-import io
-import pydicom
+import tarfile
 
 from collections import OrderedDict
-from subprocess import CalledProcessError, check_output, STDOUT
+from common_utils.metrics import NULL_METRICS
+from bidsmapper.classifier import BidsClassifier
+from common_utils.dicom_utils import get_header_tags, read_dicom_header, read_compressed_dicom_header, get_tag_values, \
+    get_dicom_metadata
+from common_utils.discovery import build_realtime_index, get_realtime_files, get_series_size
 
 
-class DicomScan:
+try:
+    from sys import intern
+except ImportError:  # Python 2
+    pass
 
-    def __init__(self, scan_path, dicom_dir, compressed=True, cardio=None, resp=None, triggers=None):
-        self._scan_path = scan_path
-        self._dicom_dir = dicom_dir
-        self._cardio = cardio
-        self._resp = resp
-        self._triggers = triggers
+# Columns of the DICOM to BIDS mapping, in the order they are stored in the map file
+MAP_COLUMNS = ['subject', 'session', 'bids_type', 'task', 'acq', 'rec', 'run', 'modality', 'patient_id',
+               'scan_datetime', 'scan_dir', 'resp_physio', 'cardiac_physio', 'biopac', 'series_uid', 'n_instances',
+               'series_bytes', 'alt_sources']
+
+# Separator of the scan_dir of the duplicate copies of a series listed in the alt_sources column
+ALT_SOURCES_SEP = ";"
+
+
+def intern_str(value):
+    """Intern value if it is a string, so the many repeated paths and labels of a large archive are stored once."""
+
+    try:
+        return intern(value)
+    except TypeError:
+        return value
+
+
+class DicomScan(object):
+
+    # One of these is kept per series, so they are kept as small as possible
+    __slots__ = ('_scan_path', '_dicom_dir', '_cardio', '_resp', '_triggers', '_compressed', '_n_instances',
+                 '_series_bytes')
+
+    def __init__(self, scan_path, dicom_dir, compressed=True, cardio=None, resp=None, triggers=None,
+                 n_instances=None, series_bytes=None):
+        self._scan_path = intern_str(scan_path)
+        self._dicom_dir = intern_str(dicom_dir)
+        self._cardio = intern_str(cardio)
+        self._resp = intern_str(resp)
+        self._triggers = intern_str(triggers)
         self._compressed = compressed
+        self._n_instances = n_instances
+        self._series_bytes = series_bytes
 
     def get_scan_path(self):
         return self._scan_path
@@ -31,6 +63,16 @@ class DicomScan:
     def get_dicom_dir(self):
         return os.path.abspath(self._dicom_dir)
 
+    def get_archive_path(self):
+        """Path of the Oxygen/Gold archive holding a compressed scan, or None for uncompressed scans."""
+
+        if not self._compressed:
+            return None
+
+        scan_subject, scan_session, _ = self.get_scan_dir().split("/")
+
+        return os.path.join(self.get_dicom_dir(), "{}-{}-DICOM.tgz".format(scan_subject, scan_session))
+
     def get_cardio(self):
         return self._cardio
 
@@ -43,263 +85,258 @@ class DicomScan:
     def is_compressed(self):
         return self._compressed
 
+    def get_n_instances(self):
+        return self._n_instances
+
+    def get_series_bytes(self):
+        return self._series_bytes
+
     def set_cardio(self, cardio):
-        self._cardio = cardio
+        self._cardio = intern_str(cardio)
 
     def set_resp(self, resp):
-        self._resp = resp
+        self._resp = intern_str(resp)
 
     def set_triggers(self, triggers):
-        self._triggers = triggers
+        self._triggers = intern_str(triggers)
 
     def set_compressed(self, compressed):
         self._compressed = compressed
 
+    def set_series_size(self, n_instances, series_bytes):
+        self._n_instances = n_instances
+        self._series_bytes = series_bytes
 
-def get_dicom_dat(field, dcm_file, dicom_tags):
 
-    dcm_fields = [dicom_tags[field]] if not isinstance(dicom_tags[field], list) else dicom_tags[field]
+def dicom_parser(scan, bids_tags, dicom_tags, log=None, metrics=None, explore=False, snapshot=None):
+    """Classify the series of scan into a row of the DICOM to BIDS map, or None if no heuristic matches it.
 
-    for dcm_field in dcm_fields:
+    bids_tags is either a BIDS_TAGS config section, or a classifier shared by all the series of a run.
 
-        dcm_group, dcm_element = dcm_field.split(",")
-        dcm_group = int(dcm_group.strip(), 16)
-        dcm_element = int(dcm_element.strip(), 16)
+    With explore, the dcmexplorer metadata of the series is returned as well, as a (map row, metadata) tuple, so both
+    are produced from a single read of the header. The parsed header and classification of the series are recorded
+    to snapshot, a bidsmapper.snapshot.SnapshotWriter, if given.
+    """
 
-        dcm_dat = dcm_file.get((dcm_group, dcm_element), None)
+    metrics = metrics if metrics is not None else NULL_METRICS
 
-        if dcm_dat:
-            return dcm_dat
+    dcm_file = scan.get_scan_path()
 
-    return None
+    # Only the tags used by the heuristics are parsed, from a bounded prefix of the file when possible
+    header_tags = get_header_tags(dicom_tags)
 
+    if scan.is_compressed():
 
-def dicom_parser(scan, bids_tags, dicom_tags, log=None):
+        compressed_file = scan.get_archive_path()
 
-    dcm_file = scan.get_scan_path()
+        with metrics.stage('header_parsing') as sample:
 
-    if scan.is_compressed():
+            try:
 
-        scan_subject, scan_session, _ = scan.get_scan_dir().split("/")
+                curr_dcm, bytes_read = read_compressed_dicom_header(compressed_file, dcm_file, header_tags)
 
-        compressed_file = os.path.join(scan.get_dicom_dir(), "{}-{}-DICOM.tgz".format(scan_subject, scan_session))
+            except IOError:
 
-        try:
+                log.error("Unable to extract {} from {}".format(dcm_file, compressed_file))
+                raise Exception("An error has occurred. Check log for details.")
+
+            sample.add(bytes_read=bytes_read)
 
-            oxy_bytes = check_output('tar -O -xf {} {}'.format(compressed_file, dcm_file),
-                                     shell=True, stderr=STDOUT)
+    else:
 
-        except CalledProcessError:
+        with metrics.stage('header_parsing') as sample:
 
-            log.error("Unable to extract {} from {}".format(dcm_file, compressed_file))
-            raise Exception("An error has occurred. Check log for details.")
+            curr_dcm, bytes_read = read_dicom_header(dcm_file, header_tags)
 
-        oxy_fobj = io.BytesIO(oxy_bytes)
+            sample.add(bytes_read=bytes_read)
 
-        curr_dcm = pydicom.dcmread(oxy_fobj, stop_before_pixels=True)
+        # Archive listings already give the size of compressed series, the files of uncompressed ones are counted here
+        if scan.get_n_instances() is None:
+            with metrics.stage('series_sizing'):
+                scan.set_series_size(*get_series_size(scan.get_scan_dir()))
 
-    else:
+    with metrics.stage('rule_matching'):
+
+        tag_values = get_tag_values(curr_dcm, dicom_tags)
+        curr_map = _match_bids_tags(scan, curr_dcm, tag_values, get_classifier(bids_tags), log)
+
+    metrics.incr('series_classified' if curr_map else 'series_unmatched')
+
+    if snapshot:
+        snapshot.write(scan, curr_dcm, header_tags, curr_map)
+
+    if explore:
+        return curr_map, get_dicom_metadata(dcm_file, tag_values)
+
+    return curr_map
+
+
+def get_classifier(bids_tags):
+    """BidsClassifier for a BIDS_TAGS config section, which may already be a classifier (e.g. a PresetClassifier)."""
+
+    return bids_tags if hasattr(bids_tags, 'classify') else BidsClassifier(bids_tags)
+
+
+def _match_bids_tags(scan, curr_dcm, tag_values, bids_tags, log=None):
 
-        curr_dcm = pydicom.dcmread(dcm_file, stop_before_pixels=True)
+    dcm_file = scan.get_scan_path()
+
+    bids_tag, labels = get_classifier(bids_tags).classify(tag_values)
+
+    if not labels:
 
-    for modality in bids_tags.keys():
-
-        # Iterate through the tags for the current bids modality, see if they
-        # match the current data in the specified dicom field
-
-        for bids_tag in bids_tags[modality]:
-
-            include_tags = bids_tag.get("include", None)
-            exclude_tags = bids_tag.get("exclude", None)
-
-            # Verify that all the keywords in the 'include' fields are present
-
-            pass_include = True
-
-            for tag in include_tags:
-
-                if not pass_include:
-                    break
-
-                dicom_field, expr = tag
-
-                dicom_dat = get_dicom_dat(dicom_field, curr_dcm, dicom_tags)
-
-                if not dicom_dat:
-                    pass_include = False
-                    break
-
-                if expr.startswith("re::"):
-                    pattern = r"{}".format(expr[4:])
-                    re_match = re.search(pattern, dicom_dat, re.IGNORECASE)
-                    if re_match:
-                        continue
-                elif expr.lower() in str(dicom_dat.value).lower():
-                    continue
-
-                pass_include = False
-
-            if not pass_include:
-                continue
-
-            # Verify that none of the keywords in the 'exclude' field are present
-
-            pass_exclude = True
-
-            for tag in exclude_tags:
-
-                if not pass_exclude:
-                    break
-
-                dicom_field, expr = tag
-
-                dicom_dat = get_dicom_dat(dicom_field, curr_dcm, dicom_tags)
-
-                if expr.startswith("re::"):
-                    pattern = r"{}".format(expr[4:])
-                    re_match = re.search(pattern, dicom_dat, re.IGNORECASE)
-                    if re_match:
-                        pass_exclude = False
-                        break
-                elif expr.lower() in str(dicom_dat.value).lower():
-                    pass_exclude = False
-                    break
-
-            if not pass_exclude:
-                continue
-
-            # Verify if there are task, acq, or rec pattern matches
-            task = ""
-            if modality == "func":
-                task_tags = bids_tag.get("task", None)
-                if task_tags:
-                    task_field, task_expr = task_tags
-                    task_dat = get_dicom_dat(task_field, curr_dcm, dicom_tags)
-                    if task_dat:
-                        task_dat = str(task_dat.value)
-                        if task_expr.startswith("re::"):
-                            pattern = r"{}".format(task_expr[4:])
-                            re_match = re.search(pattern, task_dat, re.IGNORECASE)
-                            if re_match:
-                                task = re_match.group(0).strip()
-                            else:
-                                task = "task-NotSpecified"
-                        else:
-                            task = task_expr
-                    else:
-                        task = "task-NotSpecified"
-                else:
-                    task = "task-NotSpecified"
-
-            acq = ""
-            acq_tags = bids_tag.get("acq", None)
-            if acq_tags:
-                acq_field, acq_expr = acq_tags
-                acq_dat = get_dicom_dat(acq_field, curr_dcm, dicom_tags)
-                if acq_dat:
-                    acq_dat = str(acq_dat.value)
-                    if acq_expr.startswith("re::"):
-                        pattern = r"{}".format(acq_expr[4:])
-                        re_match = re.search(pattern, acq_dat, re.IGNORECASE)
-                        if re_match:
-                            acq = re_match.group(0).strip()
-                    else:
-                        acq = acq_expr
-
-            rec = ""
-            rec_tags = bids_tag.get("rec", None)
-            if rec_tags:
-                rec_field, rec_expr = rec_tags
-                rec_dat = get_dicom_dat(rec_field, curr_dcm, dicom_tags)
-                if rec_dat:
-                    rec_dat = str(rec_dat.value)
-                    if rec_expr.startswith("re::"):
-                        pattern = r"{}".format(rec_expr[4:])
-                        re_match = re.search(pattern, rec_dat, re.IGNORECASE)
-                        if re_match:
-                            rec = re_match.group(0).strip()
-                    else:
-                        rec = rec_expr
-
-            resp_physio = scan.get_resp()
-            cardiac_physio = scan.get_cardio()
-
-            curr_map = OrderedDict({
-                'subject': "",
-                'session': "",
-                'bids_type': modality,
-                'task': task,
-                'acq': acq,
-                'rec': rec,
-                'run': "",
-                'modality': bids_tag["bids_modality"],
-                'patient_id': curr_dcm.PatientID,
-                'scan_datetime': "{}_{}".format(curr_dcm.StudyDate, curr_dcm.StudyTime),
-                'scan_dir': os.path.dirname(dcm_file),
-                'resp_physio': resp_physio,
-                'cardiac_physio': cardiac_physio,
-                'biopac': ""  # NOT IMPLEMENTED
-            })
-
-            if log:
-                log.info("Parsed: {}".format(dcm_file))
-                log.debug("Parsed: {} -- Tag: {}".format(dcm_file, bids_tag))
-            return curr_map
-
-    log.warning("No tag matches for the specified heuristics found in {}.".format(dcm_file))
-
-    return None
-
-
-def get_unique_dicoms_from_compressed(compressed_file, dicom_dir, log=None):
-
-    mr_folders_checked = []
+        if log:
+            log.warning("No tag matches for the specified heuristics found in {}.".format(dcm_file))
+
+        return None
+
+    resp_physio = scan.get_resp()
+    cardiac_physio = scan.get_cardio()
+
+    curr_map = OrderedDict({
+        'subject': "",
+        'session': "",
+        'bids_type': labels['bids_type'],
+        'task': labels['task'],
+        'acq': labels['acq'],
+        'rec': labels['rec'],
+        'run': "",
+        'modality': labels['modality'],
+        'patient_id': curr_dcm.PatientID,
+        'scan_datetime': "{}_{}".format(curr_dcm.StudyDate, curr_dcm.StudyTime),
+        'scan_dir': os.path.dirname(dcm_file),
+        'resp_physio': resp_physio,
+        'cardiac_physio': cardiac_physio,
+        'biopac': "",  # NOT IMPLEMENTED
+        'series_uid': str(curr_dcm.get('SeriesInstanceUID', "")),
+        'n_instances': scan.get_n_instances(),
+        'series_bytes': scan.get_series_bytes(),
+        'alt_sources': ""
+    })
+
+    if log:
+        log.info("Parsed: {}".format(dcm_file))
+        log.debug("Parsed: {} -- Tag: {}".format(dcm_file, bids_tag))
+
+    return curr_map
+
+
+def get_unique_dicoms_from_compressed(compressed_file, dicom_dir, log=None, metrics=None):
+
+    metrics = metrics if metrics is not None else NULL_METRICS
+
+    mr_folders_checked = set()
+    series_sizes = {}
     dicom_files = []
     realtime_files = []
     dicom_scans = []
 
     log.info("Searching for DICOM files in {}...".format(compressed_file))
 
-    try:
-        results = check_output('tar -tf {}'.format(compressed_file.strip()),
-                               shell=True, universal_newlines=True, stderr=STDOUT)
-    except CalledProcessError:
-        log.error("Could not open file {}.".format(compressed_file))
-        return None
+    with metrics.stage('archive_listing') as sample:
 
-    for result in str(results).strip().split("\n"):
+        # The member info of the archive gives the name and size of each file, whatever tar and locale are installed
+        try:
+            with tarfile.open(compressed_file.strip(), 'r:*') as tar_file:
+                members = [(member.name, member.size) for member in tar_file if member.isfile()]
+        except (tarfile.TarError, EOFError, IOError, OSError):
+            log.error("Could not open file {}.".format(compressed_file))
+            return None
+
+        sample.add(bytes_read=os.path.getsize(compressed_file.strip()))
+
+    for result, member_bytes in members:
 
-        result = result.strip()
         curr_dir = os.path.dirname(result)
 
         if result.endswith(".1D"):
 
             realtime_files.append(result)
 
-        elif curr_dir not in mr_folders_checked and result.endswith(".dcm"):
+        elif result.endswith(".dcm"):
 
-            dicom_files.append(result)
-            mr_folders_checked.append(curr_dir)
+            if curr_dir not in mr_folders_checked:
+                dicom_files.append(result)
+                mr_folders_checked.add(curr_dir)
+                series_sizes[curr_dir] = [0, 0]
+
+            series_sizes[curr_dir][0] += 1
+            series_sizes[curr_dir][1] += member_bytes
 
     # Create DicomScan objects for each dicom scan and assign relevant physio files if
     # present
+    rt_index = build_realtime_index(realtime_files)
+
     for dicom_file in dicom_files:
 
-        dicom_scan = DicomScan(scan_path=dicom_file, dicom_dir=dicom_dir, compressed=True)
+        n_instances, series_bytes = series_sizes[os.path.dirname(dicom_file)]
+        dicom_scan = DicomScan(scan_path=dicom_file, dicom_dir=dicom_dir, compressed=True, n_instances=n_instances,
+                               series_bytes=series_bytes)
 
-        scan_folder = str(dicom_scan.get_scan_dir()).split("/")[-1].split("_")[-1]
-        scan_name = "scan_{}".format(scan_folder)
+        cardio, resp = get_realtime_files(rt_index, dicom_scan.get_scan_dir())
 
-        for rt_file in realtime_files:
+        if cardio:
+            dicom_scan.set_cardio(cardio)
 
-            if ("ECG" in rt_file) and (scan_name in rt_file):
+        if resp:
+            dicom_scan.set_resp(resp)
 
-                dicom_scan.set_cardio(rt_file)
+        dicom_scans.append(dicom_scan)
 
-            elif ("Resp" in rt_file) and (scan_name in rt_file):
+    metrics.incr('series_indexed', len(dicom_scans))
 
-                dicom_scan.set_resp(rt_file)
+    return dicom_scans
 
-        dicom_scans.append(dicom_scan)
 
-    return dicom_scans
+def _get_instance_count(n_instances):
+    """Number of instances of a row of the map, which is a string in maps read back from CSV, and may be unknown."""
+
+    try:
+        return int(n_instances)
+    except (TypeError, ValueError):
+        return 0
+
+
+def collapse_duplicate_series(mapping_df, log=None):
+    """Keep a single row per series exported more than once, e.g. to both an archive and an uncompressed directory.
+
+    Rows are duplicates when they share a Series Instance UID. The copy with the most instances is kept, so that a
+    partial export is never converted in place of the complete one, then uncompressed copies over compressed ones, as
+    they need no extraction, then the first one found. The scan_dir of the other copies are listed in the alt_sources
+    column of the row kept. Returns the map without the duplicates.
+    """
+
+    duplicated = (mapping_df['series_uid'] != "") & mapping_df['series_uid'].duplicated(keep=False)
+
+    if not duplicated.any():
+        return mapping_df
+
+    dropped = []
+    groups = mapping_df[duplicated].groupby('series_uid', sort=False)
+
+    for series_uid, group in groups:
+
+        # Uncompressed series are stored in the map with their absolute path, compressed ones relative to the archive
+        ranked = sorted(group.index, key=lambda idx: (-_get_instance_count(group.at[idx, 'n_instances']),
+                                                      not os.path.isabs(group.at[idx, 'scan_dir'])))
+
+        kept, others = ranked[0], ranked[1:]
+
+        # Rows of merged shard maps may already list the copies their shard found
+        alt_sources = [group.at[idx, 'scan_dir'] for idx in others]
+        alt_sources.extend(alt_source for idx in ranked for alt_source in
+                           (group.at[idx, 'alt_sources'] or "").split(ALT_SOURCES_SEP) if alt_source)
+
+        if log and len(set(group['n_instances'])) > 1:
+            log.warning("The copies of series {} have different numbers of instances ({}), keeping the {} in "
+                        "{}".format(series_uid, ", ".join("{}".format(count) for count in group['n_instances']),
+                                    group.at[kept, 'n_instances'], group.at[kept, 'scan_dir']))
+
+        mapping_df.at[kept, 'alt_sources'] = intern_str(ALT_SOURCES_SEP.join(alt_sources))
+        dropped.extend(others)
+
+    if log:
+        log.info("Found {} duplicate copies of {} DICOM series, each series will only be converted once.".format(
+            len(dropped), groups.ngroups))
+
+    return mapping_df.drop(dropped)
@@ -15,6 +15,7 @@ import bioread
 import matplotlib.pyplot as plt
 
 from common_utils.utils import init_log, log_shutdown, create_path
+from common_utils.metrics import StageMetrics
 from datetime import datetime
 
 
@@ -67,6 +68,14 @@ def main():
         action='store_true'
     )
 
+    parser.add_argument(
+        '--trace',
+        dest="trace",
+        help='Write a Chrome trace-event timeline of the run to this file (viewable in Perfetto)',
+        type=str,
+        default=None
+    )
+
     settings = parser.parse_args()
 
     if os.path.isfile(settings.output_prefix + "_ECG.1D") and not settings.overwrite:
@@ -77,43 +86,51 @@ def main():
     log_fpath = os.path.join(os.getcwd(), "biounpack_{}.log".format(start_datetime))
     log = init_log(log_fpath, log_name='biounpack')
 
+    metrics = StageMetrics('process_biopac', trace_fpath=settings.trace)
+
     log.info("Reading biopack file: {}".format(settings.input_file))
 
-    biopac_channels = biounpacker(settings.input_file)
+    with metrics.stage('biopac_reading') as sample:
+
+        biopac_channels = biounpacker(settings.input_file)
 
-    data_resp = np.array(biopac_channels['resp'].data, dtype=float)
-    data_ecg = np.array(biopac_channels['ecg'].data, dtype=float)
-    data_trigger = np.array(biopac_channels['triggers'].data, dtype=float)
+        data_resp = np.array(biopac_channels['resp'].data, dtype=float)
+        data_ecg = np.array(biopac_channels['ecg'].data, dtype=float)
+        data_trigger = np.array(biopac_channels['triggers'].data, dtype=float)
+
+        sample.add(bytes_read=os.path.getsize(settings.input_file))
 
     if settings.info:
 
         log.info("Plotting physiological data onto file: "
                  "{}_plots.pdf".format(settings.output_prefix))
 
-        fig = plt.figure()
-        fig.set_size_inches(8.5, 11)
-        fig.subplots_adjust(hspace=3, wspace=0)
-        plt.subplot(3, 1, 1)
-        plt.title("{} - {} samples/secs".format(biopac_channels['resp'].name,
-                                                biopac_channels['resp'].samples_per_second))
-        plt.ylabel(biopac_channels['resp'].units)
-        plt.xlabel("sample")
-        plt.plot(data_resp)
-        plt.subplot(3, 1, 2)
-        plt.title("{} - {} samples/secs".format(biopac_channels['ecg'].name,
-                                                biopac_channels['ecg'].samples_per_second))
-        plt.ylabel(biopac_channels['ecg'].units)
-        plt.xlabel("sample")
-        plt.plot(data_ecg)
-        plt.subplot(3, 1, 3)
-        plt.title("{} - {} samples/secs".format(biopac_channels['triggers'].name,
-                                                biopac_channels['triggers'].samples_per_second))
-        plt.ylabel(biopac_channels['triggers'].units)
-        plt.xlabel("sample")
-        plt.plot(data_trigger)
-        fig.tight_layout()
-        plt.savefig("{}_plots.pdf".format(settings.output_prefix))
-        plt.close()
+        with metrics.stage('plotting'):
+
+            fig = plt.figure()
+            fig.set_size_inches(8.5, 11)
+            fig.subplots_adjust(hspace=3, wspace=0)
+            plt.subplot(3, 1, 1)
+            plt.title("{} - {} samples/secs".format(biopac_channels['resp'].name,
+                                                    biopac_channels['resp'].samples_per_second))
+            plt.ylabel(biopac_channels['resp'].units)
+            plt.xlabel("sample")
+            plt.plot(data_resp)
+            plt.subplot(3, 1, 2)
+            plt.title("{} - {} samples/secs".format(biopac_channels['ecg'].name,
+                                                    biopac_channels['ecg'].samples_per_second))
+            plt.ylabel(biopac_channels['ecg'].units)
+            plt.xlabel("sample")
+            plt.plot(data_ecg)
+            plt.subplot(3, 1, 3)
+            plt.title("{} - {} samples/secs".format(biopac_channels['triggers'].name,
+                                                    biopac_channels['triggers'].samples_per_second))
+            plt.ylabel(biopac_channels['triggers'].units)
+            plt.xlabel("sample")
+            plt.plot(data_trigger)
+            fig.tight_layout()
+            plt.savefig("{}_plots.pdf".format(settings.output_prefix))
+            plt.close()
 
     out_path = os.path.abspath(settings.output_prefix)
 
@@ -143,12 +160,16 @@ def main():
 
     log.info("Saving 1D files...")
 
-    np.savetxt(out_path + '_Resp.1D', data_resp)
-    np.savetxt(out_path + '_ECG.1D', data_ecg)
-    np.savetxt(out_path + '_Trigger.1D', data_trigger)
+    with metrics.stage('physio_writing', items=3):
+        np.savetxt(out_path + '_Resp.1D', data_resp)
+        np.savetxt(out_path + '_ECG.1D', data_ecg)
+        np.savetxt(out_path + '_Trigger.1D', data_trigger)
 
     log.info("Biopack data to 1D file conversion complete!")
 
+    if settings.trace:
+        log.info("Trace timeline stored in {}".format(metrics.write_trace()))
+
     log_shutdown(log)
 
 
@@ -0,0 +1,226 @@
+from __future__ import print_function, unicode_literals
+
+import argparse
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from common_utils.metrics import NULL_METRICS, _wall_clock
+from common_utils.utils import get_cpu_count, get_available_memory, get_total_memory
+
+
+AUTO_THREADS = 'auto'
+
+# Upper bound of the adaptive pools, as a multiple of the number of CPUs. Pools of I/O bound work (listing archives,
+# reading headers) gain from many more threads than CPUs on network file systems, CPU bound ones (dcm2niix) do not
+DEFAULT_IO_FACTOR = 8
+DEFAULT_CPU_FACTOR = 2
+
+# Seconds over which the throughput of an adaptive pool is measured before the number of workers is changed
+DEFAULT_INTERVAL = 2.0
+
+# Relative change in throughput below which a change in the number of workers is not considered an improvement
+DEFAULT_TOLERANCE = 0.05
+
+# Items whose median latency over a window rises this many times above the lowest median seen are taken as a sign of
+# file system congestion
+DEFAULT_LATENCY_SPIKE = 4.0
+
+# Fraction of the memory that must remain available for the number of workers to grow
+DEFAULT_MEMORY_FLOOR = 0.1
+
+
+class AutoThreads(object):
+    """Value of --nthreads auto: the pools adapt their number of threads, up to max_workers if given."""
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+
+    def __str__(self):
+        return AUTO_THREADS if self.max_workers is None else "{}:{}".format(AUTO_THREADS, self.max_workers)
+
+
+def parse_nthreads(value):
+    """argparse type of --nthreads: a number of threads, or 'auto' (optionally 'auto:<max threads>')."""
+
+    value = "{}".format(value).strip().lower()
+
+    try:
+
+        if value == AUTO_THREADS:
+            return AutoThreads()
+
+        if value.startswith("{}:".format(AUTO_THREADS)):
+            max_workers = int(value.split(":", 1)[1])
+            if max_workers < 1:
+                raise ValueError
+            return AutoThreads(max_workers)
+
+        return int(value)
+
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid number of threads {}, use a number or {} (or {}:<max "
+                                         "threads>)".format(value, AUTO_THREADS, AUTO_THREADS))
+
+
+def get_max_workers(nthreads, io_bound=False):
+    """Largest number of threads a pool sized by nthreads (a number, or AutoThreads) may run at once."""
+
+    if not isinstance(nthreads, AutoThreads):
+        return max(1, nthreads)
+
+    if nthreads.max_workers:
+        return nthreads.max_workers
+
+    return get_cpu_count() * (DEFAULT_IO_FACTOR if io_bound else DEFAULT_CPU_FACTOR)
+
+
+def get_executor(nthreads, pool, metrics=None, io_bound=False):
+    """Executor for a pool of work items: a ThreadPoolExecutor of nthreads threads, or an AdaptiveExecutor if
+    nthreads is AutoThreads."""
+
+    if isinstance(nthreads, AutoThreads):
+        # The items of CPU bound pools (e.g. the conversion of series of any size) vary too much in cost for their
+        # latency to tell anything about congestion
+        return AdaptiveExecutor(get_max_workers(nthreads, io_bound), pool=pool, metrics=metrics,
+                                latency_spike=DEFAULT_LATENCY_SPIKE if io_bound else None)
+
+    return ThreadPoolExecutor(max_workers=max(1, nthreads))
+
+
+class AdaptiveExecutor(object):
+    """ThreadPoolExecutor whose number of work items running at once adapts to the throughput it achieves.
+
+    Work items are counted as they complete. Every interval seconds (once at least as many items as are allowed to
+    run at once have completed), the throughput of the last window is compared to the one before: the number of
+    workers keeps moving in the same direction while it improves by more than tolerance, and turns back otherwise,
+    so it climbs towards the point past which more threads stop paying off, and stays around it as the work changes.
+    It is always kept between min_workers and max_workers.
+
+    The pool also backs off on its own: by a quarter when the median latency of the items of a window spikes
+    latency_spike times above the lowest seen (e.g. a congested file server), unless latency_spike is None, and by
+    half when less than memory_floor of the memory remains available. The number of workers is recorded in the
+    concurrency:<pool> gauge of the metrics.
+
+    clock (seconds, as a float) and available_memory (bytes, or None if unknown) default to the wall clock and the
+    memory available on this node, and total_memory to the memory of the node.
+    """
+
+    def __init__(self, max_workers, min_workers=1, initial_workers=None, pool='pool', metrics=None,
+                 interval=DEFAULT_INTERVAL, tolerance=DEFAULT_TOLERANCE, latency_spike=DEFAULT_LATENCY_SPIKE,
+                 memory_floor=DEFAULT_MEMORY_FLOOR, clock=_wall_clock, available_memory=get_available_memory,
+                 total_memory=None):
+
+        self.max_workers = max(1, max_workers)
+        self.min_workers = max(1, min(min_workers, self.max_workers))
+        self.pool = pool
+        self.metrics = metrics if metrics is not None else NULL_METRICS
+        self.interval = interval
+        self.tolerance = tolerance
+        self.latency_spike = latency_spike
+        self.memory_floor = memory_floor
+
+        if initial_workers is None:
+            initial_workers = get_cpu_count()
+
+        self.limit = max(self.min_workers, min(initial_workers, self.max_workers))
+        self.adjustments = 0
+
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self._cond = threading.Condition()
+        self._running = 0
+        self._direction = 1
+
+        self._clock = clock
+        self._available_memory = available_memory
+        self._window_start = clock()
+        self._window_latencies = []
+        self._last_throughput = None
+        self._min_latency = None
+        self._total_memory = total_memory if total_memory is not None else get_total_memory()
+
+        self.metrics.set_gauge("concurrency:{}".format(self.pool), self.limit)
+
+    def submit(self, fn, *args, **kwargs):
+        return self._executor.submit(self._run, fn, args, kwargs)
+
+    def _run(self, fn, args, kwargs):
+
+        # The threads beyond the current limit wait here, so lowering it takes effect as soon as items complete
+        with self._cond:
+            while self._running >= self.limit:
+                self._cond.wait()
+            self._running += 1
+
+        start = self._clock()
+
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            end = self._clock()
+
+            with self._cond:
+                self._running -= 1
+                self._window_latencies.append(end - start)
+                self._adjust(end)
+                self._cond.notify_all()
+
+    def _memory_pressure(self):
+
+        if not self._total_memory:
+            return False
+
+        available = self._available_memory()
+
+        return available is not None and available < self.memory_floor * self._total_memory
+
+    def _adjust(self, now):
+
+        elapsed = now - self._window_start
+        completed = len(self._window_latencies)
+
+        if elapsed < self.interval or completed < self.limit:
+            return
+
+        throughput = completed / elapsed
+        latencies = sorted(self._window_latencies)
+        latency = latencies[completed // 2]
+
+        self._min_latency = latency if self._min_latency is None else min(self._min_latency, latency)
+
+        if self._memory_pressure():
+            limit = self.limit // 2
+            self._direction = -1
+        elif self.latency_spike is not None and self._min_latency > 0 and \
+                latency > self.latency_spike * self._min_latency:
+            limit = self.limit - max(1, self.limit // 4)
+            self._direction = -1
+        else:
+            if self._last_throughput is not None and throughput <= self._last_throughput * (1 + self.tolerance):
+                self._direction = -self._direction
+
+            limit = self.limit + self._direction * max(1, self.limit // 4)
+
+        limit = max(self.min_workers, min(limit, self.max_workers))
+
+        # Turn back at the bounds, rather than pushing against them
+        if limit in (self.min_workers, self.max_workers) and limit == self.limit:
+            self._direction = -self._direction
+
+        if limit != self.limit:
+            self.limit = limit
+            self.adjustments += 1
+            self.metrics.set_gauge("concurrency:{}".format(self.pool), limit)
+
+        self._last_throughput = throughput
+        self._window_start = now
+        self._window_latencies = []
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown(wait=True)
+        return False
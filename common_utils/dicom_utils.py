@@ -0,0 +1,173 @@
+from __future__ import print_function, unicode_literals
+
+import io
+import zlib
+import struct
+import tarfile
+
+from pydicom.tag import Tag
+from collections import OrderedDict
+from pydicom.errors import InvalidDicomError
+from pydicom.filereader import read_partial
+
+
+# Bytes read from the start of each DICOM file before attempting to parse its header. The standard groups and the
+# (0019) private group of Oxygen/Gold scans fit comfortably in this, and the vendor blobs that follow them (e.g. the
+# SIEMENS CSA headers in group 0029) are never read. The whole file is read only if the prefix is not enough.
+HEADER_PREFIX_BYTES = 16 * 1024
+
+# Errors raised by pydicom when the bytes it reads end before the element it is parsing
+TRUNCATED_HEADER_ERRORS = (InvalidDicomError, EOFError, IOError, struct.error)
+
+# Tags read by the tools regardless of the configured DICOM_TAGS
+SPECIFIC_CHARACTER_SET = Tag(0x0008, 0x0005)
+REQUIRED_TAGS = (
+    SPECIFIC_CHARACTER_SET,
+    Tag(0x0008, 0x0020),  # Study Date
+    Tag(0x0008, 0x0030),  # Study Time
+    Tag(0x0010, 0x0020),  # Patient ID
+    Tag(0x0020, 0x000e),  # Series Instance UID
+)
+
+
+# Parsed DICOM_TAGS entries, since the same few are looked up for every series
+_HEX_TAGS = {}
+
+
+def parse_dicom_hex(hex_str):
+
+    tag = _HEX_TAGS.get(hex_str)
+
+    if tag is None:
+        dcm_group, dcm_element = hex_str.split(",")
+        tag = _HEX_TAGS[hex_str] = Tag(int(dcm_group.strip(), 16), int(dcm_element.strip(), 16))
+
+    return tag
+
+
+def get_header_tags(dicom_tags, extra_tags=REQUIRED_TAGS):
+    """Sorted list of every tag referenced in a DICOM_TAGS config section, plus extra_tags."""
+
+    tags = set(extra_tags)
+
+    for curr_val in dicom_tags.values():
+        for hex_str in (curr_val if isinstance(curr_val, list) else [curr_val]):
+            tags.add(parse_dicom_hex(hex_str))
+
+    return sorted(tags)
+
+
+def _parse_header(dcm_bytes, header_tags):
+    """Parse dcm_bytes up to the last of header_tags, reading only the values of header_tags.
+
+    Returns the dataset, and whether parsing stopped past the last tag (i.e. the header is complete, even if
+    dcm_bytes is only a prefix of the file).
+    """
+
+    last_tag = header_tags[-1]
+    state = {'complete': False}
+
+    def stop_when(tag, vr, length):
+        if tag > last_tag:
+            state['complete'] = True
+            return True
+        return False
+
+    curr_dcm = read_partial(io.BytesIO(dcm_bytes), stop_when=stop_when, specific_tags=list(header_tags))
+
+    return curr_dcm, state['complete']
+
+
+def parse_dicom_header(read_prefix, read_full, header_tags):
+    """Parse a DICOM header from a bounded prefix of the file, falling back to the whole file if needed.
+
+    read_prefix returns the first HEADER_PREFIX_BYTES bytes of the file (or all of it, if shorter), and read_full
+    returns the whole file. Returns the parsed dataset and the number of bytes read.
+    """
+
+    dcm_bytes = read_prefix()
+
+    try:
+        curr_dcm, complete = _parse_header(dcm_bytes, header_tags)
+    except TRUNCATED_HEADER_ERRORS:
+        # The prefix cut an element the header needs, parse the whole file below
+        curr_dcm, complete = None, False
+
+    if complete or (curr_dcm is not None and len(dcm_bytes) < HEADER_PREFIX_BYTES):
+        return curr_dcm, len(dcm_bytes)
+
+    dcm_bytes = read_full()
+    curr_dcm, _ = _parse_header(dcm_bytes, header_tags)
+
+    return curr_dcm, len(dcm_bytes)
+
+
+def read_dicom_header(dcm_file, header_tags):
+    """Read the header_tags of an uncompressed DICOM file, reading only a bounded prefix of it when possible."""
+
+    with open(dcm_file, 'rb') as dcm_fobj:
+
+        def read_full():
+            dcm_fobj.seek(0)
+            return dcm_fobj.read()
+
+        return parse_dicom_header(lambda: dcm_fobj.read(HEADER_PREFIX_BYTES), read_full, header_tags)
+
+
+def read_compressed_dicom_header(compressed_file, dcm_file, header_tags):
+    """Read the header_tags of a DICOM file stored in a compressed Oxygen/Gold archive.
+
+    Only a bounded prefix of the file is decompressed when possible. Raises IOError if the file cannot be extracted.
+    """
+
+    try:
+
+        with tarfile.open(compressed_file, 'r:*') as tar_file:
+
+            # Members are read in order, stopping at the file rather than listing the rest of the archive
+            dcm_member = next((member for member in tar_file if member.name == dcm_file), None)
+
+            if dcm_member is None or not dcm_member.isfile():
+                raise IOError("{} is not a file of {}".format(dcm_file, compressed_file))
+
+            dcm_fobj = tar_file.extractfile(dcm_member)
+
+            def read_full():
+                dcm_fobj.seek(0)
+                return dcm_fobj.read()
+
+            return parse_dicom_header(lambda: dcm_fobj.read(HEADER_PREFIX_BYTES), read_full, header_tags)
+
+    except (tarfile.TarError, EOFError, zlib.error) as e:
+        raise IOError("Unable to extract {} from {}: {}".format(dcm_file, compressed_file, e))
+
+
+def get_dicom_value(curr_dcm, hex_strs):
+    """Value of the first of hex_strs (a DICOM_TAGS entry, a hex string or list of them) present in curr_dcm."""
+
+    for hex_str in (hex_strs if isinstance(hex_strs, list) else [hex_strs]):
+
+        dcm_dat = curr_dcm.get(parse_dicom_hex(hex_str), None)
+
+        if dcm_dat:
+            return dcm_dat.value
+
+    return None
+
+
+def get_tag_values(curr_dcm, dicom_tags):
+    """Values of every entry of a DICOM_TAGS config section in curr_dcm, keyed by name (None for missing tags)."""
+
+    return OrderedDict((tag, get_dicom_value(curr_dcm, hex_strs)) for tag, hex_strs in dicom_tags.items())
+
+
+def get_dicom_metadata(dcm_file, tag_values):
+    """Row of the dcmexplorer metadata table for dcm_file, from the values returned by get_tag_values."""
+
+    metadata = OrderedDict()
+    metadata["dicom_file"] = "/".join(dcm_file.split("/")[-4:])
+
+    for tag, dcm_val in tag_values.items():
+        metadata[tag] = dcm_val if dcm_val is not None else ""
+
+    return metadata
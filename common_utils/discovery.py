@@ -0,0 +1,202 @@
+from __future__ import print_function, unicode_literals
+
+import os
+import re
+
+from collections import deque
+from common_utils.concurrency import get_executor, get_max_workers
+from common_utils.metrics import NULL_METRICS
+
+try:
+    from os import scandir
+except ImportError:  # Python 2
+    scandir = None
+
+
+# Realtime physio files are named after the scan they were recorded with, e.g. ECG_epiRT_scan_0003_20170208.1D
+# for the series in the mr_0003 folder
+SCAN_KEY_RE = re.compile(r'scan_([^_.]+)')
+
+
+class _DirEntry(object):
+    """Minimal stand-in for os.DirEntry on interpreters without os.scandir."""
+
+    def __init__(self, dir_path, name):
+        self.name = name
+        self.path = os.path.join(dir_path, name)
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def is_file(self):
+        return os.path.isfile(self.path)
+
+    def stat(self):
+        return os.stat(self.path)
+
+
+def _scandir(dir_path):
+
+    if scandir:
+        return scandir(dir_path)
+
+    return iter([_DirEntry(dir_path, name) for name in os.listdir(dir_path)])
+
+
+def _visible_entries(dir_path):
+    """Entries of dir_path in directory order, skipping hidden ones like glob does."""
+
+    try:
+        entries = _scandir(dir_path)
+    except OSError:
+        return
+
+    try:
+        for entry in entries:
+            if not entry.name.startswith("."):
+                yield entry
+    finally:
+        # Release the directory handle right away when the caller stops early
+        if hasattr(entries, 'close'):
+            entries.close()
+
+
+def get_scan_key(scan_dir):
+    """Key of a series folder in the realtime index, e.g. '0003' for .../mr_0003."""
+    return os.path.basename(scan_dir.rstrip("/")).split("_")[-1]
+
+
+def build_realtime_index(rt_files):
+    """Map each scan key to the cardiac ('cardio') and respiratory ('resp') realtime files recorded with it."""
+
+    index = {}
+
+    for rt_file in rt_files:
+
+        rt_name = os.path.basename(rt_file)
+        match = SCAN_KEY_RE.search(rt_name)
+
+        if not match:
+            continue
+
+        if "ECG" in rt_name:
+            index.setdefault(match.group(1), {})['cardio'] = rt_file
+        elif "Resp" in rt_name:
+            index.setdefault(match.group(1), {})['resp'] = rt_file
+
+    return index
+
+
+def get_realtime_files(rt_index, scan_dir):
+    """Cardiac and respiratory realtime files of the series in scan_dir, or None for the ones not recorded."""
+
+    physio = rt_index.get(get_scan_key(scan_dir), {})
+
+    return physio.get('cardio'), physio.get('resp')
+
+
+def _first_dicom(series_dir):
+    """Path of the first .dcm file in series_dir, stopping the directory read as soon as one is found."""
+
+    for entry in _visible_entries(series_dir):
+        if entry.name.endswith(".dcm"):
+            return entry.path
+
+    return None
+
+
+def get_series_size(series_dir):
+    """Number of .dcm files in series_dir, and their total size in bytes."""
+
+    n_instances = 0
+    series_bytes = 0
+
+    for entry in _visible_entries(series_dir):
+        if entry.name.endswith(".dcm"):
+            n_instances += 1
+            series_bytes += entry.stat().st_size
+
+    return n_instances, series_bytes
+
+
+def _scan_session(session_dir, metrics):
+    """List the series of one subject/session directory, with the realtime physio files matched to each."""
+
+    with metrics.stage('directory_scan', items=0) as sample:
+
+        series_dirs = []
+        rt_files = []
+
+        for entry in _visible_entries(session_dir):
+
+            if not entry.is_dir():
+                continue
+
+            series_dirs.append(entry.path)
+
+            if entry.name == "realtime":
+                rt_files.extend(rt_entry.path for rt_entry in _visible_entries(entry.path)
+                                if rt_entry.name.endswith(".1D"))
+
+        rt_index = build_realtime_index(rt_files)
+        series = []
+
+        for series_dir in series_dirs:
+
+            dcm_file = _first_dicom(series_dir)
+
+            if dcm_file:
+                cardio, resp = get_realtime_files(rt_index, series_dir)
+                series.append((dcm_file, cardio, resp))
+
+        sample.add(items=len(series))
+
+    return series
+
+
+def iter_session_dirs(dicom_dir):
+    """Yield the subject/session directories of the uncompressed tree of dicom_dir, in directory order."""
+
+    for subject in _visible_entries(dicom_dir):
+        if subject.is_dir():
+            for session in _visible_entries(subject.path):
+                if session.is_dir():
+                    yield session.path
+
+
+def count_series_dirs(session_dir):
+    """Number of folders in a subject/session directory, i.e. an upper bound on its number of series."""
+    return sum(1 for entry in _visible_entries(session_dir) if entry.is_dir())
+
+
+def iter_uncompressed_series(dicom_dir, nthreads=1, metrics=None, session_filter=None):
+    """Lazily yield (first .dcm file, cardiac physio, respiratory physio) for every series in the uncompressed
+    subject/session/series tree of dicom_dir.
+
+    Session directories are scanned in parallel, since listing directories is dominated by latency on network file
+    systems, and only a bounded number of them are scanned ahead of the consumer. Series are yielded in directory
+    order, the same order glob would return them in. With session_filter, only the session directories for which it
+    returns True are scanned.
+    """
+
+    metrics = metrics if metrics is not None else NULL_METRICS
+    lookahead = 4 * get_max_workers(nthreads, io_bound=True)
+
+    with get_executor(nthreads, 'directory_scan', metrics, io_bound=True) as executor:
+
+        pending = deque()
+
+        for session_dir in iter_session_dirs(dicom_dir):
+
+            if session_filter is not None and not session_filter(session_dir):
+                continue
+
+            pending.append(metrics.submit(executor, 'directory_scan', _scan_session, session_dir, metrics))
+
+            if len(pending) >= lookahead:
+                for series in pending.popleft().result():
+                    yield series
+
+        while pending:
+            for series in pending.popleft().result():
+                yield series
@@ -0,0 +1,344 @@
+from __future__ import division, print_function, unicode_literals
+
+import os
+import json
+import time
+import threading
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from common_utils.tracing import TraceRecorder
+
+
+# Wall clock used for stage durations, and per-thread CPU clock where the interpreter provides one (the tools run
+# their stages in thread pools, so process-wide CPU time would mix the work of unrelated workers)
+_wall_clock = getattr(time, 'perf_counter', time.time)
+_cpu_clock = getattr(time, 'thread_time', None) or getattr(time, 'process_time', None) or time.clock
+
+MB = 1024.0 * 1024.0
+
+
+def percentile(sorted_values, pct):
+
+    if not sorted_values:
+        return 0.0
+
+    rank = int(round((pct / 100.0) * (len(sorted_values) - 1)))
+
+    return sorted_values[max(0, min(rank, len(sorted_values) - 1))]
+
+
+def get_dir_size(path):
+
+    total = 0
+
+    for root, _, files in os.walk(path):
+        for fname in files:
+            try:
+                total += os.path.getsize(os.path.join(root, fname))
+            except OSError:
+                pass
+
+    return total
+
+
+def get_file_size(path):
+
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class StageSample(object):
+    """Counters for one invocation of a stage, updated by the code being timed."""
+
+    __slots__ = ('items', 'bytes_read', 'bytes_written')
+
+    def __init__(self, items=1):
+        self.items = items
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def add(self, items=0, bytes_read=0, bytes_written=0):
+        self.items += items
+        self.bytes_read += bytes_read
+        self.bytes_written += bytes_written
+
+
+class StageStats(object):
+    """Accumulated totals and latency samples for every invocation of a stage."""
+
+    __slots__ = ('calls', 'errors', 'items', 'wall', 'cpu', 'bytes_read', 'bytes_written', 'first_start', 'last_end',
+                 'latencies')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.items = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.first_start = None
+        self.last_end = None
+        self.latencies = []
+
+    def summary(self, origin):
+
+        latencies = sorted(self.latencies)
+
+        # Throughput is measured over the window in which the stage was active, since invocations of the same
+        # stage overlap when running on several threads
+        window = (self.last_end - self.first_start) if self.calls else 0.0
+
+        return OrderedDict([
+            ('calls', self.calls),
+            ('errors', self.errors),
+            ('items', self.items),
+            ('wall_seconds', self.wall),
+            ('cpu_seconds', self.cpu),
+            ('bytes_read', self.bytes_read),
+            ('bytes_written', self.bytes_written),
+            ('first_start', (self.first_start - origin) if self.calls else None),
+            ('last_end', (self.last_end - origin) if self.calls else None),
+            ('active_seconds', window),
+            ('items_per_second', (self.items / window) if window > 0 else None),
+            ('read_mb_per_second', (self.bytes_read / MB / window) if window > 0 else None),
+            ('write_mb_per_second', (self.bytes_written / MB / window) if window > 0 else None),
+            ('latency_seconds', OrderedDict([
+                ('p50', percentile(latencies, 50)),
+                ('p95', percentile(latencies, 95)),
+                ('max', latencies[-1] if latencies else 0.0),
+            ])),
+        ])
+
+
+class StageMetrics(object):
+    """Thread-safe collector of wall time, CPU time, bytes and item counts for the stages of a run."""
+
+    def __init__(self, run_name, trace_fpath=None, profiler=None):
+        self.run_name = run_name
+        self.profiler = profiler
+        self._lock = threading.Lock()
+        self._stages = OrderedDict()
+        self._queued = {}
+        self._counters = OrderedDict()
+        self._gauges = OrderedDict()
+        self._origin = _wall_clock()
+        self._start_time = time.time()
+        self.tracer = TraceRecorder(trace_fpath, self._origin) if trace_fpath else None
+
+    @contextmanager
+    def stage(self, name, items=1):
+
+        sample = StageSample(items)
+        failed = False
+
+        profile_token = self.profiler.start(name) if self.profiler else None
+
+        start_wall = _wall_clock()
+        start_cpu = _cpu_clock()
+
+        try:
+            yield sample
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            end_wall = _wall_clock()
+            end_cpu = _cpu_clock()
+
+            if profile_token:
+                self.profiler.stop(profile_token)
+
+            self._record(name, sample, start_wall, end_wall, end_cpu - start_cpu, failed)
+
+    def submit(self, executor, pool, fn, *args, **kwargs):
+        """Submit fn to executor, recording the time each work item spends queued before a worker picks it up."""
+
+        submitted = _wall_clock()
+        self._update_queue(pool, 1, submitted)
+
+        def queued_call():
+            started = _wall_clock()
+            self._update_queue(pool, -1, started)
+            self._record("queue_wait:{}".format(pool), StageSample(), submitted, started, 0.0, False, cat='queue')
+            return fn(*args, **kwargs)
+
+        return executor.submit(queued_call)
+
+    @contextmanager
+    def waiting(self, pool):
+        """Time spent by the submitting thread blocked on the results of a pool."""
+
+        start = _wall_clock()
+
+        try:
+            yield
+        finally:
+            self._record("pool_wait:{}".format(pool), StageSample(), start, _wall_clock(), 0.0, False, cat='wait')
+
+    def _update_queue(self, pool, delta, when):
+
+        with self._lock:
+            depth = self._queued[pool] = self._queued.get(pool, 0) + delta
+
+        if self.tracer:
+            self.tracer.counter("queue_depth:{}".format(pool), when, {'queued': depth})
+
+    def queue_depths(self):
+
+        with self._lock:
+            return dict(self._queued)
+
+    def incr(self, counter, value=1):
+
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + value
+
+    def set_gauge(self, gauge, value):
+
+        with self._lock:
+            self._gauges[gauge] = value
+
+    def totals(self):
+        """Cheap point-in-time copy of the counters, gauges and per-stage totals (no latency percentiles)."""
+
+        with self._lock:
+            return OrderedDict([
+                ('counters', OrderedDict(self._counters)),
+                ('gauges', OrderedDict(self._gauges)),
+                ('queue_depths', dict(self._queued)),
+                ('stages', OrderedDict(
+                    (name, OrderedDict([
+                        ('calls', stats.calls),
+                        ('errors', stats.errors),
+                        ('items', stats.items),
+                        ('wall_seconds', stats.wall),
+                        ('bytes_read', stats.bytes_read),
+                        ('bytes_written', stats.bytes_written),
+                    ])) for name, stats in self._stages.items()
+                )),
+            ])
+
+    def _record(self, name, sample, start, end, cpu, failed, cat='stage'):
+
+        if self.tracer:
+            self.tracer.span(name, start, end, cat=cat, args={
+                'items': sample.items,
+                'bytes_read': sample.bytes_read,
+                'bytes_written': sample.bytes_written,
+                'error': failed
+            })
+
+        with self._lock:
+
+            stats = self._stages.get(name)
+
+            if stats is None:
+                stats = self._stages[name] = StageStats()
+
+            stats.calls += 1
+            stats.errors += 1 if failed else 0
+            stats.items += sample.items
+            stats.wall += end - start
+            stats.cpu += cpu
+            stats.bytes_read += sample.bytes_read
+            stats.bytes_written += sample.bytes_written
+            stats.first_start = start if stats.first_start is None else min(stats.first_start, start)
+            stats.last_end = end if stats.last_end is None else max(stats.last_end, end)
+            stats.latencies.append(end - start)
+
+    def summary(self):
+
+        with self._lock:
+            stages = OrderedDict((name, stats.summary(self._origin)) for name, stats in self._stages.items())
+            counters = OrderedDict(self._counters)
+
+        return OrderedDict([
+            ('run', self.run_name),
+            ('start_time', self._start_time),
+            ('wall_seconds', _wall_clock() - self._origin),
+            ('counters', counters),
+            ('stages', stages),
+        ])
+
+    def format_summary(self, summary=None):
+
+        summary = summary or self.summary()
+
+        # The stage column is as wide as the longest stage name
+        name_width = max([len("stage")] + [len(name) for name in summary['stages']])
+
+        header = "{:<{}} {:>8} {:>9} {:>10} {:>10} {:>10} {:>10} {:>10} {:>9} {:>9} {:>9}".format(
+            "stage", name_width, "calls", "items", "wall (s)", "cpu (s)", "read (MB)", "write (MB)", "items/s",
+            "p50 (s)", "p95 (s)", "max (s)"
+        )
+
+        lines = [
+            "Run: {}".format(summary['run']),
+            "Total wall time: {:.3f} s".format(summary['wall_seconds']),
+            "",
+            header,
+            "-" * len(header)
+        ]
+
+        for name, stats in summary['stages'].items():
+            lines.append("{:<{}} {:>8} {:>9} {:>10.3f} {:>10.3f} {:>10.2f} {:>10.2f} {:>10} {:>9.3f} {:>9.3f} "
+                         "{:>9.3f}".format(
+                             name, name_width, stats['calls'], stats['items'], stats['wall_seconds'],
+                             stats['cpu_seconds'], stats['bytes_read'] / MB, stats['bytes_written'] / MB,
+                             "{:.2f}".format(stats['items_per_second']) if stats['items_per_second'] else "-",
+                             stats['latency_seconds']['p50'], stats['latency_seconds']['p95'],
+                             stats['latency_seconds']['max']))
+
+        return "\n".join(lines) + "\n"
+
+    def write_report(self, out_dir, prefix):
+
+        summary = self.summary()
+
+        json_fpath = os.path.join(out_dir, "{}.json".format(prefix))
+        txt_fpath = os.path.join(out_dir, "{}.txt".format(prefix))
+
+        with open(json_fpath, 'w') as json_file:
+            json.dump(summary, json_file, indent=2)
+
+        with open(txt_fpath, 'w') as txt_file:
+            txt_file.write(self.format_summary(summary))
+
+        return json_fpath, txt_fpath
+
+    def write_trace(self):
+        return self.tracer.write() if self.tracer else None
+
+    def write_profile(self):
+        return self.profiler.write() if self.profiler else None
+
+
+class NullStageMetrics(StageMetrics):
+    """Drop-in replacement for StageMetrics used when a caller does not collect metrics."""
+
+    def __init__(self):
+        super(NullStageMetrics, self).__init__(run_name=None)
+
+    @contextmanager
+    def stage(self, name, items=1):
+        yield StageSample(items)
+
+    def submit(self, executor, pool, fn, *args, **kwargs):
+        return executor.submit(fn, *args, **kwargs)
+
+    @contextmanager
+    def waiting(self, pool):
+        yield
+
+    def incr(self, counter, value=1):
+        pass
+
+    def set_gauge(self, gauge, value):
+        pass
+
+
+NULL_METRICS = NullStageMetrics()
@@ -0,0 +1,173 @@
+from __future__ import division, print_function, unicode_literals
+
+import os
+import re
+import json
+import pstats
+import cProfile
+import threading
+
+from collections import OrderedDict
+from common_utils.utils import create_path
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+
+MB = 1024.0 * 1024.0
+
+
+class StageProfiler(object):
+    """CPU and memory profiler driven by the stages recorded in StageMetrics.
+
+    For every stage, the cProfile statistics of its invocations are merged into a single pstats dump, and
+    tracemalloc is used to record the peak traced memory of each invocation along with the top allocation sites
+    observed when the memory held by the process was at its highest while the stage was running.
+
+    cProfile only allows a single active profiler per process on recent interpreters, so when several workers run
+    stages concurrently only one invocation is profiled at a time and the rest are counted as unsampled. Over a long
+    run this samples every stage in proportion to how often it runs.
+    """
+
+    def __init__(self, out_dir, top_n=25, snapshot_growth=1.25):
+        self.out_dir = out_dir
+        self.top_n = top_n
+        self.snapshot_growth = snapshot_growth
+        self._lock = threading.Lock()
+        self._busy = False
+        self._stats = OrderedDict()
+        self._memory = OrderedDict()
+
+        # A single frame per allocation is all the lineno statistics need, and keeps snapshots cheap to take
+        if tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start(1)
+
+    def _stage_memory(self, stage):
+
+        mem = self._memory.get(stage)
+
+        if mem is None:
+            mem = self._memory[stage] = OrderedDict([
+                ('calls', 0),
+                ('profiled_calls', 0),
+                ('peak_bytes', 0),
+                ('max_current_bytes', 0),
+                ('top_allocations', []),
+            ])
+
+        return mem
+
+    def start(self, stage):
+
+        profile = None
+
+        with self._lock:
+
+            self._stage_memory(stage)['calls'] += 1
+
+            if not self._busy:
+                self._busy = True
+                profile = cProfile.Profile()
+
+        if profile is not None:
+
+            # Only the invocation holding the profiler resets the tracemalloc peak, so the peak read back in stop()
+            # belongs to this invocation (plus whatever other workers allocated meanwhile)
+            if tracemalloc and hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiling tool (e.g. a debugger or an outer cProfile run) is already active
+                with self._lock:
+                    self._busy = False
+                profile = None
+
+        return stage, profile
+
+    def stop(self, token):
+
+        stage, profile = token
+
+        if profile is None:
+            return
+
+        profile.disable()
+
+        current, peak = tracemalloc.get_traced_memory() if tracemalloc else (0, 0)
+
+        with self._lock:
+
+            self._busy = False
+
+            if stage in self._stats:
+                self._stats[stage].add(profile)
+            else:
+                self._stats[stage] = pstats.Stats(profile)
+
+            mem = self._stage_memory(stage)
+            mem['profiled_calls'] += 1
+            mem['peak_bytes'] = max(mem['peak_bytes'], peak)
+
+            take_snapshot = tracemalloc is not None and current > mem['max_current_bytes'] * self.snapshot_growth
+
+            if take_snapshot:
+                mem['max_current_bytes'] = current
+
+        if take_snapshot:
+
+            top_stats = tracemalloc.take_snapshot().statistics('lineno')[:self.top_n]
+
+            with self._lock:
+                mem['top_allocations'] = [
+                    OrderedDict([
+                        ('location', "{}:{}".format(stat.traceback[0].filename, stat.traceback[0].lineno)),
+                        ('size_bytes', stat.size),
+                        ('count', stat.count),
+                    ]) for stat in top_stats
+                ]
+
+    def write(self):
+
+        create_path(self.out_dir)
+
+        with self._lock:
+
+            summary = OrderedDict([
+                ('peak_traced_bytes', max([mem['peak_bytes'] for mem in self._memory.values()] or [0])),
+                ('stages', OrderedDict()),
+            ])
+
+            for stage, mem in self._memory.items():
+
+                pstats_fpath = None
+
+                if stage in self._stats:
+                    pstats_fpath = os.path.join(self.out_dir, "{}.pstats".format(re.sub(r'[^\w.-]', '_', stage)))
+                    self._stats[stage].dump_stats(pstats_fpath)
+
+                summary['stages'][stage] = OrderedDict(mem, pstats=pstats_fpath)
+
+        with open(os.path.join(self.out_dir, "memory.json"), 'w') as json_file:
+            json.dump(summary, json_file, indent=2)
+
+        lines = ["Peak traced memory: {:.2f} MB".format(summary['peak_traced_bytes'] / MB), ""]
+
+        for stage, mem in summary['stages'].items():
+
+            lines.append("{} - {} calls ({} profiled), peak {:.2f} MB, max held {:.2f} MB".format(
+                stage, mem['calls'], mem['profiled_calls'], mem['peak_bytes'] / MB, mem['max_current_bytes'] / MB))
+
+            for alloc in mem['top_allocations']:
+                lines.append("    {:>10.1f} KB {:>8} blocks  {}".format(alloc['size_bytes'] / 1024.0, alloc['count'],
+                                                                       alloc['location']))
+
+            lines.append("")
+
+        with open(os.path.join(self.out_dir, "memory.txt"), 'w') as txt_file:
+            txt_file.write("\n".join(lines))
+
+        return self.out_dir
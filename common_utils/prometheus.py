@@ -0,0 +1,142 @@
+from __future__ import division, print_function, unicode_literals
+
+import os
+import time
+import threading
+
+from collections import OrderedDict
+
+
+METRIC_PREFIX = "fmrif_tools"
+
+COUNTER_HELP = OrderedDict([
+    ('series_indexed', "DICOM series found in the input archives and directories."),
+    ('series_classified', "DICOM series matched to a BIDS modality."),
+    ('series_unmatched', "DICOM series that did not match any BIDS heuristic."),
+    ('rows_converted', "BIDS map rows converted successfully."),
+    ('rows_failed', "BIDS map rows that failed to convert."),
+    ('rows_retried', "BIDS map rows tried again after their conversion timed out or failed."),
+    ('rows_quarantined', "BIDS map rows set aside after their conversion kept timing out or failing."),
+    ('dcm2niix_timeouts', "dcm2niix runs stopped for exceeding their timeout."),
+    ('bytes_extracted', "Bytes extracted from compressed Oxygen/Gold archives."),
+    ('bytes_written', "Bytes written to the BIDS dataset."),
+])
+
+GAUGE_HELP = OrderedDict([
+    ('rows_pending', "BIDS map rows waiting to be converted."),
+])
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels):
+    return "{" + ",".join('{}="{}"'.format(key, _escape(val)) for key, val in labels.items()) + "}"
+
+
+class PrometheusTextfileExporter(object):
+    """Periodically dumps the counters of a StageMetrics instance for the node_exporter textfile collector.
+
+    The file is written to a temporary file in the same directory and renamed over the target, so the collector
+    never reads a partially written file. Only running totals are read from StageMetrics, which keeps each write
+    cheap enough to leave on for production runs.
+    """
+
+    def __init__(self, metrics, textfile, tool, interval=15.0):
+        self.metrics = metrics
+        self.textfile = os.path.abspath(textfile)
+        self.tool = tool
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._last_items = {}
+        self._last_time = None
+
+    def start(self):
+
+        self._thread = threading.Thread(target=self._run, name="PrometheusTextfileExporter")
+        self._thread.daemon = True
+        self._thread.start()
+
+        return self
+
+    def stop(self):
+
+        self._stop_event.set()
+
+        if self._thread:
+            self._thread.join()
+
+        # Final write, so the file reflects the totals of the finished run
+        self.write()
+
+    def _run(self):
+
+        while not self._stop_event.wait(self.interval):
+            self.write()
+
+    def render(self):
+
+        totals = self.metrics.totals()
+        now = time.time()
+        tool = OrderedDict([('tool', self.tool)])
+        lines = []
+
+        def add_metric(name, metric_type, help_str, samples):
+            full_name = "{}_{}".format(METRIC_PREFIX, name)
+            lines.append("# HELP {} {}".format(full_name, help_str))
+            lines.append("# TYPE {} {}".format(full_name, metric_type))
+            for labels, value in samples:
+                lines.append("{}{} {}".format(full_name, _labels(labels), value))
+
+        for counter, help_str in COUNTER_HELP.items():
+            add_metric("{}_total".format(counter), "counter", help_str,
+                       [(tool, totals['counters'].get(counter, 0))])
+
+        for gauge, help_str in GAUGE_HELP.items():
+            add_metric(gauge, "gauge", help_str, [(tool, totals['gauges'].get(gauge, 0))])
+
+        add_metric("queue_depth", "gauge", "Work items submitted to a worker pool but not yet started.",
+                   [(OrderedDict([('tool', self.tool), ('pool', pool)]), depth)
+                    for pool, depth in sorted(totals['queue_depths'].items())])
+
+        stages = totals['stages']
+
+        def stage_samples(key):
+            return [(OrderedDict([('tool', self.tool), ('stage', name)]), stats[key]) for name, stats in stages.items()]
+
+        add_metric("stage_items_total", "counter", "Items processed by each stage.", stage_samples('items'))
+        add_metric("stage_errors_total", "counter", "Failed invocations of each stage.", stage_samples('errors'))
+        add_metric("stage_seconds_total", "counter", "Wall time spent in each stage, summed over workers.",
+                   stage_samples('wall_seconds'))
+        add_metric("stage_read_bytes_total", "counter", "Bytes read by each stage.", stage_samples('bytes_read'))
+        add_metric("stage_written_bytes_total", "counter", "Bytes written by each stage.",
+                   stage_samples('bytes_written'))
+
+        # Per-stage rate over the interval since the previous write
+        elapsed = (now - self._last_time) if self._last_time else None
+        rates = []
+
+        for name, stats in stages.items():
+            rate = (stats['items'] - self._last_items.get(name, 0)) / elapsed if elapsed else 0.0
+            rates.append((OrderedDict([('tool', self.tool), ('stage', name)]), rate))
+            self._last_items[name] = stats['items']
+
+        self._last_time = now
+
+        add_metric("stage_items_per_second", "gauge", "Items processed per second by each stage since the previous "
+                                                      "update.", rates)
+        add_metric("last_update_timestamp_seconds", "gauge", "Time of the last update of this file.", [(tool, now)])
+
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+
+        tmp_fpath = "{}.{}.tmp".format(self.textfile, os.getpid())
+
+        with open(tmp_fpath, 'w') as tmp_file:
+            tmp_file.write(self.render())
+
+        # Atomic on POSIX, the collector sees either the previous or the new file
+        os.rename(tmp_fpath, self.textfile)
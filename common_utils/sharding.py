@@ -0,0 +1,217 @@
+from __future__ import print_function, unicode_literals
+
+import os
+import json
+import heapq
+import hashlib
+import argparse
+
+from glob import glob
+
+
+SHARD_BY = ['archive', 'subject']
+
+DEFAULT_SHARD_BY = 'archive'
+
+ARCHIVE_SUFFIX = "-DICOM.tgz"
+
+
+class Shard(object):
+    """Value of --shard i/N: the i-th (counting from 0) of N shards of the work."""
+
+    def __init__(self, index, count):
+        self.index = index
+        self.count = count
+
+    @property
+    def tag(self):
+        """Suffix of the files written by this shard, e.g. shard0of4."""
+        return "shard{}of{}".format(self.index, self.count)
+
+    def __str__(self):
+        return "{}/{}".format(self.index, self.count)
+
+
+def parse_shard(value):
+    """argparse type of --shard: i/N, with 0 <= i < N (e.g. ${SLURM_ARRAY_TASK_ID}/${SLURM_ARRAY_TASK_COUNT})."""
+
+    try:
+
+        index, count = ("{}".format(value).strip().split("/"))
+        index, count = int(index), int(count)
+
+        if count < 1 or not 0 <= index < count:
+            raise ValueError
+
+        return Shard(index, count)
+
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid shard {}, use i/N with 0 <= i < N".format(value))
+
+
+def _shard_key(subject, session, shard_by):
+    return subject if shard_by == 'subject' else "{}-{}".format(subject, session)
+
+
+def get_shard_key(scan_dir, dicom_dir, shard_by=DEFAULT_SHARD_BY):
+    """Key of the unit of work a series of the map belongs to: its archive (subject-session, which is also the name
+    of the session folder of uncompressed series), or its subject.
+
+    Compressed series are stored in the map relative to their archive, and uncompressed ones with their absolute
+    path, see bidsmapper.utils.collapse_duplicate_series. Either way the key is the same, so all the copies of a
+    session end up in the same shard.
+    """
+
+    scan_dir = scan_dir.strip()
+
+    if os.path.isabs(scan_dir):
+        scan_dir = os.path.relpath(scan_dir, dicom_dir)
+
+    subject, session = scan_dir.split("/")[:2]
+
+    return _shard_key(subject, session, shard_by)
+
+
+def get_archive_shard_key(archive_fpath, shard_by=DEFAULT_SHARD_BY):
+    """Key of an Oxygen/Gold archive, e.g. DOE_JOHN-12345-20170101-56789-DICOM.tgz belongs to subject DOE_JOHN-12345
+    and session 20170101-56789. Archives not named that way are their own unit of work, whatever shard_by."""
+
+    name = os.path.basename(archive_fpath)
+
+    if not name.endswith(ARCHIVE_SUFFIX):
+        return name
+
+    fields = name[:-len(ARCHIVE_SUFFIX)].split("-")
+
+    if len(fields) < 4:
+        return name
+
+    return _shard_key("-".join(fields[:2]), "-".join(fields[2:]), shard_by)
+
+
+def get_session_shard_key(session_dir, shard_by=DEFAULT_SHARD_BY):
+    """Key of an uncompressed subject/session directory."""
+
+    subject_dir, session = os.path.split(session_dir.rstrip("/"))
+
+    return _shard_key(os.path.basename(subject_dir), session, shard_by)
+
+
+def balance_shards(costs, count):
+    """Assign each unit of work of costs (key to estimated cost) to one of count shards, so the shards carry about the
+    same total cost.
+
+    Units are placed largest first on the least loaded shard, which keeps the heaviest shard within 4/3 of the
+    optimum. Ties are broken on the key and the shard index, so every node computes the same assignment from the same
+    costs. Returns the shard index of each key, and the total cost of each shard.
+    """
+
+    loads = [(0, index) for index in range(count)]
+    assignment = {}
+
+    for key in sorted(costs, key=lambda key: (-costs[key], key)):
+        load, index = heapq.heappop(loads)
+        assignment[key] = index
+        heapq.heappush(loads, (load + costs[key], index))
+
+    totals = [0] * count
+
+    for load, index in loads:
+        totals[index] = load
+
+    return assignment, totals
+
+
+def get_manifest_path(out_dir, prefix, shard):
+    return os.path.join(out_dir, "{}_manifest_{}.json".format(prefix, shard.tag))
+
+
+def write_manifest(out_dir, prefix, shard, shard_by, **fields):
+    """Write the manifest of a shard to <prefix>_manifest_shard<i>of<N>.json in out_dir, replacing the one of an
+    earlier run of the same shard. Returns its path."""
+
+    manifest = dict(fields, shard=shard.index, count=shard.count, shard_by=shard_by)
+    manifest_fpath = get_manifest_path(out_dir, prefix, shard)
+
+    # Written aside and renamed, so the merge step never reads a partial manifest
+    tmp_fpath = "{}.tmp{}".format(manifest_fpath, os.getpid())
+
+    with open(tmp_fpath, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True, default=str)
+
+    os.rename(tmp_fpath, manifest_fpath)
+
+    return manifest_fpath
+
+
+def load_manifests(out_dir, prefix, **expected):
+    """Load the manifests of all the shards of a run from out_dir, ordered by shard.
+
+    Raises ValueError if there are none, if they disagree on the number of shards or on shard_by, if any shard is
+    missing, or if any of them differs from expected (e.g. was run on another map).
+    """
+
+    manifests = []
+
+    for manifest_fpath in sorted(glob(os.path.join(out_dir, "{}_manifest_shard*of*.json".format(prefix)))):
+        with open(manifest_fpath) as manifest_file:
+            manifests.append(json.load(manifest_file))
+
+    if not manifests:
+        raise ValueError("No {} shard manifests found in {}".format(prefix, out_dir))
+
+    counts = set(manifest['count'] for manifest in manifests)
+    shard_bys = set(manifest['shard_by'] for manifest in manifests)
+
+    if len(counts) > 1:
+        raise ValueError("The shard manifests in {} come from runs with different numbers of shards ({})".format(
+            out_dir, ", ".join("{}".format(count) for count in sorted(counts))))
+
+    if len(shard_bys) > 1:
+        raise ValueError("The shard manifests in {} come from runs sharded by {}".format(
+            out_dir, " and ".join(sorted(shard_bys))))
+
+    count = counts.pop()
+    missing = sorted(set(range(count)) - set(manifest['shard'] for manifest in manifests))
+
+    if missing:
+        raise ValueError("Missing the manifests of shards {} of {} in {}".format(
+            ", ".join("{}".format(index) for index in missing), count, out_dir))
+
+    for manifest in manifests:
+        for field, value in expected.items():
+            if manifest.get(field) != value:
+                raise ValueError("Shard {}/{} was run with {} {}, not {}".format(manifest['shard'], count, field,
+                                                                                 manifest.get(field), value))
+
+    return sorted(manifests, key=lambda manifest: manifest['shard'])
+
+
+def get_coverage(manifests, field, expected):
+    """Compare the items listed in field by the manifests of all the shards to the expected ones.
+
+    Returns the expected items no shard listed, and the items listed by more than one shard, both sorted.
+    """
+
+    seen = set()
+    repeated = set()
+
+    for manifest in manifests:
+        for item in manifest.get(field) or []:
+            if item in seen:
+                repeated.add(item)
+            seen.add(item)
+
+    return sorted(set(expected) - seen), sorted(repeated)
+
+
+def get_file_digest(fpath, chunk_size=1024 ** 2):
+    """SHA-256 of the contents of a file, to tell whether all the shards of a run were given the same one."""
+
+    digest = hashlib.sha256()
+
+    with open(fpath, 'rb') as input_file:
+        for chunk in iter(lambda: input_file.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
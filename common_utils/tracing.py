@@ -0,0 +1,82 @@
+from __future__ import division, print_function, unicode_literals
+
+import os
+import json
+import threading
+
+
+class TraceRecorder(object):
+    """Collects spans in the Chrome trace-event format, one track per worker thread.
+
+    The resulting file can be opened in Perfetto (https://ui.perfetto.dev) or chrome://tracing. Timestamps are taken
+    from the same clock used by StageMetrics, and are stored relative to the creation of the recorder.
+    """
+
+    def __init__(self, trace_fpath, origin):
+        self.trace_fpath = os.path.abspath(trace_fpath)
+        self._origin = origin
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._events = []
+        self._seen_threads = set()
+
+    def _to_us(self, clock_value):
+        return (clock_value - self._origin) * 1e6
+
+    def _register_thread(self):
+
+        thread = threading.current_thread()
+        tid = thread.ident
+
+        if tid not in self._seen_threads:
+            self._seen_threads.add(tid)
+            self._events.append({
+                'name': 'thread_name',
+                'ph': 'M',
+                'pid': self._pid,
+                'tid': tid,
+                'args': {'name': thread.name}
+            })
+
+        return tid
+
+    def span(self, name, start, end, cat='stage', args=None):
+
+        with self._lock:
+
+            event = {
+                'name': name,
+                'cat': cat,
+                'ph': 'X',
+                'ts': self._to_us(start),
+                'dur': max(0.0, (end - start) * 1e6),
+                'pid': self._pid,
+                'tid': self._register_thread(),
+            }
+
+            if args:
+                event['args'] = args
+
+            self._events.append(event)
+
+    def counter(self, name, when, values):
+
+        with self._lock:
+            self._events.append({
+                'name': name,
+                'ph': 'C',
+                'ts': self._to_us(when),
+                'pid': self._pid,
+                'tid': self._register_thread(),
+                'args': values
+            })
+
+    def write(self):
+
+        with self._lock:
+            events = list(self._events)
+
+        with open(self.trace_fpath, 'w') as trace_file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file)
+
+        return self.trace_fpath
@@ -1,6 +1,7 @@
 from __future__ import print_function, unicode_literals
 
 import os
+import re
 import errno
 import multiprocessing
 import logging
@@ -18,6 +19,47 @@ def get_cpu_count():
     return multiprocessing.cpu_count()
 
 
+def _read_meminfo(field):
+
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith("{}:".format(field)):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+
+    return None
+
+
+def get_available_memory():
+    """Memory available to new processes in bytes, or None if it cannot be told."""
+
+    available = _read_meminfo('MemAvailable')
+
+    if available is not None:
+        return available
+
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def get_total_memory():
+    """Physical memory in bytes, or None if it cannot be told."""
+
+    total = _read_meminfo('MemTotal')
+
+    if total is not None:
+        return total
+
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
 def init_log(log_fpath=None, log_name=None, debug=False):
 
     if log_name:
@@ -142,6 +184,17 @@ def validate_dicom_tags(dicom_tags, log=None):
         raise Exception(err_msg)
 
 
+# Scanner presets shipped with the package, usable as --config
+CONFIG_PRESETS = ['3Ta', '3Tb', '3Tc', '3Td']
+
+# Value of --config that picks the preset of each series from the scanner that acquired it
+AUTO_CONFIG = 'auto'
+
+# Presets recognized from the station name of a scan, when no station map says otherwise
+STATION_PRESETS = [(re.compile(r"3\s*t\s*{}(?![a-z])".format(preset[-1]), re.IGNORECASE), preset)
+                   for preset in CONFIG_PRESETS]
+
+
 def get_config(custom_config=None):
 
     avail_config = False
@@ -0,0 +1,329 @@
+from __future__ import print_function, unicode_literals
+
+import os
+import json
+import errno
+import socket
+import threading
+
+from shutil import rmtree
+
+
+# Seconds after its last heartbeat at which the lease of a task is considered abandoned (e.g. its node died), and
+# the task is given to the next worker that asks for one
+DEFAULT_LEASE_TIMEOUT = 300.0
+
+# Seconds between the heartbeats of the leases held by a worker, well within the lease timeout
+DEFAULT_HEARTBEAT = 30.0
+
+# Seconds a worker waits between looks at the queue while all the tasks left are leased to other workers
+DEFAULT_POLL_INTERVAL = 10.0
+
+
+def get_worker_id():
+    """Name of this worker in the queue: its host and process id."""
+    return "{}-{}".format(socket.gethostname(), os.getpid())
+
+
+def _write_json(fpath, data):
+
+    # Written aside and renamed, so readers on other nodes never see a partial file
+    tmp_fpath = "{}.tmp-{}".format(fpath, get_worker_id())
+
+    with open(tmp_fpath, 'w') as json_file:
+        json.dump(data, json_file, sort_keys=True, default=str)
+
+    os.rename(tmp_fpath, fpath)
+
+
+def _read_json(fpath):
+
+    try:
+        with open(fpath) as json_file:
+            return json.load(json_file)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class Lease(object):
+    """A task claimed from a FileWorkQueue by a worker."""
+
+    def __init__(self, task_id, task, attempt):
+        self.task_id = task_id
+        self.task = task
+        # Number of times the task was claimed, including this one. Above 1, an earlier worker died while holding it,
+        # and may have left partial outputs behind
+        self.attempt = attempt
+
+
+class FileWorkQueue(object):
+    """Work queue shared by any number of workers, on any number of nodes, through a directory of a shared file
+    system. No server is needed.
+
+    The tasks are written once, by the first worker to populate the queue, as one file each in tasks/, named so they
+    sort in the order they should be claimed in. A worker claims a task by creating its lease file in leases/ with
+    O_EXCL, which only one worker can do, and records it as done in done/. While a worker holds leases, a background
+    thread refreshes their modification time every heartbeat seconds. A lease not refreshed for lease_timeout seconds
+    was abandoned: the first worker to rename it away (an atomic operation, so only one can) may claim the task again.
+    Ages are measured against the clock of the file server, by touching a file of the worker in clock/, so the clocks
+    of the nodes do not need to agree.
+    """
+
+    def __init__(self, queue_dir, worker_id=None, lease_timeout=DEFAULT_LEASE_TIMEOUT, heartbeat=DEFAULT_HEARTBEAT,
+                 log=None):
+
+        self.queue_dir = os.path.abspath(queue_dir)
+        self.worker_id = worker_id or get_worker_id()
+        self.lease_timeout = lease_timeout
+        self.heartbeat = heartbeat
+        self.log = log
+
+        self.tasks_dir = os.path.join(self.queue_dir, 'tasks')
+        self.leases_dir = os.path.join(self.queue_dir, 'leases')
+        self.done_dir = os.path.join(self.queue_dir, 'done')
+        self.clock_dir = os.path.join(self.queue_dir, 'clock')
+
+        for queue_subdir in (self.queue_dir, self.leases_dir, self.done_dir, self.clock_dir):
+            try:
+                os.makedirs(queue_subdir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        self._clock_fpath = os.path.join(self.clock_dir, self.worker_id)
+        self._held = set()
+        self._lost = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def populate(self, tasks):
+        """Add tasks, a list of JSON-serializable dictionaries, in the order they should be claimed in, unless another
+        worker populated the queue already. Returns True if this worker did."""
+
+        if os.path.isdir(self.tasks_dir):
+            return False
+
+        tmp_dir = "{}.tmp-{}".format(self.tasks_dir, self.worker_id)
+
+        if os.path.isdir(tmp_dir):
+            rmtree(tmp_dir)
+
+        os.makedirs(tmp_dir)
+
+        width = len("{}".format(len(tasks)))
+
+        for idx, task in enumerate(tasks):
+            _write_json(os.path.join(tmp_dir, "{}.json".format("{}".format(idx).rjust(width, '0'))), task)
+
+        # Renaming a directory onto a non-empty one fails, so the tasks of only one worker are ever used
+        try:
+            os.rename(tmp_dir, self.tasks_dir)
+        except OSError:
+            rmtree(tmp_dir)
+            return False
+
+        return True
+
+    def _task_ids(self):
+
+        try:
+            return sorted(os.path.splitext(name)[0] for name in os.listdir(self.tasks_dir) if name.endswith(".json"))
+        except OSError:
+            return []
+
+    def _done_ids(self):
+        return set(os.path.splitext(name)[0] for name in os.listdir(self.done_dir) if name.endswith(".json"))
+
+    def _lease_fpath(self, task_id):
+        return os.path.join(self.leases_dir, "{}.lease".format(task_id))
+
+    def _owns(self, task_id):
+        """Whether the lease of task_id is still held by this worker, rather than expired, and maybe claimed again by
+        another worker."""
+
+        owner = _read_json(self._lease_fpath(task_id)) or {}
+
+        return owner.get('worker') == self.worker_id
+
+    def _fs_now(self):
+        """Current time on the clock of the file server."""
+
+        with open(self._clock_fpath, 'a'):
+            pass
+
+        os.utime(self._clock_fpath, None)
+
+        return os.stat(self._clock_fpath).st_mtime
+
+    def _expire(self, task_id, now):
+        """Rename the lease of task_id away if it is abandoned. Returns True if this worker did."""
+
+        lease_fpath = self._lease_fpath(task_id)
+
+        try:
+            if now - os.stat(lease_fpath).st_mtime < self.lease_timeout:
+                return False
+        except OSError:
+            return False
+
+        expired_fpath = "{}.expired-{}-{}".format(lease_fpath, self.worker_id, int(now))
+
+        try:
+            os.rename(lease_fpath, expired_fpath)
+        except OSError:
+            return False
+
+        owner = _read_json(expired_fpath) or {}
+
+        if self.log:
+            self.log.warning("The lease of task {} held by {} expired, it will be claimed again".format(
+                task_id, owner.get('worker')))
+
+        return True
+
+    def _attempts(self, task_id):
+        prefix = "{}.lease.expired-".format(task_id)
+        return sum(1 for name in os.listdir(self.leases_dir) if name.startswith(prefix))
+
+    def claim(self):
+        """Claim the first task neither done nor leased (or whose lease expired). Returns its Lease, or None if there
+        is no such task right now."""
+
+        done = self._done_ids()
+        now = None
+
+        for task_id in self._task_ids():
+
+            if task_id in done:
+                continue
+
+            lease_fpath = self._lease_fpath(task_id)
+
+            if os.path.exists(lease_fpath):
+
+                now = now if now is not None else self._fs_now()
+
+                if not self._expire(task_id, now):
+                    continue
+
+            try:
+                fd = os.open(lease_fpath, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError as e:
+                if e.errno == errno.EEXIST:
+                    continue
+                raise
+
+            attempt = self._attempts(task_id) + 1
+
+            with os.fdopen(fd, 'w') as lease_file:
+                json.dump({'worker': self.worker_id, 'attempt': attempt}, lease_file)
+
+            # It may have been completed between the listing of done/ and the lease
+            if os.path.exists(os.path.join(self.done_dir, "{}.json".format(task_id))):
+                os.remove(lease_fpath)
+                continue
+
+            with self._lock:
+                self._held.add(task_id)
+
+            self._start_heartbeat()
+
+            return Lease(task_id, _read_json(os.path.join(self.tasks_dir, "{}.json".format(task_id))), attempt)
+
+        return None
+
+    def lost(self, lease):
+        """Whether the lease was lost, e.g. it expired while this worker was stalled, so the task is not this worker's
+        any more and should not be worked on further."""
+
+        with self._lock:
+            if lease.task_id in self._lost:
+                return True
+
+        return not self._owns(lease.task_id)
+
+    def complete(self, lease, **result):
+        """Record the task of lease as done, with result, and give up its lease. Returns False, recording nothing, if
+        the lease was lost: the task belongs to the worker that claimed it again."""
+
+        with self._lock:
+            self._held.discard(lease.task_id)
+            self._lost.discard(lease.task_id)
+
+        if not self._owns(lease.task_id):
+            if self.log:
+                self.log.warning("Lost the lease of task {}, leaving it to its new owner".format(lease.task_id))
+            return False
+
+        _write_json(os.path.join(self.done_dir, "{}.json".format(lease.task_id)),
+                    dict(result, worker=self.worker_id, attempt=lease.attempt))
+
+        try:
+            os.remove(self._lease_fpath(lease.task_id))
+        except OSError:
+            pass
+
+        return True
+
+    def pending(self):
+        """Number of tasks not done yet, leased or not."""
+        return len(set(self._task_ids()) - self._done_ids())
+
+    def results(self):
+        """Results recorded for the tasks done so far, by task id."""
+        return dict((task_id, _read_json(os.path.join(self.done_dir, "{}.json".format(task_id))))
+                    for task_id in sorted(self._done_ids()))
+
+    def tasks(self):
+        """All the tasks of the queue, by task id."""
+        return dict((task_id, _read_json(os.path.join(self.tasks_dir, "{}.json".format(task_id))))
+                    for task_id in self._task_ids())
+
+    def _start_heartbeat(self):
+
+        if self._thread is not None:
+            return
+
+        self._thread = threading.Thread(target=self._run_heartbeat, name="queue_heartbeat")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run_heartbeat(self):
+
+        while not self._stop.wait(self.heartbeat):
+
+            with self._lock:
+                held = list(self._held)
+
+            for task_id in held:
+
+                # A lease that expired is not refreshed, as it may be another worker's by now
+                if self._owns(task_id):
+                    try:
+                        os.utime(self._lease_fpath(task_id), None)
+                        continue
+                    except OSError:
+                        pass
+
+                with self._lock:
+                    self._held.discard(task_id)
+                    self._lost.add(task_id)
+
+                if self.log:
+                    self.log.warning("Lost the lease of task {}, its remaining rows will not be converted by this "
+                                     "worker".format(task_id))
+
+    def close(self):
+        """Stop the heartbeats. The leases still held (e.g. after an error) expire, and are claimed again."""
+
+        self._stop.set()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        try:
+            os.remove(self._clock_fpath)
+        except OSError:
+            pass
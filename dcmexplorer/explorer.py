@@ -5,15 +5,55 @@ import argparse
 import json
 import pandas as pd
 
-from common_utils.utils import init_log, log_shutdown, get_cpu_count, get_datetime, validate_dicom_tags, get_config
+from common_utils.utils import init_log, log_shutdown, get_datetime, validate_dicom_tags, get_config
+from common_utils.metrics import StageMetrics, NULL_METRICS
+from common_utils.profiling import StageProfiler
+from common_utils.discovery import iter_uncompressed_series
+from common_utils.concurrency import get_executor, get_max_workers, parse_nthreads, AUTO_THREADS
 from glob import glob
-from concurrent.futures import ThreadPoolExecutor, wait
+from collections import deque
+from concurrent.futures import wait
 from itertools import repeat
 from dcmexplorer.utils import get_sample_dicoms, extract_compressed_dicom_metadata, \
                               extract_uncompressed_dicom_metadata
+from dcmexplorer.writers import MetadataWriter, METADATA_FORMATS, DEFAULT_ROW_GROUP_SIZE
 
 
-def explore_dicoms(dicom_dir, out_dir, dicom_tags, nthreads, log):
+def _collect_metadata(futures, nthreads, store, metrics):
+    """Pass the metadata of each parsed series to store in submission order, submitting new series only as the
+    oldest ones finish, so at most a few series per thread are held in memory at any time."""
+
+    pending = deque()
+
+    def store_oldest():
+
+        future = pending.popleft()
+
+        with metrics.waiting('header_parsing'):
+            failed = future.exception()
+
+        if not failed:
+            store(future.result())
+
+    for future in futures:
+
+        pending.append(future)
+
+        if len(pending) >= 4 * get_max_workers(nthreads, io_bound=True):
+            store_oldest()
+
+    while pending:
+        store_oldest()
+
+
+def explore_dicoms(dicom_dir, out_dir, dicom_tags, nthreads, log, metrics=None, writer=None):
+    """Collect the DICOM_TAGS metadata of every Oxygen/Gold series in dicom_dir.
+
+    Returns the metadata as a DataFrame, or None if no series were found. If a MetadataWriter is given, the rows are
+    written to it as they are parsed instead, and None is returned.
+    """
+
+    metrics = metrics if metrics is not None else NULL_METRICS
 
     created_log = False
 
@@ -23,6 +63,7 @@ def explore_dicoms(dicom_dir, out_dir, dicom_tags, nthreads, log):
         created_log = True
 
     metadata_list = []
+    store = writer.write if writer else metadata_list.append
 
     # Collect tgz files in dcm_dir
     log.info("Collecting compressed Oxygen/Gold files...")
@@ -33,10 +74,11 @@ def explore_dicoms(dicom_dir, out_dir, dicom_tags, nthreads, log):
     futures = []
 
     log.info("Scanning compressed files for unique scan series...")
-    with ThreadPoolExecutor(max_workers=nthreads) as executor:
+    with get_executor(nthreads, 'archive_listing', metrics, io_bound=True) as executor:
         for tgz_file in tgz_files:
-            futures.append(executor.submit(get_sample_dicoms, tgz_file, log))
-        wait(futures)
+            futures.append(metrics.submit(executor, 'archive_listing', get_sample_dicoms, tgz_file, log, metrics))
+        with metrics.waiting('archive_listing'):
+            wait(futures)
 
     compressed_dicoms = {}
     unique_series_count = 0
@@ -57,45 +99,24 @@ def explore_dicoms(dicom_dir, out_dir, dicom_tags, nthreads, log):
                 exec_filelist.extend(zip(repeat(tgz_file), dicoms))
 
         log.info("Extracting metadata from scan series...")
-        futures = []
-        with ThreadPoolExecutor(max_workers=nthreads) as executor:
-            for exec_pair in exec_filelist:
-                tgz_file, dcm_file = exec_pair
-                futures.append(executor.submit(extract_compressed_dicom_metadata, tgz_file, dcm_file, dicom_tags, log))
-            wait(futures)
-
-        for future in futures:
-            if not future.exception():
-                metadata_list.append(future.result())
+        with get_executor(nthreads, 'header_parsing', metrics, io_bound=True) as executor:
+            futures = (metrics.submit(executor, 'header_parsing', extract_compressed_dicom_metadata, tgz_file,
+                                      dcm_file, dicom_tags, log, metrics) for tgz_file, dcm_file in exec_filelist)
+            _collect_metadata(futures, nthreads, store, metrics)
 
     # Collect uncompressed files in dicom_dir
     log.info("Collecting unique Dicom files from uncompressed Oxygen/Gold scan directories...")
 
-    dcm_files = glob(os.path.join(dicom_dir, "*/*/*/*.dcm"))
-
-    seen_dirs = []
-    scans_list = []
-
-    for res in dcm_files:
-        curr_dcm = res.strip()
-        curr_dir = os.path.dirname(curr_dcm)
-        if curr_dir not in seen_dirs:
-            scans_list.append(curr_dcm)
-            seen_dirs.append(curr_dir)
+    scans_list = [dcm_file for dcm_file, _, _ in iter_uncompressed_series(dicom_dir, nthreads, metrics)]
 
     log.info("Found {} unique scan series.".format(len(scans_list)))
 
     if scans_list:
         log.info("Extracting metadata from scan series...")
-        futures = []
-        with ThreadPoolExecutor(max_workers=nthreads) as executor:
-            for dcm_file in scans_list:
-                futures.append(executor.submit(extract_uncompressed_dicom_metadata, dcm_file, dicom_tags, log))
-            wait(futures)
-
-        for future in futures:
-            if not future.exception():
-                metadata_list.append(future.result())
+        with get_executor(nthreads, 'header_parsing', metrics, io_bound=True) as executor:
+            futures = (metrics.submit(executor, 'header_parsing', extract_uncompressed_dicom_metadata, dcm_file,
+                                      dicom_tags, log, metrics) for dcm_file in scans_list)
+            _collect_metadata(futures, nthreads, store, metrics)
 
     if metadata_list:
         metadata = pd.DataFrame(metadata_list, columns=metadata_list[0].keys())
@@ -132,8 +153,46 @@ def main():
 
     parser.add_argument(
         "--nthreads",
-        help="number of threads to use when running this script. Use 0 for sequential run.",
-        default=get_cpu_count(),
+        help="number of threads to use when running this script. Use 1 for sequential run, or {} (the default) to "
+             "adapt the number of threads of each stage to the throughput it achieves ({}:<max threads> to bound "
+             "it)".format(AUTO_THREADS, AUTO_THREADS),
+        default=AUTO_THREADS,
+        type=parse_nthreads
+    )
+
+    parser.add_argument(
+        "--trace",
+        help="Write a Chrome trace-event timeline of worker activity to this file (viewable in Perfetto)",
+        default=None
+    )
+
+    parser.add_argument(
+        "--profile",
+        help="Profile CPU (cProfile) and memory (tracemalloc) usage of every stage, and store the results in a "
+             "dcmexplorer_profile_<timestamp> directory inside the output directory",
+        action='store_true',
+        default=False
+    )
+
+    parser.add_argument(
+        "--format",
+        help="Format of the metadata table. parquet and feather (which require pyarrow) store typed columns: dates, "
+             "times, numbers, and lists for multi-valued tags.",
+        choices=METADATA_FORMATS,
+        default='csv'
+    )
+
+    parser.add_argument(
+        "--partition_by",
+        help="Split the metadata table into a metadata_<timestamp> directory of Hive-style partitions on this "
+             "DICOM tag, e.g. station_name. Date tags such as study_date are partitioned by month.",
+        default=None
+    )
+
+    parser.add_argument(
+        "--row_group_size",
+        help="Number of series buffered in memory before they are written out to the metadata table.",
+        default=DEFAULT_ROW_GROUP_SIZE,
         type=int
     )
 
@@ -155,20 +214,57 @@ def main():
 
     settings["nthreads"] = cli_args.nthreads
 
+    settings["format"] = cli_args.format
+
+    settings["partition_by"] = cli_args.partition_by
+
+    settings["row_group_size"] = cli_args.row_group_size
+
+    if settings["partition_by"] and settings["partition_by"] not in settings["config"]["DICOM_TAGS"]:
+        parser.error("--partition_by must be one of the DICOM tags in the config: {}".format(
+            ", ".join(settings["config"]["DICOM_TAGS"].keys())))
+
+    settings["trace"] = os.path.abspath(cli_args.trace) if cli_args.trace else None
+
+    settings["profile"] = os.path.join(settings["out_dir"], "dcmexplorer_profile_{}".format(start_datetime)) \
+        if cli_args.profile else None
+
     # Print the settings
     settings["log"].info(json.dumps({key: settings[key] for key in settings if key != 'log'}, sort_keys=True,
                                     indent=2))
 
-    metadata = explore_dicoms(settings["dicom_dir"], settings["out_dir"], settings["config"]["DICOM_TAGS"],
-                              settings["nthreads"], settings["log"])
+    metrics = StageMetrics('dcmexplorer', trace_fpath=settings["trace"],
+                           profiler=StageProfiler(settings["profile"]) if settings["profile"] else None)
+
+    # Metadata is written out as the series are parsed. A partitioned table gets its own directory.
+    if settings["partition_by"]:
+        out_dir, file_name = os.path.join(settings["out_dir"], "metadata_{}".format(start_datetime)), "metadata"
+    else:
+        out_dir, file_name = settings["out_dir"], "metadata_{}".format(start_datetime)
+
+    try:
+        writer = MetadataWriter(out_dir, file_name, settings["config"]["DICOM_TAGS"], settings["format"],
+                                settings["partition_by"], settings["row_group_size"])
+    except ImportError as e:
+        parser.error(str(e))
+
+    explore_dicoms(settings["dicom_dir"], settings["out_dir"], settings["config"]["DICOM_TAGS"],
+                   settings["nthreads"], settings["log"], metrics, writer)
 
-    if metadata is not None:
-        # Export metadata as CSV file
-        output_file = os.path.join(settings["out_dir"], "metadata_{}.csv".format(start_datetime))
-        metadata.to_csv(output_file, sep=',', na_rep='', index=False)
+    output_files = writer.close()
+
+    if writer.rows_written:
+        settings["log"].info("Metadata of {} series stored in {}".format(
+            writer.rows_written, out_dir if settings["partition_by"] else output_files[0]))
     else:
         settings["log"].warning("No valid Dicom datasets found.")
 
+    if settings["trace"]:
+        settings["log"].info("Trace timeline stored in {}".format(metrics.write_trace()))
+
+    if settings["profile"]:
+        settings["log"].info("CPU and memory profiles stored in {}".format(metrics.write_profile()))
+
     # Shutdown the logs
     log_shutdown(settings["log"])
 
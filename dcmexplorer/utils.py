@@ -1,24 +1,30 @@
 from __future__ import print_function, unicode_literals
 
 import os
-import io
-import dicom
 
 from subprocess import check_output, CalledProcessError, STDOUT
-from collections import OrderedDict
+from common_utils.metrics import NULL_METRICS
+from common_utils.dicom_utils import get_header_tags, read_dicom_header, read_compressed_dicom_header, \
+    get_tag_values, get_dicom_metadata
 
 
-def get_sample_dicoms(tgz_file, log=None):
+def get_sample_dicoms(tgz_file, log=None, metrics=None):
 
-    try:
-        dicom_files = check_output('tar -tf {}'.format(tgz_file.strip()),
-                                   universal_newlines=True, shell=True, stderr=STDOUT)
-    except CalledProcessError:
-        if log:
-            log.warning("Unable to extract Dicom files from {}".format(tgz_file))
-        return tgz_file, []
+    metrics = metrics if metrics is not None else NULL_METRICS
 
-    seen_dirs = []
+    with metrics.stage('archive_listing') as sample:
+
+        try:
+            dicom_files = check_output('tar -tf {}'.format(tgz_file.strip()),
+                                       universal_newlines=True, shell=True, stderr=STDOUT)
+        except CalledProcessError:
+            if log:
+                log.warning("Unable to extract Dicom files from {}".format(tgz_file))
+            return tgz_file, []
+
+        sample.add(bytes_read=os.path.getsize(tgz_file.strip()))
+
+    seen_dirs = set()
     scans_list = []
 
     for res in str(dicom_files).strip().split("\n"):
@@ -26,80 +32,49 @@ def get_sample_dicoms(tgz_file, log=None):
             curr_dir = os.path.dirname(res)
             if curr_dir not in seen_dirs:
                 scans_list.append(res)
-                seen_dirs.append(curr_dir)
+                seen_dirs.add(curr_dir)
 
     return tgz_file, scans_list
 
 
-def extract_compressed_dicom_metadata(tgz_file, dcm_file, dicom_tags, log=None):
-
-    metadata = OrderedDict()
-    metadata["dicom_file"] = dcm_file
-
-    try:
-        dcm_bytes = check_output('tar -O -xf {} {}'.format(tgz_file, dcm_file),
-                                 shell=True, stderr=STDOUT)
-    except CalledProcessError:
-        if log:
-            log.warning("Unable to extract {} from {}".format(dcm_file, tgz_file))
-        raise Exception("Unable to extract {} from {}".format(dcm_file, tgz_file))
-
-    dcm_fobj = io.BytesIO(dcm_bytes)
-
-    curr_dcm = dicom.read_file(dcm_fobj, stop_before_pixels=True)
-
-    for tag in dicom_tags.keys():
-        curr_val = dicom_tags[tag]
-        if type(curr_val) == str:
-            dcm_group, dcm_element = curr_val.split(",")
-            dcm_group = int(dcm_group.strip(), 16)
-            dcm_element = int(dcm_element.strip(), 16)
-            dcm_dat = curr_dcm.get((dcm_group, dcm_element), None)
-            metadata[tag] = dcm_dat.value if dcm_dat else ""
-        elif type(curr_val) == list:
-            metadata[tag] = ""
-            for val in curr_val:
-                dcm_group, dcm_element = val.split(",")
-                dcm_group = int(dcm_group.strip(), 16)
-                dcm_element = int(dcm_element.strip(), 16)
-                dcm_dat = curr_dcm.get((dcm_group, dcm_element), None)
-                if dcm_dat:
-                    metadata[tag] = dcm_dat.value
-                    break
-        else:
-            log.error("Unknown Dicom tag format: {}".format(curr_val))
-            raise Exception("Unknown Dicom tag format: {}".format(curr_val))
+def _get_metadata(dcm_file, curr_dcm, dicom_tags, log=None):
+
+    for curr_val in dicom_tags.values():
 
-    return metadata
-
-
-def extract_uncompressed_dicom_metadata(dcm_file, dicom_tags, log=None):
-
-    metadata = OrderedDict()
-    metadata["dicom_file"] = "/".join(dcm_file.split("/")[-4:])
-
-    curr_dcm = dicom.read_file(dcm_file, stop_before_pixels=True)
-
-    for tag in dicom_tags.keys():
-        curr_val = dicom_tags[tag]
-        if type(curr_val) == str:
-            dcm_group, dcm_element = curr_val.split(",")
-            dcm_group = int(dcm_group.strip(), 16)
-            dcm_element = int(dcm_element.strip(), 16)
-            dcm_dat = curr_dcm.get((dcm_group, dcm_element), None)
-            metadata[tag] = dcm_dat.value if dcm_dat else ""
-        elif type(curr_val) == list:
-            metadata[tag] = ""
-            for val in curr_val:
-                dcm_group, dcm_element = val.split(",")
-                dcm_group = int(dcm_group.strip(), 16)
-                dcm_element = int(dcm_element.strip(), 16)
-                dcm_dat = curr_dcm.get((dcm_group, dcm_element), None)
-                if dcm_dat:
-                    metadata[tag] = dcm_dat.value
-                    break
-        else:
-            log.error("Unknown Dicom tag format: {}".format(curr_val))
+        if not isinstance(curr_val, (list, str)):
+            if log:
+                log.error("Unknown Dicom tag format: {}".format(curr_val))
             raise Exception("Unknown Dicom tag format: {}".format(curr_val))
 
-    return metadata
+    return get_dicom_metadata(dcm_file, get_tag_values(curr_dcm, dicom_tags))
+
+
+def extract_compressed_dicom_metadata(tgz_file, dcm_file, dicom_tags, log=None, metrics=None):
+
+    metrics = metrics if metrics is not None else NULL_METRICS
+
+    with metrics.stage('header_parsing') as sample:
+
+        try:
+            curr_dcm, bytes_read = read_compressed_dicom_header(tgz_file, dcm_file, get_header_tags(dicom_tags))
+        except IOError:
+            if log:
+                log.warning("Unable to extract {} from {}".format(dcm_file, tgz_file))
+            raise Exception("Unable to extract {} from {}".format(dcm_file, tgz_file))
+
+        sample.add(bytes_read=bytes_read)
+
+    return _get_metadata(dcm_file, curr_dcm, dicom_tags, log)
+
+
+def extract_uncompressed_dicom_metadata(dcm_file, dicom_tags, log=None, metrics=None):
+
+    metrics = metrics if metrics is not None else NULL_METRICS
+
+    with metrics.stage('header_parsing') as sample:
+
+        curr_dcm, bytes_read = read_dicom_header(dcm_file, get_header_tags(dicom_tags))
+
+        sample.add(bytes_read=bytes_read)
+
+    return _get_metadata(dcm_file, curr_dcm, dicom_tags, log)
@@ -0,0 +1,270 @@
+from __future__ import print_function, unicode_literals
+
+import os
+import re
+import datetime
+import pandas as pd
+
+from collections import OrderedDict
+from pydicom.datadict import dictionary_VR, dictionary_VM
+from pydicom.multival import MultiValue
+from common_utils.dicom_utils import parse_dicom_hex
+
+try:
+    from urllib.parse import quote
+except ImportError:  # Python 2
+    from urllib import quote
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+METADATA_FORMATS = ['csv', 'parquet', 'feather']
+
+# Rows buffered before they are written out, as one row group per partition
+DEFAULT_ROW_GROUP_SIZE = 10000
+
+# Directory name used for rows without a value in the partition column, the same one Hive and pyarrow use
+NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+
+INTEGER_VRS = ('IS', 'SL', 'SS', 'SV', 'UL', 'US', 'UV')
+
+FLOAT_VRS = ('DS', 'FL', 'FD')
+
+
+def get_tag_vr(hex_strs):
+    """VR of a DICOM_TAGS entry, and whether it is multi-valued, from the first of its tags in the DICOM dictionary.
+
+    Private tags are not in the dictionary and are stored as single-valued strings.
+    """
+
+    for hex_str in (hex_strs if isinstance(hex_strs, list) else [hex_strs]):
+
+        tag = parse_dicom_hex(hex_str)
+
+        try:
+            # Ambiguous VRs are listed as e.g. 'US or SS'
+            return dictionary_VR(tag).split(" or ")[0], dictionary_VM(tag) != "1"
+        except KeyError:
+            continue
+
+    return 'LO', False
+
+
+def _parse_da(value):
+    return datetime.datetime.strptime(value.strip()[:8], "%Y%m%d").date()
+
+
+def _parse_tm(value):
+
+    # TM values are HH, HHMM, HHMMSS or HHMMSS.FFFFFF
+    whole, _, fraction = value.strip().partition(".")
+    curr_time = datetime.datetime.strptime(whole, {2: "%H", 4: "%H%M", 6: "%H%M%S"}[len(whole)]).time()
+
+    return curr_time.replace(microsecond=int(fraction.ljust(6, "0")[:6]) if fraction else 0)
+
+
+def _parse_dt(value):
+
+    # The UTC offset, if any, is dropped
+    value = re.split(r"[+-]", value.strip())[0]
+    curr_time = _parse_tm(value[8:]) if len(value) > 8 else datetime.time()
+
+    return datetime.datetime.combine(_parse_da(value[:8]), curr_time)
+
+
+_PARSERS = {'DA': _parse_da, 'TM': _parse_tm, 'DT': _parse_dt}
+_PARSERS.update((vr, int) for vr in INTEGER_VRS)
+_PARSERS.update((vr, float) for vr in FLOAT_VRS)
+
+
+def _typed_value(value, vr):
+    """Value of a DICOM element as the Python type matching its VR, or None if it is empty or cannot be parsed."""
+
+    if value is None or value == "":
+        return None
+
+    try:
+        return _PARSERS.get(vr, "{}".format)(value)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _typed_column_value(value, vr, multi):
+
+    values = list(value) if isinstance(value, (list, tuple, MultiValue)) else [value]
+
+    if multi:
+        return [_typed_value(curr_val, vr) for curr_val in values] if value not in (None, "") else None
+
+    if len(values) > 1:
+        # Multi-valued data in a tag the dictionary lists as single-valued, keep it as DICOM would store it
+        return "\\".join("{}".format(curr_val) for curr_val in values) if vr not in _PARSERS else None
+
+    return _typed_value(values[0] if values else None, vr)
+
+
+def _arrow_type(vr, multi):
+
+    if vr == 'DA':
+        arrow_type = pa.date32()
+    elif vr == 'TM':
+        arrow_type = pa.time64('us')
+    elif vr == 'DT':
+        arrow_type = pa.timestamp('us')
+    elif vr in INTEGER_VRS:
+        arrow_type = pa.int64()
+    elif vr in FLOAT_VRS:
+        arrow_type = pa.float64()
+    else:
+        arrow_type = pa.string()
+
+    return pa.list_(arrow_type) if multi else arrow_type
+
+
+class MetadataWriter(object):
+    """Write dcmexplorer metadata rows to out_dir as they are produced, instead of collecting them all in memory.
+
+    Rows are buffered and written out every row_group_size rows, as one row group (or CSV chunk) per partition. The
+    parquet and feather formats require pyarrow, and store every column with the type matching the VR of its tag
+    (dates, times, numbers, and lists for multi-valued tags).
+
+    With partition_by, the rows are split into Hive-style <tag>=<value> directories on the value of that DICOM_TAGS
+    entry, and the column is left out of the files as readers restore it from the directory names. Date tags are
+    partitioned by month into <tag>_month=<YYYY-MM> directories instead, and keep their column.
+    """
+
+    def __init__(self, out_dir, file_name, dicom_tags, out_format='csv', partition_by=None,
+                 row_group_size=DEFAULT_ROW_GROUP_SIZE):
+
+        if out_format not in METADATA_FORMATS:
+            raise ValueError("Unknown metadata format {}, use one of {}".format(out_format,
+                                                                                 ", ".join(METADATA_FORMATS)))
+
+        if out_format != 'csv' and pa is None:
+            raise ImportError("pyarrow is required to write metadata in the {} format".format(out_format))
+
+        if partition_by and partition_by not in dicom_tags:
+            raise ValueError("Cannot partition by {}, it is not one of the DICOM_TAGS in the config".format(
+                partition_by))
+
+        self.out_dir = out_dir
+        self.file_name = "{}.{}".format(file_name, out_format)
+        self.out_format = out_format
+        self.partition_by = partition_by
+        self.row_group_size = row_group_size
+        self.rows_written = 0
+
+        self._vrs = OrderedDict([('dicom_file', ('LO', False))])
+        self._vrs.update((tag, get_tag_vr(hex_strs)) for tag, hex_strs in dicom_tags.items())
+
+        self._by_month = bool(partition_by) and self._vrs[partition_by][0] in ('DA', 'DT')
+
+        self._columns = [column for column in self._vrs
+                         if not partition_by or self._by_month or column != partition_by]
+
+        self._schema = pa.schema([pa.field(column, _arrow_type(*self._vrs[column]))
+                                  for column in self._columns]) if out_format != 'csv' else None
+
+        self._buffers = OrderedDict()
+        self._buffered = 0
+        self._files = OrderedDict()
+
+    def _get_partition(self, metadata):
+
+        if not self.partition_by:
+            return None
+
+        value = metadata[self.partition_by]
+
+        if self._by_month:
+            value = _typed_value(value, 'DA')
+            return "{}_month={}".format(self.partition_by, value.strftime("%Y-%m") if value else NULL_PARTITION)
+
+        value = "{}".format(value).strip() if value not in (None, "") else ""
+
+        # Readers of Hive-style datasets URI-decode the directory names, so any value can be stored losslessly
+        return "{}={}".format(self.partition_by, quote(value, safe="") if value else NULL_PARTITION)
+
+    def write(self, metadata):
+        """Add the metadata row of one series, writing out the buffered rows once there are row_group_size of them."""
+
+        self._buffers.setdefault(self._get_partition(metadata), []).append(metadata)
+        self._buffered += 1
+
+        if self._buffered >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+
+        for partition, rows in self._buffers.items():
+            self._write_rows(partition, rows)
+            self.rows_written += len(rows)
+
+        self._buffers = OrderedDict()
+        self._buffered = 0
+
+    def _get_file(self, partition):
+
+        if partition in self._files:
+            return self._files[partition]
+
+        out_dir = os.path.join(self.out_dir, partition) if partition else self.out_dir
+
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+
+        out_fpath = os.path.join(out_dir, self.file_name)
+
+        if self.out_format == 'parquet':
+            out_file = pq.ParquetWriter(out_fpath, self._schema)
+        elif self.out_format == 'feather':
+            # Feather (V2) files are Arrow IPC files
+            out_sink = pa.OSFile(out_fpath, 'wb')
+            out_file = (out_sink, pa.ipc.new_file(out_sink, self._schema))
+        else:
+            out_file = None
+
+        self._files[partition] = (out_fpath, out_file)
+
+        return self._files[partition]
+
+    def _write_rows(self, partition, rows):
+
+        out_fpath, out_file = self._get_file(partition)
+
+        if self.out_format == 'csv':
+            pd.DataFrame(rows, columns=self._columns).to_csv(out_fpath, sep=',', na_rep='', index=False, mode='a',
+                                                             header=not os.path.isfile(out_fpath))
+            return
+
+        table = pa.Table.from_pydict(
+            OrderedDict((column, [_typed_column_value(row[column], *self._vrs[column]) for row in rows])
+                        for column in self._columns),
+            schema=self._schema
+        )
+
+        if self.out_format == 'parquet':
+            out_file.write_table(table)
+        else:
+            out_file[1].write_table(table)
+
+    def close(self):
+        """Write out the remaining rows and close every file. Returns the paths of the files written."""
+
+        self.flush()
+
+        for partition, (out_fpath, out_file) in self._files.items():
+
+            if self.out_format == 'parquet':
+                out_file.close()
+            elif self.out_format == 'feather':
+                out_file[1].close()
+                out_file[0].close()
+
+            self._files[partition] = (out_fpath, None)
+
+        return [out_fpath for out_fpath, _ in self._files.values()]
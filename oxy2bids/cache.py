@@ -0,0 +1,525 @@
+from __future__ import print_function, unicode_literals
+
+import os
+import json
+import shutil
+import hashlib
+import threading
+
+from collections import OrderedDict
+from subprocess import CalledProcessError, check_output, STDOUT
+from common_utils.discovery import get_series_size
+from common_utils.metrics import NULL_METRICS, get_dir_size
+from common_utils.utils import get_datetime
+
+
+# Bumped whenever the layout of the cache entries, or what goes into their keys, changes
+CACHE_VERSION = 1
+
+DEFAULT_CACHE_SIZE_GB = 50
+
+DEFAULT_SCRATCH_SIZE_GB = 20
+
+# Conversion products kept in the cache, by extension
+CACHED_EXTENSIONS = ['.nii.gz', '.json', '.bval', '.bvec']
+
+LINK_MODES = ['auto', 'reflink', 'hardlink', 'copy']
+
+MANIFEST_NAME = "entry.json"
+
+
+def get_tool_version(conversion_tool):
+    """Version string printed by the conversion tool, e.g. 'v1.0.20211006', or '' if it cannot be found."""
+
+    try:
+        output = check_output([conversion_tool, "-v"], stderr=STDOUT, universal_newlines=True)
+    except CalledProcessError as e:
+        # dcm2niix exits with a non-zero status after printing its version
+        output = e.output or ""
+    except OSError:
+        return ""
+
+    for line in output.split("\n"):
+        if "version" in line.lower():
+            return line.strip()
+
+    return output.strip().split("\n")[0] if output.strip() else ""
+
+
+def _get_int(value):
+
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def get_series_identity(row, dicom_dir, compressed):
+    """Identity of the source series of a row of the map, for use in a ConversionCache key.
+
+    Series mapped by bidsmapper are identified by their Series Instance UID and size, wherever they are stored, so
+    the copies of a series share their cache entries. Rows without a series_uid (e.g. maps from older versions) are
+    identified by their source path, size and modification time instead.
+    """
+
+    if row.get('series_uid'):
+        return OrderedDict([
+            ('series_uid', row['series_uid']),
+            ('n_instances', _get_int(row.get('n_instances'))),
+            ('series_bytes', _get_int(row.get('series_bytes'))),
+        ])
+
+    scan_dir = row['scan_dir']
+
+    if compressed:
+        scan_subject, scan_session, _ = scan_dir.strip().split("/")
+        source = os.path.join(dicom_dir, "{}-{}-DICOM.tgz".format(scan_subject, scan_session))
+        source_stat = os.stat(source)
+        n_instances, series_bytes = None, source_stat.st_size
+    else:
+        source = os.path.join(dicom_dir, scan_dir)
+        source_stat = os.stat(source)
+        n_instances, series_bytes = get_series_size(source)
+
+    return OrderedDict([
+        ('source', os.path.abspath(source)),
+        ('scan_dir', scan_dir),
+        ('mtime', int(source_stat.st_mtime)),
+        ('n_instances', n_instances),
+        ('series_bytes', series_bytes),
+    ])
+
+
+def _reflink(src_fpath, dst_fpath):
+
+    # Copy-on-write clone, on file systems that support it (btrfs, XFS, APFS...)
+    check_output(["cp", "--reflink=always", src_fpath, dst_fpath], stderr=STDOUT)
+
+
+class ConversionCache(object):
+    """Local content-addressed store of the files produced by converting DICOM series.
+
+    Entries are keyed by the identity of the source series (see get_series_identity) and the version and flags of
+    the conversion tool, so the cache stays valid when the map is edited and rows are renamed, and misses whenever
+    the tool or its options change. The cache is bounded to max_bytes, the least recently used entries are evicted
+    first.
+
+    Files are placed in and out of the cache as reflinks when the file system supports them, or else hardlinks, or
+    else copies (link_mode 'auto'). JSON sidecars are always copied, as they are often edited in place after the
+    conversion, which would otherwise also change the cached file. Instances can be shared between threads, and
+    several processes, on one or more nodes, can share a cache directory: an entry missing from the index of a
+    process, built when it starts, is looked for on disk before it is reported as a miss. The size bound and the LRU
+    order are only kept by each process over the entries it knows of (those indexed at start, or stored or fetched
+    since), so processes sharing a cache may together exceed max_bytes until one of them starts again.
+    """
+
+    def __init__(self, cache_dir, max_bytes, link_mode='auto', log=None, metrics=None):
+
+        if link_mode not in LINK_MODES:
+            raise ValueError("Unknown link mode {}, use one of {}".format(link_mode, ", ".join(LINK_MODES)))
+
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.link_mode = link_mode
+        self.log = log
+        self.metrics = metrics if metrics is not None else NULL_METRICS
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._tool_versions = {}
+
+        # Cleared the first time a reflink fails, so file systems without them are not probed for every file
+        self._reflinks = link_mode in ('auto', 'reflink')
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        # Entries from least to most recently used, with their size in bytes
+        self._entries = OrderedDict()
+
+        found = []
+
+        for prefix in os.listdir(self.cache_dir):
+
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+
+            if len(prefix) != 2 or not os.path.isdir(prefix_dir):
+                continue
+
+            for key in os.listdir(prefix_dir):
+
+                manifest_fpath = os.path.join(prefix_dir, key, MANIFEST_NAME)
+
+                if os.path.isfile(manifest_fpath):
+                    found.append((os.path.getmtime(manifest_fpath), key, get_dir_size(os.path.join(prefix_dir, key))))
+
+        for _, key, entry_bytes in sorted(found):
+            self._entries[key] = entry_bytes
+
+        # In case max_bytes was lowered since the last run
+        self.evict()
+
+    @property
+    def size(self):
+        return sum(self._entries.values())
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get_key(self, series, conversion_tool, flags):
+        """Key of the conversion of a series (see get_series_identity) with a given tool and command line flags."""
+
+        if conversion_tool not in self._tool_versions:
+            self._tool_versions[conversion_tool] = get_tool_version(conversion_tool)
+
+        key_data = OrderedDict([
+            ('cache_version', CACHE_VERSION),
+            ('series', series),
+            ('tool', conversion_tool),
+            ('tool_version', self._tool_versions[conversion_tool]),
+            ('flags', list(flags)),
+        ])
+
+        return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _place(self, src_fpath, dst_fpath):
+        """Reflink, hardlink or copy src_fpath to dst_fpath, following the link mode."""
+
+        if os.path.lexists(dst_fpath):
+            os.remove(dst_fpath)
+
+        if self._reflinks:
+            try:
+                return _reflink(src_fpath, dst_fpath)
+            except (CalledProcessError, OSError):
+                self._reflinks = False
+
+        if self.link_mode in ('auto', 'hardlink') and not src_fpath.endswith(".json"):
+            try:
+                return os.link(src_fpath, dst_fpath)
+            except OSError:
+                pass
+
+        shutil.copy2(src_fpath, dst_fpath)
+
+    def fetch(self, key, out_dir, out_name, extensions=None):
+        """Place the cached products of key in out_dir as <out_name><extension>.
+
+        Only the given extensions (default: all of CACHED_EXTENSIONS) are placed. Returns the list of paths placed,
+        or None on a cache miss.
+        """
+
+        entry_dir = self._entry_dir(key)
+
+        with self._lock:
+            hit = key in self._entries
+
+        # Stored by another process sharing the cache since this one indexed it
+        if not hit and os.path.isfile(os.path.join(entry_dir, MANIFEST_NAME)):
+            entry_bytes = get_dir_size(entry_dir)
+            with self._lock:
+                self._entries.setdefault(key, entry_bytes)
+            hit = True
+
+        if not hit:
+            with self._lock:
+                self.misses += 1
+            self.metrics.incr('conversion_cache_misses')
+            return None
+
+        placed = []
+
+        with self.metrics.stage('cache_fetch') as sample:
+
+            try:
+
+                with open(os.path.join(entry_dir, MANIFEST_NAME)) as manifest_file:
+                    manifest = json.load(manifest_file)
+
+                for extension in manifest['extensions']:
+
+                    if extensions is not None and extension not in extensions:
+                        continue
+
+                    out_fpath = os.path.join(out_dir, "{}{}".format(out_name, extension))
+                    self._place(os.path.join(entry_dir, "series{}".format(extension)), out_fpath)
+                    placed.append(out_fpath)
+
+                # The modification time of the manifest records the last use, for eviction across runs
+                os.utime(os.path.join(entry_dir, MANIFEST_NAME), None)
+
+            except (IOError, OSError, ValueError, KeyError):
+
+                # Evicted by another process sharing the cache, or incomplete. Convert the series again
+                for out_fpath in placed:
+                    os.remove(out_fpath)
+
+                with self._lock:
+                    self._entries.pop(key, None)
+                    self.misses += 1
+
+                self.metrics.incr('conversion_cache_misses')
+                return None
+
+            sample.add(items=len(placed), bytes_written=sum(os.path.getsize(out_fpath) for out_fpath in placed))
+
+        with self._lock:
+            if key in self._entries:
+                self._entries[key] = self._entries.pop(key)
+            self.hits += 1
+
+        self.metrics.incr('conversion_cache_hits')
+
+        return placed
+
+    def store(self, key, src_dir, src_name, series=None):
+        """Add the conversion products <src_name><extension> found in src_dir to the cache under key."""
+
+        extensions = [extension for extension in CACHED_EXTENSIONS
+                      if os.path.isfile(os.path.join(src_dir, "{}{}".format(src_name, extension)))]
+
+        if not extensions:
+            return
+
+        entry_dir = self._entry_dir(key)
+        tmp_dir = "{}.tmp{}-{}".format(entry_dir, os.getpid(), threading.current_thread().ident)
+
+        with self.metrics.stage('cache_store') as sample:
+
+            if os.path.isdir(tmp_dir):
+                shutil.rmtree(tmp_dir)
+
+            os.makedirs(tmp_dir)
+
+            for extension in extensions:
+                self._place(os.path.join(src_dir, "{}{}".format(src_name, extension)),
+                            os.path.join(tmp_dir, "series{}".format(extension)))
+
+            with open(os.path.join(tmp_dir, MANIFEST_NAME), 'w') as manifest_file:
+                json.dump(OrderedDict([('created', get_datetime()), ('series', series),
+                                       ('extensions', extensions)]), manifest_file, indent=2)
+
+            entry_bytes = get_dir_size(tmp_dir)
+
+            try:
+                # Entries appear atomically, so readers never see a partial one
+                os.rename(tmp_dir, entry_dir)
+            except OSError:
+                # Stored concurrently by another worker or process
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                return
+
+            sample.add(items=1, bytes_written=entry_bytes)
+
+        with self._lock:
+            self._entries[key] = entry_bytes
+
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in max_bytes."""
+
+        evicted = []
+
+        with self._lock:
+
+            total_bytes = self.size
+
+            while self._entries and total_bytes > self.max_bytes:
+                key, entry_bytes = self._entries.popitem(last=False)
+                total_bytes -= entry_bytes
+                evicted.append(key)
+
+        self.metrics.set_gauge('conversion_cache_bytes', total_bytes)
+
+        for key in evicted:
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+
+        if evicted:
+            self.metrics.incr('conversion_cache_evictions', len(evicted))
+
+            if self.log:
+                self.log.info("Evicted {} entries from the conversion cache {}.".format(len(evicted), self.cache_dir))
+
+
+class ExtractedSeriesCache(object):
+    """Scratch directory of series extracted from Oxygen/Gold archives, kept for later conversions of the same series.
+
+    Entries are keyed by the identity of the archive (path, size and modification time) and the path of the series
+    in it, so a modified archive is extracted again. The scratch directory is bounded to max_bytes, the least recently
+    used entries are evicted first, except the ones still being converted. Instances can be shared between threads,
+    and the entries are reused by later runs with the same scratch directory, but not by concurrent ones.
+    """
+
+    def __init__(self, scratch_dir, max_bytes, log=None, metrics=None):
+
+        self.scratch_dir = os.path.abspath(scratch_dir)
+        self.max_bytes = max_bytes
+        self.log = log
+        self.metrics = metrics if metrics is not None else NULL_METRICS
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+
+        # Entries from least to most recently used with their size in bytes, the number of conversions using each,
+        # and the extractions in progress
+        self._entries = OrderedDict()
+        self._pins = {}
+        self._extracting = {}
+
+        if not os.path.isdir(self.scratch_dir):
+            os.makedirs(self.scratch_dir)
+
+        found = []
+
+        for key in os.listdir(self.scratch_dir):
+
+            entry_dir = os.path.join(self.scratch_dir, key)
+
+            if ".tmp" in key:
+                # Left behind by an interrupted extraction
+                shutil.rmtree(entry_dir, ignore_errors=True)
+            elif os.path.isdir(entry_dir):
+                found.append((os.path.getmtime(entry_dir), key, get_dir_size(entry_dir)))
+
+        for _, key, entry_bytes in sorted(found):
+            self._entries[key] = entry_bytes
+
+        self.evict()
+
+    @staticmethod
+    def get_key(archive_fpath, member):
+
+        archive_stat = os.stat(archive_fpath)
+        key_data = [os.path.abspath(archive_fpath), archive_stat.st_size, int(archive_stat.st_mtime), member]
+
+        return hashlib.sha1(json.dumps(key_data).encode('utf-8')).hexdigest()
+
+    def acquire(self, archive_fpath, member, local_fpath=None):
+        """Path of the series directory member of archive_fpath, extracted to the scratch directory if not there yet.
+
+        Entries are keyed on archive_fpath, but extracted from local_fpath when given (e.g. a prefetched copy of the
+        archive). Returns (key, path, extracted). The entry is not evicted until release(key) is called. Raises
+        CalledProcessError if tar fails.
+        """
+
+        key = self.get_key(archive_fpath, member)
+        entry_dir = os.path.join(self.scratch_dir, key)
+
+        while True:
+
+            with self._lock:
+
+                if key in self._entries:
+                    self._entries[key] = self._entries.pop(key)
+                    self._pins[key] = self._pins.get(key, 0) + 1
+                    self.hits += 1
+                    hit = True
+                    break
+
+                in_progress = self._extracting.get(key)
+
+                if in_progress is None:
+                    self._extracting[key] = threading.Event()
+                    self._pins[key] = self._pins.get(key, 0) + 1
+                    self.misses += 1
+                    hit = False
+                    break
+
+            # Another thread is extracting the same series, use its result
+            in_progress.wait()
+
+        if hit:
+            os.utime(entry_dir, None)
+            self.metrics.incr('scratch_hits')
+            return key, entry_dir, False
+
+        tmp_dir = "{}.tmp".format(entry_dir)
+
+        try:
+
+            if os.path.isdir(tmp_dir):
+                shutil.rmtree(tmp_dir)
+
+            os.makedirs(tmp_dir)
+
+            check_output(['tar', '-xf', local_fpath or archive_fpath, member], stderr=STDOUT, cwd=tmp_dir)
+
+            # Entries appear atomically, so an interrupted extraction is never mistaken for a complete one
+            os.rename(os.path.join(tmp_dir, member), entry_dir)
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+            entry_bytes = get_dir_size(entry_dir)
+
+        except BaseException:
+
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+            with self._lock:
+                self._release(key)
+                self._extracting.pop(key).set()
+
+            raise
+
+        with self._lock:
+            self._entries[key] = entry_bytes
+            self._extracting.pop(key).set()
+
+        self.metrics.incr('scratch_misses')
+        self.evict()
+
+        return key, entry_dir, True
+
+    def _release(self, key):
+
+        self._pins[key] -= 1
+
+        if not self._pins[key]:
+            del self._pins[key]
+
+    def release(self, key):
+        """Allow the entry of key to be evicted again, once the conversion using it is done."""
+
+        with self._lock:
+            self._release(key)
+
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries not in use until the scratch directory fits in max_bytes."""
+
+        evicted = []
+
+        with self._lock:
+
+            total_bytes = sum(self._entries.values())
+
+            for key in list(self._entries.keys()):
+
+                if total_bytes <= self.max_bytes:
+                    break
+
+                if key in self._pins:
+                    continue
+
+                total_bytes -= self._entries.pop(key)
+
+                # Moved out of the way first, so the series can be extracted again while it is being deleted
+                evicted_dir = os.path.join(self.scratch_dir, "{}.tmp-evicted".format(key))
+
+                try:
+                    os.rename(os.path.join(self.scratch_dir, key), evicted_dir)
+                except OSError:
+                    evicted_dir = os.path.join(self.scratch_dir, key)
+
+                evicted.append(evicted_dir)
+
+        for evicted_dir in evicted:
+            shutil.rmtree(evicted_dir, ignore_errors=True)
+
+        self.metrics.set_gauge('scratch_bytes', total_bytes)
+
+        if evicted:
+            self.metrics.incr('scratch_evictions', len(evicted))
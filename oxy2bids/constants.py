@@ -5,6 +5,33 @@ LOG_MESSAGES = {
                        "generating one.",
     'gen_map_done': "Map generation complete. Results stored in {}",
     'shutdown': "BIDS conversion complete. Results stored in {}",
+    'metrics_done': "Stage metrics stored in {} and {}",
+    'trace_done': "Trace timeline stored in {}",
+    'profile_done': "CPU and memory profiles stored in {}",
+    'cache_stats': "Reused {} series from the conversion cache, converted {} new ones. Cache stored in {}",
+    'estimate_done': "Per row estimates stored in {}",
+    'shard_plan': "Shard {} converts {} rows, from {} of the {} units of work (by {}), an estimated {:.1f} MB of DICOM "
+                  "series, the largest shard {:.1f} MB",
+    'manifest_done': "Manifest of shard {} stored in {}",
+    'shards_overlap': "{} rows were converted by more than one shard: {}",
+    'shards_incomplete': "{} of the {} rows of the map were not converted by any shard. Their map is stored in {}, "
+                         "convert them with --bids_map",
+    'shards_complete': "All {} rows of the map were converted by the {} shards into {}",
+    'queue_claim': "Claimed {} tasks ({} rows) from the work queue as {}",
+    'queue_lost': "The lease of the task of {} was lost, leaving it to the worker that claimed it again",
+    'queue_done': "Work queue {}: {} of {} tasks done ({} failed), {} rows converted by this worker",
+    'watch_start': "Watching {} for new archives and sessions every {} seconds (Ctrl-C to stop)",
+    'watch_ready': "{} is complete, mapping and converting it",
+    'watch_error': "Could not map and convert {}: {}",
+    'watch_done': "{}: {} ({} rows) in {:.1f} seconds",
+    'watch_stop': "Stopped watching {}",
+    'conversion_retry': "Conversion of {} failed (attempt {} of {}), trying again in {:.0f} seconds",
+    'quarantine': "Conversion of {} failed {} times, quarantined it in {}",
+    'quarantine_done': "{} rows kept failing and were quarantined in {}, convert them again with --bids_map once the "
+                       "cause is fixed",
+    'schedule': "Scheduled {} rows largest first, starting with {} ({:.1f} MB)",
+    'scratch_stats': "Reused {} extracted series from the scratch directory, extracted {} new ones. Scratch "
+                     "directory: {}",
     'success_converted':
         'Converted {} to {}\n'
         'Command:\n{}\n'
@@ -15,6 +42,9 @@ LOG_MESSAGES = {
         'Error running dcm2niix on DICOM series in {} directory.\n'
         'Command:\n{}\n'
         'Return Code:\n{}\n\n',
+    'dcm2niix_timeout':
+        'dcm2niix timed out after {:.0f} seconds on DICOM series in {} directory, stopped it.\n'
+        'Command:\n{}\n\n',
     'tar_error':
         'Error extracting tarred file {}.\n'
         'Command:\n{}\n'
@@ -8,21 +8,50 @@ import numpy as np
 import string
 import random
 import struct
+import time
+import heapq
+import itertools
 
 from glob import glob
 from shutil import rmtree
 from collections import OrderedDict
 from oxy2bids.constants import LOG_MESSAGES
+from oxy2bids.cache import CACHED_EXTENSIONS, get_series_identity
+from oxy2bids.scheduling import get_archive_path, schedule_rows
+from oxy2bids.watchdog import ConversionTimeout, RetryConversion
 from biounpacker.biopac_organize import biounpacker
 from common_utils.utils import create_path, init_log, get_cpu_count
+from common_utils.metrics import NULL_METRICS, get_dir_size, get_file_size
 from subprocess import CalledProcessError, check_output, STDOUT
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from common_utils.concurrency import get_executor, get_max_workers
+from common_utils.workqueue import DEFAULT_POLL_INTERVAL
+from concurrent.futures import wait, FIRST_COMPLETED
+
+
+# Options dcm2niix is run with, besides the output file name and the input directory
+DCM2NIIX_FLAGS = ["-z", "y", "-b", "y"]
 
 
 class BIDSConverter(object):
 
-    def __init__(self, conversion_tool='dcm2niix', log=None):
+    def __init__(self, conversion_tool='dcm2niix', log=None, metrics=None, cache=None, scratch=None, prefetcher=None,
+                 schedule=None, watchdog=None):
         self.conversion_tool = conversion_tool
+        self.metrics = metrics if metrics is not None else NULL_METRICS
+        # Optional oxy2bids.cache.ConversionCache, to reuse the products of series converted before
+        self.cache = cache
+        # Optional oxy2bids.cache.ExtractedSeriesCache, to reuse the series extracted from archives before
+        self.scratch = scratch
+        # Optional oxy2bids.prefetch.ArchivePrefetcher, to read the archives from local copies
+        self.prefetcher = prefetcher
+        # Order the rows are converted in, one of oxy2bids.scheduling.SCHEDULES ('map' order if not set)
+        self.schedule = schedule
+        # Optional oxy2bids.watchdog.ConversionWatchdog, to stop, retry, and eventually quarantine hung conversions
+        self.watchdog = watchdog
+        # scan_dir of the rows converted by the last map_to_bids, even if it did not complete
+        self.converted_rows = []
+        # Set by queue_to_bids, tells whether a row should be skipped as the lease of its task was lost
+        self._skip_row = None
         if log:
             self.log = log
             self.use_outside_log = True
@@ -41,12 +70,12 @@ class BIDSConverter(object):
         cols = []
 
         if cardiac_physio:
-            cardio_df = pd.read_csv(cardiac_physio, sep="\n", header=None, names=["cardiac"])
-            physio_df = physio_df.append(cardio_df)
+            cardio_df = pd.read_csv(cardiac_physio, header=None, names=["cardiac"])
+            physio_df = pd.concat([physio_df, cardio_df])
             cols.append("cardiac")
 
         if resp_physio:
-            resp_df = pd.read_csv(resp_physio, sep="\n", header=None, names=["respiratory"])
+            resp_df = pd.read_csv(resp_physio, header=None, names=["respiratory"])
             physio_df = physio_df.join(resp_df)
             cols.append("respiratory")
 
@@ -67,7 +96,7 @@ class BIDSConverter(object):
 
         if biopac_channels['ecg']:
             cardio_df = pd.DataFrame(biopac_channels['ecg'].data, columns=["cardiac"])
-            physio_df = physio_df.append(cardio_df)
+            physio_df = pd.concat([physio_df, cardio_df])
             cols.append("cardiac")
 
         if biopac_channels['resp']:
@@ -88,7 +117,8 @@ class BIDSConverter(object):
 
         return physio_df, physio_meta
 
-    def _dcm2niix(self, bids_fpath, scan_dir, dicom_dir, physio, compressed, biopac_dir=None, overwrite=False):
+    def _dcm2niix(self, bids_fpath, scan_dir, dicom_dir, physio, compressed, biopac_dir=None, overwrite=False,
+                  series=None):
 
         if os.path.isfile(bids_fpath) and not overwrite:
             self.log.error("The file {} already exists, and --overwrite is set to "
@@ -105,142 +135,207 @@ class BIDSConverter(object):
         tmp_dir = "tmp_{}".format(''.join(random.choice(
             string.ascii_uppercase + string.digits) for _ in range(10)))
 
-        if compressed:
+        # With a conversion cache, series converted before (possibly under another BIDS name) are only linked in place
+        cache_key = None
+        cached = None
+        scratch_key = None
+
+        if self.cache is not None and series is not None:
 
-            workdir = os.path.join(bids_dir, tmp_dir)
-            create_path(workdir)
+            cache_key = self.cache.get_key(series, self.conversion_tool, DCM2NIIX_FLAGS)
+
+            # Like the converted files below, the .bval and .bvec files are only kept for DTI scans
+            cached = self.cache.fetch(cache_key, bids_dir, bids_fname,
+                                      CACHED_EXTENSIONS if "_dwi" in bids_fname else ['.nii.gz', '.json'])
+
+        # dcm2niix writes its outputs here rather than next to the DICOM files, which may be read-only or shared
+        workdir = os.path.join(bids_dir, tmp_dir)
+        create_path(workdir)
+
+        if compressed:
 
             scan_subject, scan_session, scan_folder = scan_dir.strip().split("/")
             compressed_fpath = os.path.join(dicom_dir, "{}-{}-DICOM.tgz".format(scan_subject, scan_session))
-            tar_cmd = 'tar -xf {} {}'.format(compressed_fpath, scan_dir)
 
-            # Extract dicom file
-            try:
+            # Path the archive is read from, its prefetched local copy if there is one
+            archive_fpath = compressed_fpath
 
-                self.log.info("Extracting scan {} from file {}...".format(scan_dir, compressed_fpath))
-                orig_scan_dir = scan_dir
-                check_output(tar_cmd, shell=True, stderr=STDOUT, cwd=workdir)
-                scan_dir = os.path.join(workdir, scan_dir)
-                self.log.info("Scan {} extracted to {}.".format(orig_scan_dir, scan_dir))
+            if self.prefetcher is not None and (not cached or physio['cardiac'] or physio['resp']):
+                archive_fpath = self.prefetcher.get(compressed_fpath)
 
-            except CalledProcessError as e:
+            tar_cmd = 'tar -xf {} {}'.format(archive_fpath, scan_dir)
+
+            # Only the physio files are needed for series found in the cache
+            if not cached:
+
+                # Extract dicom file
+                with self.metrics.stage('series_extraction') as sample:
+
+                    try:
+
+                        self.log.info("Extracting scan {} from file {}...".format(scan_dir, compressed_fpath))
+                        orig_scan_dir = scan_dir
+
+                        if self.scratch is not None:
+                            # Series extracted for an earlier conversion are still in the scratch directory
+                            scratch_key, scan_dir, extracted = self.scratch.acquire(compressed_fpath, scan_dir,
+                                                                                    archive_fpath)
+                        else:
+                            check_output(tar_cmd, shell=True, stderr=STDOUT, cwd=workdir)
+                            scan_dir = os.path.join(workdir, scan_dir)
+                            extracted = True
+
+                        self.log.info("Scan {} {} {}.".format(orig_scan_dir, "extracted to" if extracted else
+                                                              "found in the scratch directory at", scan_dir))
 
-                log_str = LOG_MESSAGES['tar_error'].format(compressed_fpath, tar_cmd, e.returncode)
+                    except CalledProcessError as e:
 
-                if e.output:
-                    log_str += LOG_MESSAGES['output'].format(e.output)
+                        log_str = LOG_MESSAGES['tar_error'].format(compressed_fpath, tar_cmd, e.returncode)
 
-                self.log.error(log_str)
-                raise Exception(LOG_MESSAGES['abort_msg'])
+                        if e.output:
+                            log_str += LOG_MESSAGES['output'].format(e.output)
+
+                        self.log.error(log_str)
+                        raise Exception(LOG_MESSAGES['abort_msg'])
+
+                    scan_bytes = get_dir_size(scan_dir)
+
+                    if extracted:
+                        sample.add(bytes_written=scan_bytes)
+                        self.metrics.incr('bytes_extracted', scan_bytes)
 
             # Extract physio files if present (SIEMENS)
-            if physio['cardiac']:
+            with self.metrics.stage('physio_extraction', items=0) as sample:
 
-                try:
+                if physio['cardiac']:
 
-                    tar_cmd = 'tar -xf {} {}'.format(compressed_fpath, physio['cardiac'])
-                    check_output(tar_cmd, shell=True, stderr=STDOUT, cwd=workdir)
+                    try:
 
-                except CalledProcessError as e:
+                        tar_cmd = 'tar -xf {} {}'.format(archive_fpath, physio['cardiac'])
+                        check_output(tar_cmd, shell=True, stderr=STDOUT, cwd=workdir)
+                        sample.add(items=1, bytes_written=get_file_size(os.path.join(workdir, physio['cardiac'])))
 
-                    log_str = LOG_MESSAGES['tar_error'].format(compressed_fpath, tar_cmd, e.returncode)
+                    except CalledProcessError as e:
 
-                    if e.output:
-                        log_str += LOG_MESSAGES['output'].format(e.output)
+                        log_str = LOG_MESSAGES['tar_error'].format(compressed_fpath, tar_cmd, e.returncode)
 
-                    self.log.error(log_str)
-                    raise Exception(LOG_MESSAGES['abort_msg'])
+                        if e.output:
+                            log_str += LOG_MESSAGES['output'].format(e.output)
 
-            if physio['resp']:
+                        self.log.error(log_str)
+                        raise Exception(LOG_MESSAGES['abort_msg'])
 
-                try:
+                if physio['resp']:
 
-                    tar_cmd = 'tar -xf {} {}'.format(compressed_fpath, physio['resp'])
-                    check_output(tar_cmd, shell=True, stderr=STDOUT, cwd=workdir)
+                    try:
 
-                except CalledProcessError as e:
+                        tar_cmd = 'tar -xf {} {}'.format(archive_fpath, physio['resp'])
+                        check_output(tar_cmd, shell=True, stderr=STDOUT, cwd=workdir)
+                        sample.add(items=1, bytes_written=get_file_size(os.path.join(workdir, physio['resp'])))
 
-                    log_str = LOG_MESSAGES['tar_error'].format(compressed_fpath, tar_cmd, e.returncode)
+                    except CalledProcessError as e:
 
-                    if e.output:
-                        log_str += LOG_MESSAGES['output'].format(e.output)
+                        log_str = LOG_MESSAGES['tar_error'].format(compressed_fpath, tar_cmd, e.returncode)
 
-                    self.log.error(log_str)
+                        if e.output:
+                            log_str += LOG_MESSAGES['output'].format(e.output)
 
-                    raise Exception(LOG_MESSAGES['abort_msg'])
+                        self.log.error(log_str)
 
-        else:
+                        raise Exception(LOG_MESSAGES['abort_msg'])
 
-            workdir = bids_dir
+                self.metrics.incr('bytes_extracted', sample.bytes_written)
+
+        else:
 
             scan_dir = os.path.join(dicom_dir, scan_dir)
 
+            scan_bytes = get_dir_size(scan_dir) if not cached else 0
+
         # Convert extracted DICOMs to NIFTI
 
-        cmd = [
-            "dcm2niix",
-            "-z",
-            "y",
-            "-b",
-            "y",
+        cmd = ["dcm2niix"] + DCM2NIIX_FLAGS + [
             "-f",
             bids_fname,
+            "-o",
+            workdir,
             scan_dir
         ]
 
         try:
 
-            self.log.info("Converting scan {} to BIDS file {}...".format(scan_dir, bids_fname))
+            if cached:
+
+                self.log.info("Reused the cached conversion of scan {} for BIDS file {}.".format(scan_dir, bids_fname))
 
-            result = check_output(cmd, stderr=STDOUT, cwd=workdir, universal_newlines=True)
+            else:
+
+                self.log.info("Converting scan {} to BIDS file {}...".format(scan_dir, bids_fname))
+
+                with self.metrics.stage('dcm2niix') as sample:
+                    if self.watchdog is not None:
+                        result = self.watchdog.run(cmd, scan_bytes, cwd=workdir)
+                    else:
+                        result = check_output(cmd, stderr=STDOUT, cwd=workdir, universal_newlines=True)
+                    sample.add(bytes_read=scan_bytes)
+
+                # The following line is a hack to get the actual filename returned by the dcm2niix utility. When
+                # converting the B0 dcm files, or files that specify which coil they used, or whether they contain phase
+                # information, the utility appends some prefixes to the filename it saves, instead of just using
+                # the specified output filename. There is no option to turn this off (and the author seemed unwilling to
+                # add one). With this hack I retrieve the actual filename it used to save the file from the utility
+                # output. This might break on future updates of dcm2niix
 
-            # The following line is a hack to get the actual filename returned by the dcm2niix utility. When converting
-            # the B0 dcm files, or files that specify which coil they used, or whether they contain phase information,
-            # the utility appends some prefixes to the filename it saves, instead of just using
-            # the specified output filename. There is no option to turn this off (and the author seemed unwilling to
-            # add one). With this hack I retrieve the actual filename it used to save the file from the utility output.
-            # This might break on future updates of dcm2niix
+                convert_line = ""
+                for line in str(result).split("\n"):
+                    if line.startswith("Convert"):
+                        convert_line = line
 
-            convert_line = ""
-            for line in str(result).split("\n"):
-                if line.startswith("Convert"):
-                    convert_line = line
+                if not convert_line:
+                    raise CalledProcessError(-1, cmd, output=result)
 
-            if not convert_line:
-                raise CalledProcessError(-1, cmd, output=result)
+                actual_fname = os.path.basename(convert_line.split(" ")[-2])
 
-            actual_fname = os.path.basename(convert_line.split(" ")[-2])
+                if cache_key:
+                    self.cache.store(cache_key, workdir, actual_fname, series)
 
-            # Move nifti file and json bids file to bids folder
-            print("actual fname: {}".format(actual_fname))
-            print("scan dir: {}".format(os.path.join(scan_dir, "{}.nii.gz".format(actual_fname))))
-            print("bids dir: {}".format(os.path.join(bids_dir, "{}.nii.gz".format(bids_fname))))
-            shutil.move(os.path.join(scan_dir, "{}.nii.gz".format(actual_fname)),
-                        os.path.join(bids_dir, "{}.nii.gz".format(bids_fname)))
-            shutil.move(os.path.join(scan_dir, "{}.json".format(actual_fname)),
-                        os.path.join(bids_dir, "{}.json".format(bids_fname)))
+                # Move nifti file and json bids file to bids folder
+                with self.metrics.stage('file_moves') as sample:
 
-            # If the scan is a DTI scan, move over the bval and bvec files too
-            if "_dwi" in bids_fname:
+                    print("actual fname: {}".format(actual_fname))
+                    print("scan dir: {}".format(os.path.join(workdir, "{}.nii.gz".format(actual_fname))))
+                    print("bids dir: {}".format(os.path.join(bids_dir, "{}.nii.gz".format(bids_fname))))
+                    shutil.move(os.path.join(workdir, "{}.nii.gz".format(actual_fname)),
+                                os.path.join(bids_dir, "{}.nii.gz".format(bids_fname)))
+                    shutil.move(os.path.join(workdir, "{}.json".format(actual_fname)),
+                                os.path.join(bids_dir, "{}.json".format(bids_fname)))
 
-                # Need to verify the .bval and .bvec files got created, because sometimes they fail
-                # without throwing an error in dcm2niix
-                if os.path.isfile(os.path.join(scan_dir, "{}.bval".format(actual_fname))):
+                    sample.add(bytes_written=get_file_size(os.path.join(bids_dir, "{}.nii.gz".format(bids_fname))) +
+                               get_file_size(os.path.join(bids_dir, "{}.json".format(bids_fname))))
 
-                    shutil.move(os.path.join(scan_dir, "{}.bval".format(actual_fname)),
-                                os.path.join(bids_dir, "{}.bval".format(bids_fname)))
+                    # If the scan is a DTI scan, move over the bval and bvec files too
+                    if "_dwi" in bids_fname:
 
-                if os.path.isfile(os.path.join(scan_dir, "{}.bvec".format(actual_fname))):
+                        # Need to verify the .bval and .bvec files got created, because sometimes they fail
+                        # without throwing an error in dcm2niix
+                        if os.path.isfile(os.path.join(workdir, "{}.bval".format(actual_fname))):
 
-                    shutil.move(os.path.join(scan_dir, "{}.bvec".format(actual_fname)),
-                                os.path.join(bids_dir, "{}.bvec".format(bids_fname)))
+                            shutil.move(os.path.join(workdir, "{}.bval".format(actual_fname)),
+                                        os.path.join(bids_dir, "{}.bval".format(bids_fname)))
 
-            log_str = LOG_MESSAGES['success_converted'].format(scan_dir, bids_fpath, " ".join(cmd), 0)
+                        if os.path.isfile(os.path.join(workdir, "{}.bvec".format(actual_fname))):
 
-            if result:
-                log_str += LOG_MESSAGES['output'].format(result)
+                            shutil.move(os.path.join(workdir, "{}.bvec".format(actual_fname)),
+                                        os.path.join(bids_dir, "{}.bvec".format(bids_fname)))
 
-            self.log.info(log_str)
+                self.metrics.incr('bytes_written', sample.bytes_written)
+
+                log_str = LOG_MESSAGES['success_converted'].format(scan_dir, bids_fpath, " ".join(cmd), 0)
+
+                if result:
+                    log_str += LOG_MESSAGES['output'].format(result)
+
+                self.log.info(log_str)
 
             if physio['biopac']:
 
@@ -252,23 +347,28 @@ class BIDSConverter(object):
 
                 self.log.info("Converting biopac file to BIDS format...")
 
-                try:
+                with self.metrics.stage('physio_conversion') as sample:
 
-                    physio_df, physio_meta = self._biopac_to_bids(os.path.join(biopac_dir, physio['biopac']))
+                    try:
 
-                    bids_fname = bids_fname[:-5] if bids_fname.endswith('_bold') else bids_fname
+                        physio_df, physio_meta = self._biopac_to_bids(os.path.join(biopac_dir, physio['biopac']))
 
-                    physio_df.to_csv(os.path.join(bids_dir, "{}_physio.tsv.gz".format(bids_fname)), sep="\t",
-                                     index=False, header=False, compression="gzip")
+                        bids_fname = bids_fname[:-5] if bids_fname.endswith('_bold') else bids_fname
 
-                    with open(os.path.join(bids_dir, "{}_physio.json".format(bids_fname)), 'w') as physio_json:
-                        json.dump(physio_meta, physio_json)
+                        physio_df.to_csv(os.path.join(bids_dir, "{}_physio.tsv.gz".format(bids_fname)), sep="\t",
+                                         index=False, header=False, compression="gzip")
+                        sample.add(bytes_written=get_file_size(os.path.join(bids_dir,
+                                                                            "{}_physio.tsv.gz".format(bids_fname))))
+                        self.metrics.incr('bytes_written', sample.bytes_written)
 
-                    self.log.info("Finished converting biopac to BIDS format...")
+                        with open(os.path.join(bids_dir, "{}_physio.json".format(bids_fname)), 'w') as physio_json:
+                            json.dump(physio_meta, physio_json)
 
-                except struct.error:
+                        self.log.info("Finished converting biopac to BIDS format...")
 
-                    self.log.error("There was an error opening biopac file {}.".format(physio['biopac']))
+                    except struct.error:
+
+                        self.log.error("There was an error opening biopac file {}.".format(physio['biopac']))
 
             elif physio['resp'] or physio['cardiac']:
 
@@ -281,21 +381,39 @@ class BIDSConverter(object):
 
                 self.log.info("Converting physio files to BIDS...")
 
-                physio_df, physio_meta = self._physio_to_bids(resp_physio=resp_physio,
-                                                              cardiac_physio=cardiac_physio)
+                with self.metrics.stage('physio_conversion') as sample:
+
+                    physio_df, physio_meta = self._physio_to_bids(resp_physio=resp_physio,
+                                                                  cardiac_physio=cardiac_physio)
 
-                bids_fname = bids_fname[:-5] if bids_fname.endswith('_bold') else bids_fname
+                    bids_fname = bids_fname[:-5] if bids_fname.endswith('_bold') else bids_fname
 
-                physio_df.to_csv(os.path.join(bids_dir, "{}_physio.tsv.gz".format(bids_fname)), sep="\t", index=False,
-                                 header=False, compression="gzip")
+                    physio_df.to_csv(os.path.join(bids_dir, "{}_physio.tsv.gz".format(bids_fname)), sep="\t",
+                                     index=False, header=False, compression="gzip")
+                    sample.add(bytes_written=get_file_size(os.path.join(bids_dir,
+                                                                        "{}_physio.tsv.gz".format(bids_fname))))
+                    self.metrics.incr('bytes_written', sample.bytes_written)
 
-                with open(os.path.join(bids_dir, "{}_physio.json".format(bids_fname)), 'w') as physio_json:
-                    json.dump(physio_meta, physio_json)
+                    with open(os.path.join(bids_dir, "{}_physio.json".format(bids_fname)), 'w') as physio_json:
+                        json.dump(physio_meta, physio_json)
 
-                self.log.info("Finished converting physio files to BIDS...")
+                    self.log.info("Finished converting physio files to BIDS...")
 
             return True
 
+        except ConversionTimeout as e:
+
+            log_str = LOG_MESSAGES['dcm2niix_timeout'].format(e.timeout, scan_dir, " ".join(cmd))
+
+            if e.output:
+                log_str += LOG_MESSAGES['output'].format(e.output)
+
+            self.log.error(log_str)
+            self.metrics.incr('dcm2niix_timeouts')
+
+            # Left to _process_map_row, which tries the row again or quarantines it
+            raise
+
         except CalledProcessError as e:
 
             log_str = LOG_MESSAGES['dcm2niix_error'].format(scan_dir, " ".join(cmd), e.returncode)
@@ -305,19 +423,30 @@ class BIDSConverter(object):
 
             self.log.error(log_str)
 
+            # With a watchdog, the row is tried again or quarantined rather than aborting the conversion of the map
+            if self.watchdog is not None:
+                raise
+
             raise Exception(LOG_MESSAGES['abort_msg'])
 
         finally:
+
+            if scratch_key:
+                self.scratch.release(scratch_key)
+
             # Clean up temporary files
-            tmp_files = glob(os.path.join(bids_dir, tmp_dir))
+            with self.metrics.stage('cleanup'):
 
-            if tmp_files:
-                list(map(rmtree, tmp_files))
+                tmp_files = glob(os.path.join(bids_dir, tmp_dir))
 
-    def _convert_to_bids(self, bids_fpath, scan_dir, dicom_dir, physio, compressed, biopac_dir=None, overwrite=False):
+                if tmp_files:
+                    list(map(rmtree, tmp_files))
+
+    def _convert_to_bids(self, bids_fpath, scan_dir, dicom_dir, physio, compressed, biopac_dir=None, overwrite=False,
+                         series=None):
 
         if self.conversion_tool == 'dcm2niix':
-            return self._dcm2niix(bids_fpath, scan_dir, dicom_dir, physio, compressed, biopac_dir, overwrite)
+            return self._dcm2niix(bids_fpath, scan_dir, dicom_dir, physio, compressed, biopac_dir, overwrite, series)
         else:
             raise Exception(
                 "Tool Error: {} is not a supported conversion tool. We only support dcm2niix "
@@ -326,31 +455,190 @@ class BIDSConverter(object):
 
     def map_to_bids(self, bids_map, bids_dir, dicom_dir, biopac_dir, nthreads, overwrite):
 
-        # Parse bids_map csv table, and create execution list for BIDS generation
-        mapping = pd.read_csv(bids_map, header=0, index_col=None)
-        mapping.replace(np.nan, '', regex=True, inplace=True)
+        self.converted_rows = []
 
-        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        # Parse bids_map csv table (or use the map already in memory), and create execution list for BIDS generation
+        with self.metrics.stage('map_loading', items=0) as sample:
 
-            futures = []
+            if isinstance(bids_map, pd.DataFrame):
+                mapping = bids_map.fillna('')
+                sample.add(items=len(mapping))
+            else:
+                mapping = pd.read_csv(bids_map, header=0, index_col=None)
+                mapping.replace(np.nan, '', regex=True, inplace=True)
+                sample.add(items=len(mapping), bytes_read=get_file_size(bids_map))
 
-            for _, row in mapping.iterrows():
-                futures.append(executor.submit(self._process_map_row, row, bids_dir, dicom_dir, self.conversion_tool,
-                                               biopac_dir, overwrite))
+        # Start the largest conversions first, so a large series does not end up running alone at the end
+        if self.schedule == 'cost' and len(mapping):
+            mapping, costs = schedule_rows(mapping, dicom_dir, self.metrics)
+            self.log.info(LOG_MESSAGES['schedule'].format(len(mapping), mapping['scan_dir'].iloc[0],
+                                                          costs[0] / 1024.0 ** 2))
 
-            success = True
+        if self.prefetcher is not None:
+            self.prefetcher.start([archive_fpath for archive_fpath in
+                                   (get_archive_path(dicom_dir, scan_dir) for scan_dir in mapping['scan_dir'])
+                                   if archive_fpath])
+
+        try:
+            self._convert_rows(mapping, bids_dir, dicom_dir, biopac_dir, nthreads, overwrite)
+        finally:
+            if self.prefetcher is not None:
+                self.prefetcher.close()
+
+        if self.cache is not None:
+            self.log.info(LOG_MESSAGES['cache_stats'].format(self.cache.hits, self.cache.misses, self.cache.cache_dir))
+
+        if self.scratch is not None:
+            self.log.info(LOG_MESSAGES['scratch_stats'].format(self.scratch.hits, self.scratch.misses,
+                                                               self.scratch.scratch_dir))
+
+    def queue_to_bids(self, queue, bids_map, bids_dir, dicom_dir, biopac_dir, nthreads, overwrite, batch_rows=None,
+                      poll_interval=DEFAULT_POLL_INTERVAL):
+        """Convert the rows of the map claimed from queue, a common_utils.workqueue.FileWorkQueue of tasks listing the
+        scan_dir of their rows (see oxy2bids.scheduling.queue_tasks), until no task is left.
 
-            for future in as_completed(futures):
+        Tasks are claimed until they hold at least batch_rows rows (by default, as many as nthreads can run at once),
+        and converted together with map_to_bids. While the only tasks left are leased to other workers, the queue is
+        polled every poll_interval seconds, to take over the tasks of workers that die. The rows of a task taken over
+        are converted with overwrite, as its earlier worker may have left some of its outputs behind. Conversely, the
+        rows not started yet of a task whose lease this worker lost (e.g. it stalled for longer than the lease timeout)
+        are left to the worker that claimed it again.
+        """
 
-                if not future.result():
-                    success = False
+        if not isinstance(bids_map, pd.DataFrame):
+            bids_map = pd.read_csv(bids_map, header=0, index_col=None)
+
+        batch_rows = batch_rows or get_max_workers(nthreads)
+        converted_rows = []
+
+        while True:
+
+            leases = []
+            scan_dirs = []
+
+            while len(scan_dirs) < batch_rows:
+
+                lease = queue.claim()
+
+                if lease is None:
+                    break
+
+                leases.append(lease)
+                scan_dirs.extend(lease.task['rows'])
+
+            if not leases:
+
+                if not queue.pending():
                     break
 
+                time.sleep(poll_interval)
+                continue
+
+            self.log.info(LOG_MESSAGES['queue_claim'].format(len(leases), len(scan_dirs), queue.worker_id))
+
+            row_leases = dict((scan_dir, lease) for lease in leases for scan_dir in lease.task['rows'])
+            self._skip_row = lambda scan_dir: queue.lost(row_leases[scan_dir])
+
+            try:
+                self.map_to_bids(bids_map[bids_map['scan_dir'].isin(scan_dirs)], bids_dir, dicom_dir, biopac_dir,
+                                 nthreads, overwrite or any(lease.attempt > 1 for lease in leases))
+            finally:
+
+                self._skip_row = None
+
+                converted = set(self.converted_rows)
+                converted_rows.extend(self.converted_rows)
+
+                for lease in leases:
+                    task_converted = [scan_dir for scan_dir in lease.task['rows'] if scan_dir in converted]
+                    queue.complete(lease, converted=task_converted,
+                                   status='complete' if len(task_converted) == len(lease.task['rows']) else 'failed')
+
+                self.converted_rows = converted_rows
+
+    def _convert_rows(self, mapping, bids_dir, dicom_dir, biopac_dir, nthreads, overwrite):
+
+        with get_executor(nthreads, 'conversion', self.metrics) as executor:
+
+            futures = {}
+
+            def submit(row, attempt=1):
+                future = self.metrics.submit(executor, 'conversion', self._process_map_row, row, bids_dir, dicom_dir,
+                                             self.conversion_tool, biopac_dir, overwrite, attempt)
+                futures[future] = row
+
+            for row in self._iter_map_rows(mapping):
+                submit(row)
+
+            # Rows to be tried again, as (not before, sequence number, row, attempt), earliest first
+            retries = []
+            sequence = itertools.count()
+
+            success = True
+            self.metrics.set_gauge('rows_pending', len(futures))
+
+            with self.metrics.waiting('conversion'):
+
+                while futures or retries:
+
+                    now = time.time()
+
+                    while retries and retries[0][0] <= now:
+                        _, _, row, attempt = heapq.heappop(retries)
+                        submit(row, attempt)
+
+                    timeout = retries[0][0] - now if retries else None
+
+                    # No pool thread is held while the backoff of a retried row runs
+                    if not futures:
+                        time.sleep(timeout)
+                        continue
+
+                    done, _ = wait(list(futures), timeout=timeout, return_when=FIRST_COMPLETED)
+
+                    for future in done:
+
+                        row = futures.pop(future)
+
+                        try:
+                            converted = future.result()
+                        except RetryConversion as e:
+                            heapq.heappush(retries, (e.not_before, next(sequence), row, e.attempt))
+                            continue
+                        except Exception:
+                            self.metrics.incr('rows_failed')
+                            raise
+
+                        # Rows quarantined by the watchdog do not hold back the others
+                        if not converted:
+                            self.metrics.incr('rows_failed')
+                            success = False
+                            continue
+
+                        self.metrics.incr('rows_converted')
+                        self.converted_rows.append(row['scan_dir'])
+
+                    self.metrics.set_gauge('rows_pending', len(futures) + len(retries))
+
+            if self.watchdog is not None and self.watchdog.quarantined:
+                self.log.error(LOG_MESSAGES['quarantine_done'].format(self.watchdog.quarantined,
+                                                                      self.watchdog.quarantine_fpath))
+
             if not success:
                 self.log.error("There were errors converting the provided datasets to BIDS format. See log for more" 
                                " information.")
 
-    def _process_map_row(self, row, bids_dir, dicom_dir, conversion_tool='dcm2niix', biopac_dir=None, overwrite=False):
+    @staticmethod
+    def _iter_map_rows(mapping):
+        """Yield the rows of the map as plain dictionaries, built one at a time rather than as a Series per row."""
+
+        columns = list(mapping.columns)
+
+        for values in mapping.itertuples(index=False, name=None):
+            yield dict(zip(columns, values))
+
+    def _process_map_row(self, row, bids_dir, dicom_dir, conversion_tool='dcm2niix', biopac_dir=None, overwrite=False,
+                         attempt=1):
 
         # Construct the BIDS filename based on the metadata provided in the row
 
@@ -450,15 +738,62 @@ class BIDSConverter(object):
             'overwrite': overwrite
         })
 
-        # Convert the file to BIDS format
-        success = self._convert_to_bids(
-            bids_fpath=exec_params['bids_fpath'],
-            scan_dir=exec_params['scan_dir'],
-            dicom_dir=exec_params['dicom_dir'],
-            physio=exec_params['physio'],
-            compressed=exec_params['compressed'],
-            biopac_dir=exec_params['biopac_dir'],
-            overwrite=exec_params['overwrite']
-        )
+        # Convert the file to BIDS format. With a watchdog, failed conversions are tried again later
+        retry = False
+
+        try:
+
+            # The task of the row was claimed again by another worker, which converts it instead
+            if self._skip_row is not None and self._skip_row(scan_dir):
+                self.log.warning(LOG_MESSAGES['queue_lost'].format(scan_dir))
+                return False
+
+            # Stats the source of the row, which may fail, so its prefetched archive is still released below
+            exec_params['series'] = get_series_identity(row, dicom_dir, compressed) if self.cache is not None else None
+
+            try:
+
+                success = self._convert_to_bids(
+                    bids_fpath=exec_params['bids_fpath'],
+                    scan_dir=exec_params['scan_dir'],
+                    dicom_dir=exec_params['dicom_dir'],
+                    physio=exec_params['physio'],
+                    compressed=exec_params['compressed'],
+                    biopac_dir=exec_params['biopac_dir'],
+                    overwrite=exec_params['overwrite'],
+                    series=exec_params['series']
+                )
+
+            except CalledProcessError as e:
+
+                # Only raised through with a watchdog, see _dcm2niix
+                if self.watchdog is None:
+                    raise
+
+                if isinstance(e, ConversionTimeout):
+                    reason = "dcm2niix timed out {} times, the last one after {:.0f} seconds".format(attempt, e.timeout)
+                else:
+                    reason = "dcm2niix failed {} times, the last one with return code {}".format(attempt, e.returncode)
+
+                if attempt > self.watchdog.retries:
+                    self.watchdog.quarantine(row, reason)
+                    self.metrics.incr('rows_quarantined')
+                    self.log.error(LOG_MESSAGES['quarantine'].format(scan_dir, attempt, self.watchdog.quarantine_fpath))
+                    return False
+
+                backoff = self.watchdog.get_backoff(attempt)
+                self.log.warning(LOG_MESSAGES['conversion_retry'].format(scan_dir, attempt, self.watchdog.retries + 1,
+                                                                         backoff))
+                self.metrics.incr('rows_retried')
+
+                # Put back in the queue by _convert_rows, the archive stays prefetched for it
+                retry = True
+                raise RetryConversion(time.time() + backoff, attempt + 1, e)
+
+        finally:
+
+            # Let the prefetched copy of the archive go once its last row is done, whatever the outcome
+            if compressed and self.prefetcher is not None and not retry:
+                self.prefetcher.release(get_archive_path(dicom_dir, scan_dir))
 
         return success
@@ -0,0 +1,235 @@
+from __future__ import print_function, unicode_literals
+
+import os
+import json
+import pandas as pd
+
+from collections import OrderedDict
+from oxy2bids.scheduling import estimate_row_cost, get_archive_path
+from common_utils.metrics import MB
+
+
+# Rates used for the stages no earlier run has measured, in MB of DICOM series per second of a single thread
+DEFAULT_RATES = OrderedDict([
+    ('extraction_mb_per_second', 100.0),
+    ('conversion_mb_per_second', 25.0),
+    # Seconds spent per row outside of the extraction and dcm2niix (physio files, moving the outputs, cleanup)
+    ('row_overhead_seconds', 0.5),
+    # Size of the BIDS outputs (.nii.gz and sidecars) over the size of the DICOM series
+    ('output_ratio', 0.5),
+])
+
+# Stages of oxy2bids runs counted in row_overhead_seconds
+OVERHEAD_STAGES = ['physio_extraction', 'physio_conversion', 'file_moves', 'cleanup']
+
+# Peak memory of dcm2niix, as a multiple of the size of the series it converts, plus a fixed part
+DCM2NIIX_MEMORY_FACTOR = 3
+
+DCM2NIIX_BASE_MEMORY = 64 * 1024 * 1024
+
+ESTIMATE_COLUMNS = ['subject', 'session', 'bids_type', 'modality', 'scan_dir', 'compressed', 'series_bytes',
+                    'extract_bytes', 'output_bytes', 'memory_bytes', 'seconds']
+
+
+def load_calibration(metrics_fpaths):
+    """Per-thread rates of the conversion stages, from the metrics reports (.json) of earlier oxy2bids runs.
+
+    The stages of all the runs are pooled. Rates the runs do not measure (e.g. no series was extracted) keep their
+    DEFAULT_RATES. Returns the rates, and the list of the reports used.
+    """
+
+    totals = dict((key, 0.0) for key in ('extraction_seconds', 'extracted_bytes', 'conversion_seconds',
+                                         'converted_bytes', 'output_bytes', 'overhead_seconds', 'rows'))
+    used = []
+
+    for metrics_fpath in metrics_fpaths:
+
+        try:
+            with open(metrics_fpath) as metrics_file:
+                report = json.load(metrics_file)
+            stages = report['stages']
+            counters = report['counters']
+        except (IOError, OSError, ValueError, KeyError):
+            continue
+
+        # Only runs that converted something say anything about the conversion
+        if not counters.get('rows_converted'):
+            continue
+
+        used.append(metrics_fpath)
+
+        empty = {'wall_seconds': 0, 'bytes_read': 0, 'bytes_written': 0}
+
+        extraction = stages.get('series_extraction', empty)
+        totals['extraction_seconds'] += extraction['wall_seconds']
+        totals['extracted_bytes'] += extraction['bytes_written']
+
+        dcm2niix = stages.get('dcm2niix', empty)
+        totals['conversion_seconds'] += dcm2niix['wall_seconds']
+        totals['converted_bytes'] += dcm2niix['bytes_read']
+        totals['output_bytes'] += stages.get('file_moves', empty)['bytes_written']
+
+        totals['overhead_seconds'] += sum(stages.get(stage, empty)['wall_seconds'] for stage in OVERHEAD_STAGES)
+        totals['rows'] += counters['rows_converted']
+
+    rates = OrderedDict(DEFAULT_RATES)
+
+    if totals['extraction_seconds'] and totals['extracted_bytes']:
+        rates['extraction_mb_per_second'] = totals['extracted_bytes'] / MB / totals['extraction_seconds']
+
+    if totals['conversion_seconds'] and totals['converted_bytes']:
+        rates['conversion_mb_per_second'] = totals['converted_bytes'] / MB / totals['conversion_seconds']
+
+    if totals['converted_bytes'] and totals['output_bytes']:
+        rates['output_ratio'] = totals['output_bytes'] / totals['converted_bytes']
+
+    if totals['rows']:
+        rates['row_overhead_seconds'] = totals['overhead_seconds'] / totals['rows']
+
+    return rates, used
+
+
+def estimate_map(bids_map, dicom_dir, rates):
+    """Predict the extraction bytes, output size, dcm2niix memory and conversion time of every row of the map.
+
+    Only the map and the sizes of the series are used, nothing is extracted or converted. The size of a series is
+    taken from the map, see oxy2bids.scheduling.estimate_row_cost. Returns a DataFrame with ESTIMATE_COLUMNS.
+    """
+
+    if isinstance(bids_map, pd.DataFrame):
+        mapping = bids_map.fillna('')
+    else:
+        mapping = pd.read_csv(bids_map, header=0, index_col=None).fillna('')
+
+    rows = mapping.to_dict('records')
+    sizes = [estimate_row_cost(row, dicom_dir) for row in rows]
+
+    # Series whose size is unknown are assumed to be of the median size
+    known = sorted(size for size in sizes if size is not None)
+    default_size = known[len(known) // 2] if known else 0
+
+    estimates = []
+
+    for row, series_bytes in zip(rows, sizes):
+
+        series_bytes = series_bytes if series_bytes is not None else default_size
+        compressed = get_archive_path(dicom_dir, row['scan_dir']) is not None
+        extract_bytes = series_bytes if compressed else 0
+
+        estimates.append(OrderedDict([
+            ('subject', row['subject']),
+            ('session', row['session']),
+            ('bids_type', row['bids_type']),
+            ('modality', row['modality']),
+            ('scan_dir', row['scan_dir']),
+            ('compressed', compressed),
+            ('series_bytes', series_bytes),
+            ('extract_bytes', extract_bytes),
+            ('output_bytes', int(series_bytes * rates['output_ratio'])),
+            ('memory_bytes', DCM2NIIX_MEMORY_FACTOR * series_bytes + DCM2NIIX_BASE_MEMORY),
+            ('seconds', extract_bytes / MB / rates['extraction_mb_per_second'] +
+             series_bytes / MB / rates['conversion_mb_per_second'] + rates['row_overhead_seconds']),
+        ]))
+
+    return pd.DataFrame(estimates, columns=ESTIMATE_COLUMNS)
+
+
+def get_free_space(path):
+    """Free space in bytes of the file system path is (or will be) created on, or None if it cannot be told."""
+
+    path = os.path.abspath(path)
+
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+
+    try:
+        stat = os.statvfs(path)
+    except (AttributeError, OSError):
+        return None
+
+    return stat.f_bavail * stat.f_frsize
+
+
+def summarize_estimate(estimate_df, cpu_count, available_memory=None, free_space=None, map_seconds=0.0):
+    """Totals of an estimate, and the number of threads and scratch space suggested for this machine.
+
+    The suggested nthreads is the number of CPUs, limited by the number of rows, and by the available memory given
+    the peak memory of dcm2niix on the largest series. The walltime is that of the rows spread over the suggested
+    threads largest first, but never less than the longest row. The scratch space is what the suggested threads
+    need at once in the work directories (the largest extracted series and their outputs), and the scratch budget
+    the size of every extracted series, enough for --scratch_dir to keep them all.
+    """
+
+    n_rows = len(estimate_df)
+    max_memory = int(estimate_df['memory_bytes'].max()) if n_rows else 0
+
+    nthreads = max(1, min(cpu_count, n_rows))
+
+    if available_memory and max_memory:
+        nthreads = max(1, min(nthreads, available_memory // max_memory))
+
+    seconds = estimate_df['seconds'].sum()
+    max_seconds = estimate_df['seconds'].max() if n_rows else 0.0
+
+    workdir_bytes = (estimate_df['extract_bytes'] + estimate_df['output_bytes']).sort_values(ascending=False)
+
+    summary = OrderedDict([
+        ('rows', n_rows),
+        ('compressed_rows', int(estimate_df['compressed'].sum())),
+        ('series_bytes', int(estimate_df['series_bytes'].sum())),
+        ('extract_bytes', int(estimate_df['extract_bytes'].sum())),
+        ('output_bytes', int(estimate_df['output_bytes'].sum())),
+        ('cpu_seconds', float(seconds)),
+        ('max_row_seconds', float(max_seconds)),
+        ('map_seconds', float(map_seconds)),
+        ('cpu_count', cpu_count),
+        ('available_memory', available_memory),
+        ('max_row_memory', max_memory),
+        ('nthreads', int(nthreads)),
+        ('walltime_seconds', float(map_seconds + max(seconds / nthreads, max_seconds))),
+        ('peak_memory', int(max_memory * nthreads)),
+        ('peak_scratch_bytes', int(workdir_bytes.iloc[:nthreads].sum())),
+        ('scratch_budget_bytes', int(estimate_df['extract_bytes'].sum())),
+        ('free_space', free_space),
+    ])
+
+    return summary
+
+
+def format_estimate(summary, rates, calibration_fpaths):
+
+    def gb(value):
+        return "{:.2f} GB".format(value / MB / 1024.0) if value is not None else "unknown"
+
+    def duration(value):
+        return "{:d}h{:02d}m{:02d}s".format(int(value // 3600), int(value % 3600 // 60), int(value % 60))
+
+    lines = [
+        "Estimate for {} rows ({} compressed):".format(summary['rows'], summary['compressed_rows']),
+        "  DICOM series:                  {}".format(gb(summary['series_bytes'])),
+        "  Extracted from archives:       {}".format(gb(summary['extract_bytes'])),
+        "  BIDS outputs:                  {}".format(gb(summary['output_bytes'])),
+        "  Conversion time (1 thread):    {}".format(duration(summary['cpu_seconds'])),
+        "  Longest row:                   {}".format(duration(summary['max_row_seconds'])),
+        "",
+        "Suggested for this machine ({} CPUs, {} of memory available):".format(summary['cpu_count'],
+                                                                             gb(summary['available_memory'])),
+        "  --nthreads                     {}".format(summary['nthreads']),
+        "  Walltime                       {}".format(duration(summary['walltime_seconds'])),
+        "  Peak memory                    {}".format(gb(summary['peak_memory'])),
+        "  Peak scratch space             {}".format(gb(summary['peak_scratch_bytes'])),
+        "  --scratch_size                 {}".format(gb(summary['scratch_budget_bytes'])),
+        "  Free space for the outputs     {}".format(gb(summary['free_space'])),
+        "",
+        "Rates ({}):".format("calibrated from {} earlier run(s)".format(len(calibration_fpaths))
+                             if calibration_fpaths else "defaults, no earlier runs to calibrate from"),
+    ]
+
+    lines.extend("  {:<30} {:.4g}".format(key, value) for key, value in rates.items())
+
+    if summary['free_space'] is not None and \
+            summary['free_space'] < summary['output_bytes'] + summary['peak_scratch_bytes']:
+        lines.extend(["", "WARNING: the outputs and work directories may not fit in the free space of the BIDS "
+                          "directory"])
+
+    return "\n".join(lines) + "\n"
@@ -1,13 +1,35 @@
 from __future__ import print_function, unicode_literals
 
 import os
+import time
 import argparse
 import json
+import pandas as pd
+
+from glob import glob
 
 from oxy2bids.constants import LOG_MESSAGES
-from common_utils.utils import init_log, log_shutdown, get_cpu_count, get_datetime, get_config
+from common_utils.utils import init_log, log_shutdown, get_cpu_count, get_datetime, get_config, AUTO_CONFIG, \
+    CONFIG_PRESETS, get_available_memory
+from common_utils.metrics import StageMetrics
+from common_utils.concurrency import parse_nthreads, AUTO_THREADS
+from common_utils.profiling import StageProfiler
+from common_utils.prometheus import PrometheusTextfileExporter
 from oxy2bids.converters import BIDSConverter
+from oxy2bids.cache import ConversionCache, ExtractedSeriesCache, DEFAULT_CACHE_SIZE_GB, DEFAULT_SCRATCH_SIZE_GB, \
+    LINK_MODES
+from oxy2bids.prefetch import ArchivePrefetcher, DEFAULT_PREFETCH_ARCHIVES, DEFAULT_PREFETCH_SIZE_GB
+from oxy2bids.scheduling import SCHEDULES, DEFAULT_SCHEDULE, QUEUE_BY, shard_rows, queue_tasks
+from common_utils.sharding import SHARD_BY, DEFAULT_SHARD_BY, parse_shard, write_manifest, load_manifests, \
+    get_coverage, get_file_digest
+from oxy2bids.watchdog import ConversionWatchdog, DEFAULT_TIMEOUT, DEFAULT_TIMEOUT_PER_GB, DEFAULT_RETRIES, \
+    DEFAULT_RETRY_BACKOFF
+from oxy2bids.watch import WatchState, watch_dicom_dir, load_seed_map, DEFAULT_WATCH_INTERVAL
+from common_utils.workqueue import FileWorkQueue, DEFAULT_LEASE_TIMEOUT, DEFAULT_POLL_INTERVAL, get_worker_id
+from oxy2bids.estimate import load_calibration, estimate_map, summarize_estimate, format_estimate, get_free_space
 from bidsmapper.mapper import gen_map
+from bidsmapper.classifier import get_auto_config
+from bidsmapper.utils import MAP_COLUMNS
 
 
 def main():
@@ -55,14 +77,30 @@ def main():
 
     parser.add_argument(
         "--nthreads",
-        help="number of threads to use when running this script. Use 1 for sequential run.",
-        default=get_cpu_count(),
-        type=int
+        help="number of threads to use when running this script. Use 1 for sequential run, or {} (the default) to "
+             "adapt the number of threads of each stage to the throughput it achieves ({}:<max threads> to bound "
+             "it)".format(AUTO_THREADS, AUTO_THREADS),
+        default=AUTO_THREADS,
+        type=parse_nthreads
     )
 
     parser.add_argument(
         "--config",
-        help="Custom config file",
+        help="Custom config file, one of the scanner presets ({}), or 'auto' to pick the preset of each series from "
+             "the scanner that acquired it".format(", ".join(CONFIG_PRESETS)),
+        default=None
+    )
+
+    parser.add_argument(
+        "--station_map",
+        help="With --config auto, JSON file mapping station names (or manufacturers) to the preset to use for their "
+             "series, for scanners that are not recognized from their station name",
+        default=None
+    )
+
+    parser.add_argument(
+        "--trace",
+        help="Write a Chrome trace-event timeline of worker activity to this file (viewable in Perfetto)",
         default=None
     )
 
@@ -74,26 +112,275 @@ def main():
         default=False
     )
 
+    parser.add_argument(
+        "--prom_textfile",
+        help="Periodically write live progress metrics to this file in the Prometheus text format, for the "
+             "node_exporter textfile collector (the file name must end in .prom)",
+        default=None
+    )
+
+    parser.add_argument(
+        "--prom_interval",
+        help="Seconds between updates of the --prom_textfile file.",
+        default=15.0,
+        type=float
+    )
+
+    parser.add_argument(
+        "--profile",
+        help="Profile CPU (cProfile) and memory (tracemalloc) usage of every stage, and store the results in a "
+             "oxy2bids_profile_<timestamp> directory inside the output directory",
+        action='store_true',
+        default=False
+    )
+
+    parser.add_argument(
+        "--keep_duplicates",
+        help="Map every copy of a series found more than once in the DICOM directory (e.g. in both an archive and an "
+             "uncompressed folder), instead of only its preferred copy",
+        action='store_true',
+        default=False
+    )
+
+    parser.add_argument(
+        "--conversion_cache",
+        help="Directory of a cache of dcm2niix outputs, keyed by source series and dcm2niix version and flags. Series "
+             "converted in a previous run (e.g. before editing the map) are linked or copied from it instead of being "
+             "extracted and converted again",
+        default=None
+    )
+
+    parser.add_argument(
+        "--cache_size",
+        help="Maximum size of the --conversion_cache directory in GB, the least recently used conversions are evicted "
+             "beyond it",
+        default=DEFAULT_CACHE_SIZE_GB,
+        type=float
+    )
+
+    parser.add_argument(
+        "--cache_link_mode",
+        help="How files are placed in and out of the --conversion_cache: 'auto' (reflinks if the file system supports "
+             "them, else hardlinks, else copies), 'reflink', 'hardlink' or 'copy'. JSON sidecars are never hardlinked.",
+        choices=LINK_MODES,
+        default='auto'
+    )
+
+    parser.add_argument(
+        "--scratch_dir",
+        help="Local directory in which to keep the series extracted from the .tgz archives, so series converted again "
+             "(e.g. with --overwrite, or after a failed conversion) are not decompressed again",
+        default=None
+    )
+
+    parser.add_argument(
+        "--scratch_size",
+        help="Maximum size of the --scratch_dir directory in GB, the least recently used series are evicted beyond it",
+        default=DEFAULT_SCRATCH_SIZE_GB,
+        type=float
+    )
+
+    parser.add_argument(
+        "--prefetch_dir",
+        help="Local directory to copy the .tgz archives to ahead of their conversion, when dicom_dir is on slow (e.g. "
+             "network) storage. The copies are deleted once all the series in them are converted",
+        default=None
+    )
+
+    parser.add_argument(
+        "--prefetch_archives",
+        help="Maximum number of archives copied to the --prefetch_dir at a time",
+        default=DEFAULT_PREFETCH_ARCHIVES,
+        type=int
+    )
+
+    parser.add_argument(
+        "--prefetch_size",
+        help="Maximum total size of the archives copied to the --prefetch_dir at a time in GB",
+        default=DEFAULT_PREFETCH_SIZE_GB,
+        type=float
+    )
+
+    parser.add_argument(
+        "--schedule",
+        help="Order in which to convert the rows of the map: 'cost' (the largest series first, keeping the series of "
+             "the same archive together) or 'map' (the order of the map)",
+        choices=SCHEDULES,
+        default=DEFAULT_SCHEDULE
+    )
+
+    parser.add_argument(
+        "--estimate",
+        help="Only estimate the extraction, output size, memory and conversion time of every row of the map (from "
+             "the archive indexes and DICOM headers, without running dcm2niix), and suggest --nthreads and a scratch "
+             "budget for this machine",
+        action='store_true',
+        default=False
+    )
+
+    parser.add_argument(
+        "--calibration",
+        help="Metrics reports (oxy2bids_metrics_*.json), or directories holding them, of earlier runs to calibrate "
+             "the --estimate time model with. Defaults to the reports in out_dir",
+        nargs='+',
+        default=None
+    )
+
+    parser.add_argument(
+        "--shard",
+        help="Only convert shard i of N (i/N, with 0 <= i < N, e.g. the index and size of a job array) of the rows of "
+             "the --bids_map, balanced by their estimated cost, into the shared --bids_dir. Each shard writes its own "
+             "manifest and log, and --merge_shards checks that all of them completed",
+        default=None,
+        type=parse_shard
+    )
+
+    parser.add_argument(
+        "--shard_by",
+        help="Rows converted by a single shard with --shard: those of the same 'archive' (a session) or 'subject'",
+        choices=SHARD_BY,
+        default=DEFAULT_SHARD_BY
+    )
+
+    parser.add_argument(
+        "--merge_shards",
+        help="Check that the shards of a --shard run in out_dir converted every row of the --bids_map, and store the "
+             "rows that were not in a oxy2bids_missing_<timestamp>.csv map, to convert them again",
+        action='store_true',
+        default=False
+    )
+
+    parser.add_argument(
+        "--queue_dir",
+        help="Directory of a work queue shared by any number of oxy2bids workers, on any number of nodes, converting "
+             "the rows of the same --bids_map into the shared --bids_dir. Each worker claims tasks as it goes, and "
+             "takes over the tasks of workers that stop sending heartbeats",
+        default=None
+    )
+
+    parser.add_argument(
+        "--queue_by",
+        help="Rows of a task of the --queue_dir: those of the same 'archive' (a session) or 'subject', or a single "
+             "'row'",
+        choices=QUEUE_BY,
+        default=DEFAULT_SHARD_BY
+    )
+
+    parser.add_argument(
+        "--lease_timeout",
+        help="Seconds without a heartbeat after which the tasks leased by a worker of the --queue_dir are given to "
+             "another worker",
+        default=DEFAULT_LEASE_TIMEOUT,
+        type=float
+    )
+
+    parser.add_argument(
+        "--watch",
+        help="Keep watching dicom_dir, and map and convert each new archive or uncompressed session into the "
+             "--bids_dir as soon as its size stops changing, until stopped. Subjects and sessions are labelled "
+             "consistently with the data converted before, which is kept track of across restarts in out_dir. With "
+             "--bids_map, the labels of the map the --bids_dir was converted from are reused",
+        action='store_true',
+        default=False
+    )
+
+    parser.add_argument(
+        "--watch_interval",
+        help="Seconds between two looks at dicom_dir with --watch",
+        default=DEFAULT_WATCH_INTERVAL,
+        type=float
+    )
+
+    parser.add_argument(
+        "--timeout",
+        help="Seconds dcm2niix may run for on any series, plus --timeout_per_gb seconds per GB of the series, after "
+             "which it is stopped along with its children, and the series tried again. 0 disables the timeout",
+        default=DEFAULT_TIMEOUT,
+        type=float
+    )
+
+    parser.add_argument(
+        "--timeout_per_gb",
+        help="Seconds dcm2niix may run for per GB of the series it converts, on top of --timeout",
+        default=DEFAULT_TIMEOUT_PER_GB,
+        type=float
+    )
+
+    parser.add_argument(
+        "--retries",
+        help="Times a series whose conversion timed out or failed is tried again before it is quarantined: set "
+             "aside in a map stored in out_dir, while the other series carry on",
+        default=DEFAULT_RETRIES,
+        type=int
+    )
+
+    parser.add_argument(
+        "--retry_backoff",
+        help="Seconds before the first retry of a series whose conversion timed out or failed, doubled for each "
+             "further one",
+        default=DEFAULT_RETRY_BACKOFF,
+        type=float
+    )
+
     settings = {}
 
     cli_args = parser.parse_args()
 
+    if cli_args.watch and not cli_args.bids_dir:
+        parser.error("--watch requires a --bids_dir")
+
+    if cli_args.watch and (cli_args.shard or cli_args.merge_shards or cli_args.queue_dir or cli_args.estimate):
+        parser.error("--watch cannot be used with --shard, --merge_shards, --queue_dir or --estimate")
+
+    if cli_args.queue_dir and not (cli_args.bids_map and cli_args.bids_dir):
+        parser.error("--queue_dir requires a --bids_map and a --bids_dir shared by all the workers")
+
+    if cli_args.queue_dir and (cli_args.shard or cli_args.merge_shards or cli_args.estimate):
+        parser.error("--queue_dir cannot be used with --shard, --merge_shards or --estimate")
+
+    if (cli_args.shard or cli_args.merge_shards) and not cli_args.bids_map:
+        parser.error("--shard and --merge_shards require a --bids_map, generated once for all the shards")
+
+    if cli_args.shard and not cli_args.bids_dir:
+        parser.error("--shard requires a --bids_dir shared by all the shards")
+
+    if cli_args.shard and cli_args.merge_shards:
+        parser.error("--shard and --merge_shards cannot be used together")
+
     settings["debug"] = cli_args.debug
 
     settings["out_dir"] = os.path.abspath(cli_args.out_dir)
 
+    settings["shard"] = cli_args.shard
+
+    settings["queue_dir"] = os.path.abspath(cli_args.queue_dir) if cli_args.queue_dir else None
+
+    # Each shard (or queue worker) has its own log, as all the shards of a job array may start within the same second
+    if settings["shard"]:
+        run_name = "{}_{}".format(start_datetime, settings["shard"].tag)
+    elif settings["queue_dir"]:
+        run_name = "{}_{}".format(start_datetime, get_worker_id())
+    else:
+        run_name = start_datetime
+
     # Init log
-    log_fpath = os.path.join(settings["out_dir"], "oxy2bids_{}.log".format(start_datetime))
+    log_fpath = os.path.join(settings["out_dir"], "oxy2bids_{}.log".format(run_name))
     settings["log"] = init_log(log_fpath, log_name='oxy2bids', debug=settings["debug"])
 
     # Load config file
-    settings["config"] = get_config(cli_args.config) if cli_args.config else get_config()
+    if cli_args.station_map and cli_args.config != AUTO_CONFIG:
+        parser.error("--station_map can only be used with --config {}".format(AUTO_CONFIG))
+
+    if cli_args.config == AUTO_CONFIG:
+        settings["config"] = get_auto_config(os.path.abspath(cli_args.station_map) if cli_args.station_map else None)
+    else:
+        settings["config"] = get_config(cli_args.config) if cli_args.config else get_config()
 
     # Normalize directories
     settings["dicom_dir"] = os.path.abspath(cli_args.dicom_dir)
 
     if cli_args.bids_dir:
-        if os.path.isfile(os.path.abspath(cli_args.bids_dir)):
+        if os.path.isdir(os.path.abspath(cli_args.bids_dir)):
             settings["bids_dir"] = os.path.abspath(cli_args.bids_dir)
         else:
             settings["log"].error("BIDS directory {} not found. Aborting...".format(cli_args.bids_dir))
@@ -120,52 +407,302 @@ def main():
 
     settings["nthreads"] = cli_args.nthreads
 
+    settings["trace"] = os.path.abspath(cli_args.trace) if cli_args.trace else None
+
+    settings["prom_textfile"] = os.path.abspath(cli_args.prom_textfile) if cli_args.prom_textfile else None
+
+    settings["prom_interval"] = cli_args.prom_interval
+
+    settings["profile"] = os.path.join(settings["out_dir"], "oxy2bids_profile_{}".format(run_name)) \
+        if cli_args.profile else None
+
     settings["overwrite"] = cli_args.overwrite
 
+    settings["keep_duplicates"] = cli_args.keep_duplicates
+
+    settings["conversion_cache"] = os.path.abspath(cli_args.conversion_cache) if cli_args.conversion_cache else None
+
+    settings["cache_size"] = cli_args.cache_size
+
+    settings["cache_link_mode"] = cli_args.cache_link_mode
+
+    settings["scratch_dir"] = os.path.abspath(cli_args.scratch_dir) if cli_args.scratch_dir else None
+
+    settings["scratch_size"] = cli_args.scratch_size
+
+    settings["prefetch_dir"] = os.path.abspath(cli_args.prefetch_dir) if cli_args.prefetch_dir else None
+
+    settings["prefetch_archives"] = cli_args.prefetch_archives
+
+    settings["prefetch_size"] = cli_args.prefetch_size
+
+    settings["schedule"] = cli_args.schedule
+
+    settings["estimate"] = cli_args.estimate
+
+    settings["shard_by"] = cli_args.shard_by
+
+    settings["merge_shards"] = cli_args.merge_shards
+
+    settings["queue_by"] = cli_args.queue_by
+
+    settings["lease_timeout"] = cli_args.lease_timeout
+
+    settings["watch"] = cli_args.watch
+
+    settings["watch_interval"] = cli_args.watch_interval
+
+    settings["timeout"] = cli_args.timeout
+
+    settings["timeout_per_gb"] = cli_args.timeout_per_gb
+
+    settings["retries"] = cli_args.retries
+
+    settings["retry_backoff"] = cli_args.retry_backoff
+
+    settings["quarantine"] = os.path.join(settings["out_dir"], "oxy2bids_quarantine_{}.csv".format(run_name))
+
+    settings["calibration"] = []
+
+    for calibration_path in (cli_args.calibration or [settings["out_dir"]]):
+        if os.path.isdir(calibration_path):
+            settings["calibration"].extend(sorted(glob(os.path.join(os.path.abspath(calibration_path),
+                                                                    "oxy2bids_metrics_*.json"))))
+        else:
+            settings["calibration"].append(os.path.abspath(calibration_path))
+
     # Print the settings
     settings["log"].info(json.dumps({key: settings[key] for key in settings if key != 'log'}, sort_keys=True,
-                                    indent=2))
+                                    indent=2, default=str))
 
-    converter = BIDSConverter(conversion_tool='dcm2niix', log=settings["log"])
+    if settings["merge_shards"]:
 
-    if valid_bmap:
+        # Check the shards of a sharded run instead of converting
+        try:
 
-        # Use provided map to convert files
-        settings["log"].info(LOG_MESSAGES['start_conversion'])
+            manifests = load_manifests(settings["out_dir"], 'oxy2bids',
+                                       bids_map_digest=get_file_digest(settings["bids_map"]))
 
-        converter.map_to_bids(settings["bids_map"], settings["bids_dir"], settings["dicom_dir"],
-                              settings["biopac_dir"], settings["nthreads"], settings["overwrite"])
+            mapping = pd.read_csv(settings["bids_map"], header=0, index_col=None)
+            missing, _ = get_coverage(manifests, 'converted', mapping['scan_dir'])
+            _, repeated = get_coverage(manifests, 'rows', mapping['scan_dir'])
 
-        settings["log"].info(LOG_MESSAGES['shutdown'].format(settings["bids_dir"]))
+            if repeated:
+                settings["log"].warning(LOG_MESSAGES['shards_overlap'].format(len(repeated), ", ".join(repeated)))
 
-    else:
+            if missing:
+                missing_fpath = os.path.join(settings["out_dir"], "oxy2bids_missing_{}.csv".format(start_datetime))
+                mapping[mapping['scan_dir'].isin(missing)].to_csv(path_or_buf=missing_fpath, index=False, header=True)
+                settings["log"].error(LOG_MESSAGES['shards_incomplete'].format(len(missing), len(mapping),
+                                                                               missing_fpath))
+            else:
+                settings["log"].info(LOG_MESSAGES['shards_complete'].format(len(mapping), len(manifests),
+                                                                            manifests[0]['bids_dir']))
+
+        except ValueError as e:
+
+            settings["log"].error(str(e))
+
+        log_shutdown(settings["log"])
+        return
+
+    metrics = StageMetrics('oxy2bids', trace_fpath=settings["trace"],
+                           profiler=StageProfiler(settings["profile"]) if settings["profile"] else None)
+
+    exporter = None
+
+    if settings["prom_textfile"]:
+        exporter = PrometheusTextfileExporter(metrics, settings["prom_textfile"], 'oxy2bids',
+                                              settings["prom_interval"]).start()
+
+    if settings["estimate"]:
+
+        map_seconds = 0.0
 
-        # Generate Oxygen to BIDS mapping
-        settings["log"].info(LOG_MESSAGES['start_map'])
+        if valid_bmap:
 
-        mapping = gen_map(settings["dicom_dir"], settings["config"]["BIDS_TAGS"], settings["config"]["DICOM_TAGS"],
-                          settings["nthreads"], settings["log"])
+            mapping = settings["bids_map"]
+
+            if settings["shard"]:
+                mapping, n_units, total_units, loads = shard_rows(pd.read_csv(mapping, header=0, index_col=None),
+                                                                  settings["dicom_dir"], settings["shard"],
+                                                                  settings["shard_by"], metrics)
+                settings["log"].info(LOG_MESSAGES['shard_plan'].format(
+                    settings["shard"], len(mapping), n_units, total_units, settings["shard_by"],
+                    loads[settings["shard"].index] / 1024.0 ** 2, max(loads) / 1024.0 ** 2))
+
+        else:
+
+            # The headers are parsed as for a conversion, and the map saved so the conversion can reuse it
+            settings["log"].info(LOG_MESSAGES['start_map'])
+
+            map_start = time.time()
+            mapping = gen_map(settings["dicom_dir"], settings["config"]["BIDS_TAGS"], settings["config"]["DICOM_TAGS"],
+                              settings["nthreads"], settings["log"], metrics,
+                              keep_duplicates=settings["keep_duplicates"])
+            map_seconds = time.time() - map_start
+
+            if mapping is not None:
+                mapping.to_csv(path_or_buf=settings["bids_map"], index=False, header=True, columns=MAP_COLUMNS)
+                settings["log"].info(LOG_MESSAGES['gen_map_done'].format(settings["bids_map"]))
 
         if mapping is not None:
 
-            col_order = ['subject', 'session', 'bids_type', 'task', 'acq', 'rec', 'run', 'modality', 'patient_id',
-                         'scan_datetime', 'scan_dir', 'resp_physio', 'cardiac_physio', 'biopac']
+            rates, calibration = load_calibration(settings["calibration"])
+
+            estimate_df = estimate_map(mapping, settings["dicom_dir"], rates)
+            summary = summarize_estimate(estimate_df, get_cpu_count(), get_available_memory(),
+                                         get_free_space(settings["bids_dir"]), map_seconds)
+
+            estimate_fpath = os.path.join(settings["out_dir"], "oxy2bids_estimate_{}.csv".format(run_name))
+            estimate_df.to_csv(path_or_buf=estimate_fpath, index=False, header=True)
+
+            settings["log"].info("\n" + format_estimate(summary, rates, calibration))
+            settings["log"].info(LOG_MESSAGES['estimate_done'].format(estimate_fpath))
+
+        else:
+
+            settings["log"].warning("A mapping could not be generated. See log for details.")
+
+    else:
+
+        cache = None
+
+        if settings["conversion_cache"]:
+            cache = ConversionCache(settings["conversion_cache"], int(settings["cache_size"] * 1024 ** 3),
+                                    settings["cache_link_mode"], settings["log"], metrics)
+
+        scratch = None
+
+        if settings["scratch_dir"]:
+            scratch = ExtractedSeriesCache(settings["scratch_dir"], int(settings["scratch_size"] * 1024 ** 3),
+                                           settings["log"], metrics)
+
+        prefetcher = None
+
+        if settings["prefetch_dir"]:
+            prefetcher = ArchivePrefetcher(settings["prefetch_dir"], settings["prefetch_archives"],
+                                           int(settings["prefetch_size"] * 1024 ** 3), log=settings["log"],
+                                           metrics=metrics)
+
+        watchdog = ConversionWatchdog(settings["timeout"], settings["timeout_per_gb"], settings["retries"],
+                                      settings["retry_backoff"], settings["quarantine"])
+
+        converter = BIDSConverter(conversion_tool='dcm2niix', log=settings["log"], metrics=metrics, cache=cache,
+                                  scratch=scratch, prefetcher=prefetcher, schedule=settings["schedule"],
+                                  watchdog=watchdog)
+
+        if settings["watch"]:
+
+            # The map of each unit converted is appended to a single map, and the labels given so far are persisted
+            state = WatchState(os.path.join(settings["out_dir"], "oxy2bids_watch_state.json"), settings["bids_dir"])
+
+            if valid_bmap:
+                state.seed(load_seed_map(settings["bids_map"]))
+
+            watch_dicom_dir(settings["dicom_dir"], settings["bids_dir"],
+                            os.path.join(settings["out_dir"], "bids_map_watch.csv"), state, converter,
+                            settings["config"], settings["nthreads"], settings["log"], metrics,
+                            biopac_dir=settings["biopac_dir"], overwrite=settings["overwrite"],
+                            interval=settings["watch_interval"], keep_duplicates=settings["keep_duplicates"])
 
-            # Save map to csv
-            mapping.to_csv(path_or_buf=settings["bids_map"], index=False, header=True, columns=col_order)
-            settings["log"].info(LOG_MESSAGES['gen_map_done'].format(settings["bids_map"]))
+        elif valid_bmap and settings["queue_dir"]:
+
+            mapping = pd.read_csv(settings["bids_map"], header=0, index_col=None)
+
+            queue = FileWorkQueue(settings["queue_dir"], lease_timeout=settings["lease_timeout"],
+                                  heartbeat=settings["lease_timeout"] / 10, log=settings["log"])
+
+            # Only the first worker's tasks are used, the others find the queue populated
+            queue.populate(queue_tasks(mapping, settings["dicom_dir"], settings["queue_by"]))
 
-            # Use generated map to convert files
             settings["log"].info(LOG_MESSAGES['start_conversion'])
 
-            converter.map_to_bids(settings["bids_map"], settings["bids_dir"], settings["dicom_dir"],
-                                  settings["biopac_dir"], settings["nthreads"], settings["overwrite"])
+            try:
+                converter.queue_to_bids(queue, mapping, settings["bids_dir"], settings["dicom_dir"],
+                                        settings["biopac_dir"], settings["nthreads"], settings["overwrite"],
+                                        poll_interval=min(DEFAULT_POLL_INTERVAL, settings["lease_timeout"] / 4))
+            finally:
+                queue.close()
+
+            results = queue.results()
+            settings["log"].info(LOG_MESSAGES['queue_done'].format(
+                settings["queue_dir"], len(results), len(queue.tasks()),
+                sum(1 for result in results.values() if result and result['status'] != 'complete'),
+                len(converter.converted_rows)))
+
+        elif valid_bmap:
+
+            mapping = settings["bids_map"]
+
+            if settings["shard"]:
+                mapping, n_units, total_units, loads = shard_rows(pd.read_csv(mapping, header=0, index_col=None),
+                                                                  settings["dicom_dir"], settings["shard"],
+                                                                  settings["shard_by"], metrics)
+                settings["log"].info(LOG_MESSAGES['shard_plan'].format(
+                    settings["shard"], len(mapping), n_units, total_units, settings["shard_by"],
+                    loads[settings["shard"].index] / 1024.0 ** 2, max(loads) / 1024.0 ** 2))
+
+            # Use provided map to convert files
+            settings["log"].info(LOG_MESSAGES['start_conversion'])
+
+            try:
+
+                converter.map_to_bids(mapping, settings["bids_dir"], settings["dicom_dir"],
+                                      settings["biopac_dir"], settings["nthreads"], settings["overwrite"])
+
+            finally:
+
+                # Written even if the conversion is aborted, so the merge step can tell which rows are left
+                if settings["shard"]:
+                    manifest_fpath = write_manifest(
+                        settings["out_dir"], 'oxy2bids', settings["shard"], settings["shard_by"],
+                        status='complete' if len(converter.converted_rows) == len(mapping) else 'failed',
+                        bids_map=settings["bids_map"], bids_map_digest=get_file_digest(settings["bids_map"]),
+                        bids_dir=settings["bids_dir"], dicom_dir=settings["dicom_dir"], units=n_units,
+                        rows=list(mapping['scan_dir']), converted=converter.converted_rows, log=log_fpath)
+                    settings["log"].info(LOG_MESSAGES['manifest_done'].format(settings["shard"], manifest_fpath))
 
             settings["log"].info(LOG_MESSAGES['shutdown'].format(settings["bids_dir"]))
 
         else:
 
-            settings["log"].warning("A mapping could not be generated. See log for details.")
+            # Generate Oxygen to BIDS mapping
+            settings["log"].info(LOG_MESSAGES['start_map'])
+
+            mapping = gen_map(settings["dicom_dir"], settings["config"]["BIDS_TAGS"], settings["config"]["DICOM_TAGS"],
+                              settings["nthreads"], settings["log"], metrics,
+                              keep_duplicates=settings["keep_duplicates"])
+
+            if mapping is not None:
+
+                # Save map to csv
+                mapping.to_csv(path_or_buf=settings["bids_map"], index=False, header=True, columns=MAP_COLUMNS)
+                settings["log"].info(LOG_MESSAGES['gen_map_done'].format(settings["bids_map"]))
+
+                # Use generated map to convert files, straight from memory rather than reloading the csv
+                settings["log"].info(LOG_MESSAGES['start_conversion'])
+
+                converter.map_to_bids(mapping, settings["bids_dir"], settings["dicom_dir"],
+                                      settings["biopac_dir"], settings["nthreads"], settings["overwrite"])
+
+                settings["log"].info(LOG_MESSAGES['shutdown'].format(settings["bids_dir"]))
+
+            else:
+
+                settings["log"].warning("A mapping could not be generated. See log for details.")
+
+    if exporter:
+        exporter.stop()
+
+    metrics_files = metrics.write_report(settings["out_dir"], "oxy2bids_metrics_{}".format(run_name))
+    settings["log"].info(LOG_MESSAGES['metrics_done'].format(*metrics_files))
+
+    if settings["trace"]:
+        settings["log"].info(LOG_MESSAGES['trace_done'].format(metrics.write_trace()))
+
+    if settings["profile"]:
+        settings["log"].info(LOG_MESSAGES['profile_done'].format(metrics.write_profile()))
 
     # Shutdown the log
     log_shutdown(settings["log"])
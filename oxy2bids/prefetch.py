@@ -0,0 +1,245 @@
+from __future__ import print_function, unicode_literals
+
+import os
+import shutil
+import threading
+
+from collections import OrderedDict
+from common_utils.metrics import NULL_METRICS
+
+
+DEFAULT_PREFETCH_ARCHIVES = 2
+
+DEFAULT_PREFETCH_SIZE_GB = 10
+
+# Size of the reads from the network file system, large enough to keep the reads sequential
+DEFAULT_CHUNK_SIZE = 16 * 1024 * 1024
+
+_PENDING, _COPYING, _READY, _FAILED, _RELEASED = 'pending', 'copying', 'ready', 'failed', 'released'
+
+
+def _fadvise(fd, advice):
+
+    # Only a hint, not available on every platform (or on Python 2)
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+        except OSError:
+            pass
+
+
+def copy_sequential(src_fpath, dst_fpath, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Copy src_fpath to dst_fpath in large sequential reads, and return the number of bytes copied.
+
+    The kernel is told the source is read sequentially, so it reads ahead aggressively, and that its pages are not
+    needed afterwards, since only the local copy is read from then on.
+    """
+
+    copied = 0
+
+    with open(src_fpath, 'rb') as src_file:
+
+        _fadvise(src_file.fileno(), 'POSIX_FADV_SEQUENTIAL')
+
+        with open(dst_fpath, 'wb') as dst_file:
+
+            while True:
+
+                chunk = src_file.read(chunk_size)
+
+                if not chunk:
+                    break
+
+                dst_file.write(chunk)
+                copied += len(chunk)
+
+        _fadvise(src_file.fileno(), 'POSIX_FADV_DONTNEED')
+
+    shutil.copystat(src_fpath, dst_fpath)
+
+    return copied
+
+
+class ArchivePrefetcher(object):
+    """Copy the Oxygen/Gold archives about to be converted from slow (e.g. network) storage to a local directory.
+
+    Given the archive of every row of the map in conversion order, a background thread copies the archives in the
+    order they are first needed, while the rows of the previous ones are converted. At most max_archives archives, and
+    max_bytes bytes, are kept locally at a time (a single archive larger than max_bytes is still copied once nothing
+    else is). The local copy of an archive is deleted as soon as its last row is released. Rows whose archive was not
+    copied yet read it from its original location.
+    """
+
+    def __init__(self, prefetch_dir, max_archives=DEFAULT_PREFETCH_ARCHIVES,
+                 max_bytes=int(DEFAULT_PREFETCH_SIZE_GB * 1024 ** 3), chunk_size=DEFAULT_CHUNK_SIZE, log=None,
+                 metrics=None):
+
+        self.prefetch_dir = os.path.abspath(prefetch_dir)
+        self.max_archives = max(1, max_archives)
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.log = log
+        self.metrics = metrics if metrics is not None else NULL_METRICS
+
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+        self._states = OrderedDict()
+        self._remaining = {}
+        self._sizes = {}
+
+        if not os.path.isdir(self.prefetch_dir):
+            os.makedirs(self.prefetch_dir)
+
+    def _get_local_path(self, archive_fpath):
+        return os.path.join(self.prefetch_dir, os.path.basename(archive_fpath))
+
+    def start(self, archive_rows):
+        """Start prefetching, given the archive of every row to be converted, in conversion order. The prefetcher can
+        be started again after close, e.g. for the next batch of a work queue."""
+
+        self._stopped = False
+
+        for archive_fpath in archive_rows:
+
+            if archive_fpath not in self._states:
+                self._states[archive_fpath] = _PENDING
+                self._remaining[archive_fpath] = 0
+
+            self._remaining[archive_fpath] += 1
+
+        self._thread = threading.Thread(target=self._run, name="archive_prefetch")
+        self._thread.daemon = True
+        self._thread.start()
+
+        return self
+
+    def _resident(self):
+        return [archive_fpath for archive_fpath, state in self._states.items() if state in (_COPYING, _READY)]
+
+    def _has_room(self, archive_bytes):
+
+        resident = self._resident()
+
+        if not resident:
+            return True
+
+        return len(resident) < self.max_archives and \
+            sum(self._sizes[archive_fpath] for archive_fpath in resident) + archive_bytes <= self.max_bytes
+
+    def _run(self):
+
+        for archive_fpath in list(self._states.keys()):
+
+            try:
+                archive_bytes = os.path.getsize(archive_fpath)
+            except OSError:
+                archive_bytes = 0
+
+            with self._cond:
+
+                while not self._stopped and not self._has_room(archive_bytes):
+                    self._cond.wait()
+
+                if self._stopped:
+                    return
+
+                # All its rows are already done (e.g. they failed before reading it)
+                if self._remaining[archive_fpath] <= 0:
+                    self._states[archive_fpath] = _RELEASED
+                    continue
+
+                self._sizes[archive_fpath] = archive_bytes
+                self._states[archive_fpath] = _COPYING
+
+            local_fpath = self._get_local_path(archive_fpath)
+            tmp_fpath = "{}.part".format(local_fpath)
+
+            try:
+
+                with self.metrics.stage('archive_prefetch') as sample:
+                    sample.add(bytes_read=copy_sequential(archive_fpath, tmp_fpath, self.chunk_size))
+                    os.rename(tmp_fpath, local_fpath)
+
+                state = _READY
+
+            except (IOError, OSError) as e:
+
+                # The rows of this archive read it from its original location instead
+                if self.log:
+                    self.log.warning("Could not prefetch {} to {}: {}".format(archive_fpath, self.prefetch_dir, e))
+
+                if os.path.isfile(tmp_fpath):
+                    os.remove(tmp_fpath)
+
+                state = _FAILED
+
+            with self._cond:
+
+                if state == _READY and self._remaining[archive_fpath] <= 0:
+                    os.remove(local_fpath)
+                    state = _RELEASED
+
+                self._states[archive_fpath] = state
+                self._cond.notify_all()
+
+    def get(self, archive_fpath):
+        """Path to read archive_fpath from: its local copy, waiting for it if it is being copied, or the archive itself
+        if it is not prefetched, or not yet being copied.
+
+        Archives waiting for room are not waited for: room only frees up once every row of a local copy is released,
+        which, when the rows of several archives are interleaved, may take rows that are still to come.
+        """
+
+        with self._cond:
+
+            if archive_fpath not in self._states:
+                return archive_fpath
+
+            if self._states[archive_fpath] == _PENDING:
+                self.metrics.incr('prefetch_bypassed')
+                return archive_fpath
+
+            if self._states[archive_fpath] == _COPYING:
+
+                with self.metrics.stage('prefetch_wait'):
+                    while not self._stopped and self._states[archive_fpath] == _COPYING:
+                        self._cond.wait()
+
+            if self._states[archive_fpath] == _READY:
+                return self._get_local_path(archive_fpath)
+
+            return archive_fpath
+
+    def release(self, archive_fpath):
+        """Signal that one row of archive_fpath is done, deleting its local copy after the last one."""
+
+        with self._cond:
+
+            if archive_fpath not in self._states:
+                return
+
+            self._remaining[archive_fpath] -= 1
+
+            if self._remaining[archive_fpath] > 0 or self._states[archive_fpath] != _READY:
+                return
+
+            self._states[archive_fpath] = _RELEASED
+            os.remove(self._get_local_path(archive_fpath))
+            self._cond.notify_all()
+
+    def close(self):
+        """Stop prefetching, and delete the local copies left."""
+
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+        if self._thread is not None:
+            self._thread.join()
+
+        for archive_fpath, state in self._states.items():
+            if state == _READY:
+                os.remove(self._get_local_path(archive_fpath))
+                self._states[archive_fpath] = _RELEASED
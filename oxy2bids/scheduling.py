@@ -0,0 +1,162 @@
+from __future__ import print_function, unicode_literals
+
+import os
+
+from common_utils.discovery import get_series_size
+from common_utils.metrics import NULL_METRICS
+from common_utils.sharding import SHARD_BY, DEFAULT_SHARD_BY, get_shard_key, balance_shards
+
+
+SCHEDULES = ['cost', 'map']
+
+DEFAULT_SCHEDULE = 'cost'
+
+# Units of work of the tasks of a --queue_dir: the rows of an archive, of a subject, or each row on its own
+QUEUE_BY = SHARD_BY + ['row']
+
+
+def get_archive_path(dicom_dir, scan_dir):
+    """Path of the Oxygen/Gold archive holding the series in scan_dir, or None if it is uncompressed."""
+
+    if os.path.isdir(os.path.join(dicom_dir, scan_dir)):
+        return None
+
+    scan_subject, scan_session, _ = scan_dir.strip().split("/")
+
+    return os.path.join(dicom_dir, "{}-{}-DICOM.tgz".format(scan_subject, scan_session))
+
+
+def estimate_row_cost(row, dicom_dir):
+    """Estimated cost of converting a row of the map, as the size in bytes of its DICOM series, or None if unknown.
+
+    The size recorded in the map by bidsmapper is used when there is one. Otherwise uncompressed series are sized on
+    disk, and the size of compressed ones is left unknown, as it would take reading their archive to find out.
+    """
+
+    try:
+        series_bytes = int(float(row.get('series_bytes')))
+    except (TypeError, ValueError):
+        series_bytes = None
+
+    if series_bytes:
+        return series_bytes
+
+    series_dir = os.path.join(dicom_dir, row['scan_dir'])
+
+    if os.path.isdir(series_dir):
+        return get_series_size(series_dir)[1]
+
+    return None
+
+
+def estimate_row_costs(rows, dicom_dir):
+    """Estimated cost of each row (see estimate_row_cost), with the rows of unknown cost given the median cost of the
+    others."""
+
+    costs = [estimate_row_cost(row, dicom_dir) for row in rows]
+
+    known = sorted(cost for cost in costs if cost is not None)
+    default_cost = known[len(known) // 2] if known else 0
+
+    return [cost if cost is not None else default_cost for cost in costs]
+
+
+def shard_rows(mapping, dicom_dir, shard, shard_by=DEFAULT_SHARD_BY, metrics=None):
+    """Rows of the map converted by a shard (a common_utils.sharding.Shard) of a sharded run.
+
+    The rows are grouped by archive (or subject, with shard_by), so no archive is read by more than one shard, and the
+    groups are spread over the shards by their estimated cost (see estimate_row_cost). Every node computes the same
+    split from the same map. Returns the rows of the shard in map order, the number of groups in the shard and in
+    all, and the estimated cost of each shard.
+    """
+
+    metrics = metrics if metrics is not None else NULL_METRICS
+
+    rows = mapping.to_dict('records')
+
+    with metrics.stage('sharding', items=len(rows)):
+
+        keys = [get_shard_key(row['scan_dir'], dicom_dir, shard_by) for row in rows]
+        group_costs = {}
+
+        for key, cost in zip(keys, estimate_row_costs(rows, dicom_dir)):
+            group_costs[key] = group_costs.get(key, 0) + cost
+
+        assignment, loads = balance_shards(group_costs, shard.count)
+
+    in_shard = [assignment[key] == shard.index for key in keys]
+    n_groups = sum(1 for index in assignment.values() if index == shard.index)
+
+    return mapping[in_shard].reset_index(drop=True), n_groups, len(assignment), loads
+
+
+def queue_tasks(mapping, dicom_dir, queue_by=DEFAULT_SHARD_BY):
+    """Tasks of a common_utils.workqueue.FileWorkQueue converting the rows of the map.
+
+    Each task holds the scan_dir of the rows of an archive, of a subject, or a single row, depending on queue_by
+    (one of QUEUE_BY). Tasks are listed largest first by the estimated cost of their rows (see estimate_row_cost),
+    for the same reason rows are, see schedule_rows.
+    """
+
+    rows = mapping.to_dict('records')
+
+    tasks = {}
+    task_order = []
+
+    for row, cost in zip(rows, estimate_row_costs(rows, dicom_dir)):
+
+        key = row['scan_dir'] if queue_by == 'row' else get_shard_key(row['scan_dir'], dicom_dir, queue_by)
+
+        if key not in tasks:
+            tasks[key] = {'key': key, 'rows': [], 'cost': 0}
+            task_order.append(key)
+
+        tasks[key]['rows'].append(row['scan_dir'])
+        tasks[key]['cost'] += cost
+
+    task_order.sort(key=lambda key: -tasks[key]['cost'])
+
+    return [tasks[key] for key in task_order]
+
+
+def schedule_rows(mapping, dicom_dir, metrics=None):
+    """Reorder the rows of the map so the largest conversions start first.
+
+    With the rows in map order, a large series (e.g. a long multiband BOLD run, or a DWI series) near the end of the
+    map leaves one worker busy long after the others are done. Rows are ordered by estimated cost instead (see
+    estimate_row_cost), largest first, while the rows of the same archive are kept together, so each archive is read
+    once, in a single stretch: archives are ordered by the cost of their largest row, and their rows by cost. Rows
+    of unknown cost are given the median cost of the others. Ties keep the map order.
+
+    Returns the reordered map, and the estimated cost of each of its rows.
+    """
+
+    metrics = metrics if metrics is not None else NULL_METRICS
+
+    rows = mapping.to_dict('records')
+
+    with metrics.stage('scheduling', items=len(rows)):
+        costs = estimate_row_costs(rows, dicom_dir)
+
+    groups = {}
+    group_order = []
+
+    for idx, row in enumerate(rows):
+
+        # Uncompressed series are each their own group, only the archives benefit from being read in one go
+        group_key = get_archive_path(dicom_dir, row['scan_dir']) or ('row', idx)
+
+        if group_key not in groups:
+            groups[group_key] = []
+            group_order.append(group_key)
+
+        groups[group_key].append(idx)
+
+    for group_key in group_order:
+        groups[group_key].sort(key=lambda idx: -costs[idx])
+
+    group_order.sort(key=lambda group_key: -costs[groups[group_key][0]])
+
+    order = [idx for group_key in group_order for idx in groups[group_key]]
+
+    return mapping.iloc[order].reset_index(drop=True), [costs[idx] for idx in order]
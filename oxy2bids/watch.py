@@ -0,0 +1,357 @@
+from __future__ import print_function, unicode_literals
+
+import os
+import re
+import json
+import time
+import signal
+import threading
+import pandas as pd
+
+from glob import glob
+from common_utils.discovery import iter_session_dirs
+from common_utils.metrics import NULL_METRICS
+from common_utils.sharding import get_archive_shard_key, get_session_shard_key
+from bidsmapper.mapper import gen_map
+from bidsmapper.utils import MAP_COLUMNS
+from oxy2bids.constants import LOG_MESSAGES
+
+
+# Seconds between two looks at the DICOM directory
+DEFAULT_WATCH_INTERVAL = 30.0
+
+# Number of looks in a row over which the size of an archive or session must not change for it to be converted, so
+# archives still being copied, and sessions still being exported, are left alone
+DEFAULT_SETTLE_POLLS = 2
+
+SUBJECT_RE = re.compile(r'^sub-(\d+)$')
+RUN_RE = re.compile(r'^run-(\d+)$')
+
+# Columns whose combination is numbered in runs within a session, see bidsmapper.mapper.assign_bids_labels
+RUN_COLUMNS = ['task', 'acq', 'rec', 'modality']
+
+# Unit of the runs taken over from the map of an earlier conversion
+SEED_UNIT = ''
+
+
+def get_unit_signature(unit_path):
+    """Size of an archive, or number of files and their total size for an uncompressed session, along with the
+    latest modification time: it stops changing once the data is completely written."""
+
+    if os.path.isfile(unit_path):
+        stat = os.stat(unit_path)
+        return [1, stat.st_size, stat.st_mtime]
+
+    n_files = 0
+    total_bytes = 0
+    latest = 0
+
+    for dir_path, _, file_names in os.walk(unit_path):
+        for file_name in file_names:
+            try:
+                stat = os.stat(os.path.join(dir_path, file_name))
+            except OSError:
+                continue
+            n_files += 1
+            total_bytes += stat.st_size
+            latest = max(latest, stat.st_mtime)
+
+    return [n_files, total_bytes, latest]
+
+
+def get_run_number(run):
+    """Number of a run label of the map, 1 for the unlabelled single runs."""
+
+    match = RUN_RE.match(run or "")
+
+    return int(match.group(1)) if match else 1
+
+
+class WatchState(object):
+    """State of oxy2bids --watch, persisted to a JSON file across restarts.
+
+    Records the BIDS subject of every patient id and the BIDS session of every (patient id, scan datetime) seen so
+    far, and the runs each unit (archive or session, see list_units) added to every task/acq/rec/modality of a
+    session, so series arriving later are labelled consistently with the BIDS directory. Also records the signature
+    (see get_unit_signature) and outcome of every unit processed, so they are not converted twice.
+    """
+
+    def __init__(self, state_fpath, bids_dir):
+
+        self.state_fpath = state_fpath
+        self.bids_dir = bids_dir
+        self.subjects = {}
+        self.sessions = {}
+        self.runs = {}
+        self.units = {}
+
+        if os.path.isfile(state_fpath):
+            with open(state_fpath) as state_file:
+                state = json.load(state_file)
+            self.subjects = state['subjects']
+            self.sessions = state['sessions']
+            self.runs = state.get('runs', {})
+            self.units = state['units']
+
+    def save(self):
+
+        tmp_fpath = "{}.tmp".format(self.state_fpath)
+
+        with open(tmp_fpath, 'w') as state_file:
+            json.dump({'subjects': self.subjects, 'sessions': self.sessions, 'runs': self.runs, 'units': self.units},
+                      state_file, indent=2, sort_keys=True)
+
+        os.rename(tmp_fpath, self.state_fpath)
+
+    @staticmethod
+    def _session_key(patient_id, scan_datetime):
+        return "{}|{}".format(patient_id, scan_datetime)
+
+    @staticmethod
+    def _run_keys(mapping):
+        return ["|".join(values) for values in mapping[RUN_COLUMNS].fillna('').astype(str).values.tolist()]
+
+    def seed(self, mapping):
+        """Take over the labels of a map the BIDS directory was already converted from."""
+
+        n_runs = {}
+
+        for row, run_key in zip(mapping[['subject', 'session', 'patient_id', 'scan_datetime']].itertuples(index=False),
+                                self._run_keys(mapping)):
+            session_key = self._session_key(row.patient_id, row.scan_datetime)
+            self.subjects.setdefault("{}".format(row.patient_id), row.subject)
+            self.sessions.setdefault(session_key, row.session)
+            n_runs[(session_key, run_key)] = n_runs.get((session_key, run_key), 0) + 1
+
+        for (session_key, run_key), count in n_runs.items():
+            self.runs.setdefault(session_key, {}).setdefault(run_key, {}).setdefault(SEED_UNIT, [0, count])
+
+    def _next_subject(self):
+        """Number following the highest subject label given so far, or found in the BIDS directory."""
+
+        labels = list(self.subjects.values())
+
+        if os.path.isdir(self.bids_dir):
+            labels.extend(os.listdir(self.bids_dir))
+
+        numbers = [int(match.group(1)) for match in (SUBJECT_RE.match(label) for label in labels) if match]
+
+        return max(numbers or [0]) + 1
+
+    def _place_runs(self, session_key, run_key, unit_key, n_runs):
+        """Number of runs of a task/acq/rec/modality of a session that come before the n_runs ones of unit_key, and
+        the total number of runs of the session.
+
+        A unit processed again keeps the place of its runs if they still fit in it, other units follow the runs
+        already recorded.
+        """
+
+        units = self.runs.setdefault(session_key, {}).setdefault(run_key, {})
+        placed = units.get(unit_key)
+
+        if placed is not None and n_runs <= placed[1]:
+            offset = placed[0]
+        else:
+            offset = max([first + count for unit, (first, count) in units.items() if unit != unit_key] or [0])
+
+        units[unit_key] = [offset, n_runs]
+
+        return offset, max(first + count for first, count in units.values())
+
+    def assign_labels(self, mapping_df, unit_key=SEED_UNIT):
+        """Replace the labels of a map generated for the newly arrived data of unit_key, numbered within that data
+        only, by the ones of the patients and sessions already seen, or by new ones following them.
+
+        The runs of a session already converted from other units are numbered after the ones recorded, so a series
+        added to it never takes the BIDS file name of an earlier one. A run label is given as soon as a session has
+        more than one run of a task/acq/rec/modality, so the first one may have been converted without it.
+        """
+
+        next_subject = self._next_subject()
+
+        subjects = []
+        sessions = []
+        session_keys = []
+
+        for patient_id, scan_datetime in zip(mapping_df['patient_id'], mapping_df['scan_datetime']):
+
+            patient_id = "{}".format(patient_id)
+
+            if patient_id not in self.subjects:
+                self.subjects[patient_id] = 'sub-{}'.format(str(next_subject).rjust(5, '0'))
+                next_subject += 1
+
+            session_key = self._session_key(patient_id, scan_datetime)
+
+            if session_key not in self.sessions:
+                n_sessions = sum(1 for key in self.sessions if key.split("|", 1)[0] == patient_id)
+                self.sessions[session_key] = 'ses-{}'.format(str(n_sessions + 1).rjust(5, '0'))
+
+            subjects.append(self.subjects[patient_id])
+            sessions.append(self.sessions[session_key])
+            session_keys.append(session_key)
+
+        mapping_df['subject'] = subjects
+        mapping_df['session'] = sessions
+
+        # The runs of the unit, numbered in order by gen_map, with single runs left unlabelled
+        run_groups = list(zip(session_keys, self._run_keys(mapping_df)))
+        run_numbers = [get_run_number(run) for run in mapping_df['run']]
+
+        n_runs = {}
+
+        for run_group, run_number in zip(run_groups, run_numbers):
+            n_runs[run_group] = max(n_runs.get(run_group, 0), run_number)
+
+        places = {run_group: self._place_runs(run_group[0], run_group[1], unit_key, count)
+                  for run_group, count in n_runs.items()}
+
+        runs = []
+
+        for run_group, run_number in zip(run_groups, run_numbers):
+            offset, total = places[run_group]
+            runs.append("run-{}".format(str(offset + run_number).rjust(len(str(total)) + 1, '0')) if total > 1 else "")
+
+        mapping_df['run'] = runs
+
+
+def list_units(dicom_dir):
+    """Archives and uncompressed sessions of dicom_dir, by key (see common_utils.sharding): the copies of a session
+    in both forms share their key, and are mapped together."""
+
+    units = {}
+
+    for archive_fpath in glob(os.path.join(dicom_dir, "*.tgz")):
+        units.setdefault(get_archive_shard_key(archive_fpath), []).append(archive_fpath)
+
+    for session_dir in iter_session_dirs(dicom_dir):
+        units.setdefault(get_session_shard_key(session_dir), []).append(session_dir)
+
+    return units
+
+
+def watch_dicom_dir(dicom_dir, bids_dir, map_fpath, state, converter, config, nthreads, log, metrics=None,
+                    biopac_dir=None, overwrite=False, interval=DEFAULT_WATCH_INTERVAL,
+                    settle_polls=DEFAULT_SETTLE_POLLS, keep_duplicates=False):
+    """Map and convert the archives and uncompressed sessions of dicom_dir as they arrive, until interrupted (Ctrl-C
+    or SIGTERM).
+
+    dicom_dir is listed every interval seconds. An archive or session is converted once its signature (see
+    get_unit_signature) stayed the same for settle_polls looks in a row: its series are mapped alone, labelled
+    consistently with the data converted before (see WatchState), appended to the map in map_fpath, and converted.
+    An archive is not processed again unless its signature changes, e.g. when it is exported again. Uncompressed
+    sessions already processed are not walked again, unless an archive of the same session appears.
+    """
+
+    metrics = metrics if metrics is not None else NULL_METRICS
+
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        stop.set()
+
+    previous_handler = signal.signal(signal.SIGTERM, request_stop)
+
+    # Signature of the units not processed yet at each look, and the number of looks it stayed the same
+    pending = {}
+
+    log.info(LOG_MESSAGES['watch_start'].format(dicom_dir, interval))
+
+    try:
+
+        while not stop.is_set():
+
+            with metrics.stage('watch_scan', items=0) as sample:
+
+                ready = []
+
+                for key, unit_paths in sorted(list_units(dicom_dir).items()):
+
+                    unit_paths = sorted(unit_paths)
+                    processed = state.units.get(key, {})
+
+                    if processed.get('paths') == unit_paths and all(os.path.isdir(path) for path in unit_paths):
+                        continue
+
+                    signature = [get_unit_signature(unit_path) for unit_path in unit_paths]
+
+                    if processed.get('signature') == signature:
+                        continue
+
+                    last_signature, stable = pending.get(key, (None, 0))
+                    stable = stable + 1 if signature == last_signature else 1
+                    pending[key] = (signature, stable)
+
+                    if stable >= settle_polls:
+                        ready.append((key, unit_paths))
+
+                sample.add(items=len(ready))
+
+            for key, unit_paths in ready:
+
+                if stop.is_set():
+                    break
+
+                # Data exported again replaces the outputs of its earlier conversion
+                _process_unit(key, unit_paths, pending.pop(key)[0], dicom_dir, bids_dir, map_fpath, state, converter,
+                              config, nthreads, log, metrics, biopac_dir, overwrite or key in state.units,
+                              keep_duplicates)
+
+            stop.wait(interval)
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
+
+    log.info(LOG_MESSAGES['watch_stop'].format(dicom_dir))
+
+
+def _process_unit(key, unit_paths, signature, dicom_dir, bids_dir, map_fpath, state, converter, config, nthreads, log,
+                  metrics, biopac_dir, overwrite, keep_duplicates):
+
+    arrived = time.time()
+
+    log.info(LOG_MESSAGES['watch_ready'].format(key))
+
+    status = 'failed'
+    n_rows = 0
+
+    try:
+
+        mapping = gen_map(dicom_dir, config["BIDS_TAGS"], config["DICOM_TAGS"], nthreads, log, metrics,
+                          keep_duplicates=keep_duplicates, shard_units={key})
+
+        if mapping is None:
+
+            status = 'empty'
+
+        else:
+
+            state.assign_labels(mapping, key)
+            mapping.sort_values(['subject', 'session', 'task', 'modality', 'run'], inplace=True)
+            n_rows = len(mapping)
+
+            mapping.to_csv(path_or_buf=map_fpath, mode='a', index=False, header=not os.path.isfile(map_fpath),
+                           columns=MAP_COLUMNS)
+
+            converter.map_to_bids(mapping, bids_dir, dicom_dir, biopac_dir, nthreads, overwrite)
+
+            status = 'converted' if len(converter.converted_rows) == n_rows else 'failed'
+
+    except Exception as e:
+
+        log.error(LOG_MESSAGES['watch_error'].format(key, e))
+
+    # Failed units are not retried until their data changes, as they would most likely fail the same way
+    state.units[key] = {'paths': unit_paths, 'signature': signature, 'status': status, 'rows': n_rows}
+    state.save()
+
+    metrics.incr('watch_units_{}'.format(status))
+    log.info(LOG_MESSAGES['watch_done'].format(key, status, n_rows, time.time() - arrived))
+
+
+def load_seed_map(map_fpath):
+    """Map a BIDS directory was converted from before watching started, with its labels as strings."""
+    return pd.read_csv(map_fpath, header=0, index_col=None, dtype=str, keep_default_na=False)
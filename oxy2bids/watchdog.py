@@ -0,0 +1,163 @@
+from __future__ import print_function, unicode_literals
+
+import os
+import sys
+import time
+import signal
+import threading
+import pandas as pd
+
+from subprocess import Popen, PIPE, STDOUT, CalledProcessError
+
+
+# Seconds any dcm2niix run is given, on top of the time allowed for the size of its series. 0 disables the watchdog
+DEFAULT_TIMEOUT = 600.0
+
+# Seconds dcm2niix is given per GB of DICOM series, well below its usual throughput so only hung runs are stopped
+DEFAULT_TIMEOUT_PER_GB = 600.0
+
+# Times a row whose conversion timed out or failed is tried again before it is quarantined
+DEFAULT_RETRIES = 2
+
+# Seconds before the first retry of a row, doubled for each further one
+DEFAULT_RETRY_BACKOFF = 30.0
+
+# Seconds between the SIGTERM and the SIGKILL sent to a process group that timed out
+KILL_GRACE = 5.0
+
+QUARANTINE_REASON = 'quarantine_reason'
+
+
+class ConversionTimeout(CalledProcessError):
+    """A command stopped by the ConversionWatchdog after running for longer than its timeout."""
+
+    def __init__(self, cmd, timeout, output=None):
+        super(ConversionTimeout, self).__init__(-signal.SIGKILL, cmd, output=output)
+        self.timeout = timeout
+
+    def __str__(self):
+        return "Command '{}' timed out after {:.0f} seconds".format(" ".join(self.cmd), self.timeout)
+
+
+class RetryConversion(Exception):
+    """Raised for a row of the map whose conversion failed, to be tried again once not_before (a time.time()) has
+    passed, rather than waiting in the worker."""
+
+    def __init__(self, not_before, attempt, cause):
+        super(RetryConversion, self).__init__("{}".format(cause))
+        self.not_before = not_before
+        self.attempt = attempt
+        self.cause = cause
+
+
+def _kill_group(proc, killed):
+
+    # Finished just as the timeout expired
+    if proc.poll() is not None:
+        return
+
+    # dcm2niix may have started children (e.g. pigz), the whole group is stopped so none is left behind
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except OSError:
+        return
+
+    killed.set()
+
+    for _ in range(int(KILL_GRACE * 10)):
+        if proc.poll() is not None:
+            return
+        time.sleep(0.1)
+
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+class ConversionWatchdog(object):
+    """Run dcm2niix with a timeout scaled to the size of the series it converts, and decide what happens to the rows
+    of the map whose conversion keeps failing.
+
+    A run is given timeout seconds plus timeout_per_gb seconds per GB of its series. Past that, its whole process
+    group is sent SIGTERM, then SIGKILL, and ConversionTimeout is raised. A row whose conversion timed out or failed
+    is tried again up to retries times, retry_backoff seconds later for the first retry and twice as long for each
+    further one, and is put back in the queue of the conversion pool meanwhile. Rows that still fail are
+    quarantined: appended to the quarantine_fpath CSV as they come, with the reason in a quarantine_reason column, so
+    they can be looked into, and converted again with --bids_map, while the rest of the map carries on.
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, timeout_per_gb=DEFAULT_TIMEOUT_PER_GB, retries=DEFAULT_RETRIES,
+                 retry_backoff=DEFAULT_RETRY_BACKOFF, quarantine_fpath=None):
+
+        self.timeout = timeout
+        self.timeout_per_gb = timeout_per_gb
+        self.retries = max(0, retries)
+        self.retry_backoff = retry_backoff
+        self.quarantine_fpath = quarantine_fpath
+
+        self.quarantined = 0
+        self._lock = threading.Lock()
+
+    def get_timeout(self, series_bytes):
+        """Seconds a conversion of a series of series_bytes bytes may run for, or None if unlimited."""
+
+        if not self.timeout:
+            return None
+
+        return self.timeout + self.timeout_per_gb * (series_bytes or 0) / 1024.0 ** 3
+
+    def get_backoff(self, attempt):
+        """Seconds to wait before trying a row again, after its attempt-th failed attempt."""
+        return self.retry_backoff * 2 ** (attempt - 1)
+
+    def run(self, cmd, series_bytes, cwd=None):
+        """Run cmd like subprocess.check_output (with stderr merged, as text), in its own process group, stopping it
+        after the timeout of a series of series_bytes bytes."""
+
+        timeout = self.get_timeout(series_bytes)
+
+        session = {'start_new_session': True} if sys.version_info[0] >= 3 else {'preexec_fn': os.setsid}
+        proc = Popen(cmd, stdout=PIPE, stderr=STDOUT, cwd=cwd, universal_newlines=True, **session)
+
+        killed = threading.Event()
+        timer = None
+
+        if timeout is not None:
+            timer = threading.Timer(timeout, _kill_group, [proc, killed])
+            timer.daemon = True
+            timer.start()
+
+        try:
+            output, _ = proc.communicate()
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+        # A run that completed is kept, even if the timeout expired as it was exiting
+        if proc.returncode == 0:
+            return output
+
+        if killed.is_set():
+            raise ConversionTimeout(cmd, timeout, output=output)
+
+        if proc.returncode:
+            raise CalledProcessError(proc.returncode, cmd, output=output)
+
+        return output
+
+    def quarantine(self, row, reason):
+        """Set a row of the map aside, recording why."""
+
+        with self._lock:
+
+            self.quarantined += 1
+
+            if not self.quarantine_fpath:
+                return
+
+            quarantined = dict(row)
+            quarantined[QUARANTINE_REASON] = "{}".format(reason)
+
+            pd.DataFrame([quarantined], columns=list(row.keys()) + [QUARANTINE_REASON]).to_csv(
+                self.quarantine_fpath, mode='a', index=False, header=not os.path.isfile(self.quarantine_fpath))
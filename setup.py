@@ -17,6 +17,7 @@ def main():
         PACKAGE_NAME,
         CLASSIFIERS,
         REQUIRES,
+        EXTRAS_REQUIRE,
     )
 
     pkg_data = {
@@ -28,6 +29,9 @@ def main():
             'data/3Td.json',
             # 'data/NIAAA3T.json',
             # 'data/7T.json'
+        ],
+        'benchmarks': [
+            'data/baseline.json'
         ]
     }
 
@@ -45,6 +49,7 @@ def main():
         maintainer_email=__email__,
         classifiers=CLASSIFIERS,
         install_requires=REQUIRES,
+        extras_require=EXTRAS_REQUIRE,
         url=__url__,
         download_url=__download__,
         entry_points={
@@ -52,7 +57,8 @@ def main():
                 'oxy2bids=oxy2bids.gen_bids:main',
                 'process_biopac=biounpacker.biopac_organize:main',
                 'dcmexplorer=dcmexplorer.explorer:main',
-                'bidsmapper=bidsmapper.mapper:main'
+                'bidsmapper=bidsmapper.mapper:main',
+                'benchmarks=benchmarks.regression:main'
             ]
         },
         packages=find_packages(),
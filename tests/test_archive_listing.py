@@ -0,0 +1,68 @@
+from __future__ import print_function, unicode_literals
+
+import io
+import os
+import logging
+import tarfile
+
+from bidsmapper.utils import get_unique_dicoms_from_compressed
+
+
+LOG = logging.getLogger(__name__)
+
+
+def _add_member(tar_file, name, size):
+    member = tarfile.TarInfo(name)
+    member.size = size
+    tar_file.addfile(member, io.BytesIO(b'\0' * size))
+
+
+def _archive(tmpdir, members):
+
+    tgz_fpath = os.path.join(str(tmpdir), 'p1-s1-DICOM.tgz')
+
+    with tarfile.open(tgz_fpath, 'w:gz') as tar_file:
+        for name, size in members:
+            _add_member(tar_file, name, size)
+
+    return tgz_fpath
+
+
+def test_series_are_sized_from_the_member_info(tmpdir):
+
+    tgz_fpath = _archive(tmpdir, [
+        ('p1/s1/mr_0001/00001.dcm', 100),
+        ('p1/s1/mr_0001/00002.dcm', 250),
+        ('p1/s1/mr_0002/with space.dcm', 40),
+        ('p1/s1/notes.txt', 10),
+    ])
+
+    scans = get_unique_dicoms_from_compressed(tgz_fpath, str(tmpdir), log=LOG)
+
+    sizes = {scan.get_scan_dir(): (scan.get_n_instances(), scan.get_series_bytes()) for scan in scans}
+    assert sizes == {'p1/s1/mr_0001': (2, 350), 'p1/s1/mr_0002': (1, 40)}
+    assert [scan.get_scan_name() for scan in scans] == ['00001.dcm', 'with space.dcm']
+
+
+def test_realtime_files_are_matched_to_their_series(tmpdir):
+
+    tgz_fpath = _archive(tmpdir, [
+        ('p1/s1/mr_0003/00001.dcm', 10),
+        ('p1/s1/realtime/ECG_epiRT_scan_0003_phys.1D', 10),
+        ('p1/s1/realtime/Resp_epiRT_scan_0003_phys.1D', 10),
+    ])
+
+    scan, = get_unique_dicoms_from_compressed(tgz_fpath, str(tmpdir), log=LOG)
+
+    assert scan.get_cardio() == 'p1/s1/realtime/ECG_epiRT_scan_0003_phys.1D'
+    assert scan.get_resp() == 'p1/s1/realtime/Resp_epiRT_scan_0003_phys.1D'
+
+
+def test_unreadable_archive_is_skipped(tmpdir):
+
+    tgz_fpath = os.path.join(str(tmpdir), 'p1-s1-DICOM.tgz')
+
+    with open(tgz_fpath, 'wb') as tgz_file:
+        tgz_file.write(b'not an archive')
+
+    assert get_unique_dicoms_from_compressed(tgz_fpath, str(tmpdir), log=LOG) is None
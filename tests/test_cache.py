@@ -0,0 +1,164 @@
+from __future__ import print_function, unicode_literals
+
+import io
+import os
+import tarfile
+
+from oxy2bids.cache import ConversionCache, ExtractedSeriesCache
+
+
+TOOL = 'no-such-dcm2niix'
+
+
+def _write(fpath, content):
+    with open(fpath, 'w') as out_file:
+        out_file.write(content)
+
+
+def _convert(tmpdir, name, content):
+    """Products of a fake conversion, of about len(content) bytes each."""
+
+    src_dir = os.path.join(str(tmpdir), 'converted')
+
+    if not os.path.isdir(src_dir):
+        os.makedirs(src_dir)
+
+    _write(os.path.join(src_dir, "{}.nii.gz".format(name)), content)
+    _write(os.path.join(src_dir, "{}.json".format(name)), '{}')
+
+    return src_dir
+
+
+def _read(fpath):
+    with open(fpath) as in_file:
+        return in_file.read()
+
+
+def _conversion_cache(tmpdir, max_bytes=10 ** 6):
+    return ConversionCache(os.path.join(str(tmpdir), 'cache'), max_bytes, link_mode='copy')
+
+
+def test_conversion_is_fetched_after_it_is_stored(tmpdir):
+
+    cache = _conversion_cache(tmpdir)
+    key = cache.get_key({'series_uid': '1.2.3'}, TOOL, ['-z', 'y'])
+    out_dir = str(tmpdir)
+
+    assert cache.fetch(key, out_dir, 'sub-00001_T1w') is None
+
+    cache.store(key, _convert(tmpdir, 'series_a', 'nifti a'), 'series_a')
+    placed = cache.fetch(key, out_dir, 'sub-00001_T1w')
+
+    assert sorted(os.path.basename(fpath) for fpath in placed) == ['sub-00001_T1w.json', 'sub-00001_T1w.nii.gz']
+    assert _read(os.path.join(out_dir, 'sub-00001_T1w.nii.gz')) == 'nifti a'
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_key_changes_with_the_series_and_flags(tmpdir):
+
+    cache = _conversion_cache(tmpdir)
+    key = cache.get_key({'series_uid': '1.2.3'}, TOOL, ['-z', 'y'])
+
+    assert cache.get_key({'series_uid': '1.2.3'}, TOOL, ['-z', 'y']) == key
+    assert cache.get_key({'series_uid': '1.2.4'}, TOOL, ['-z', 'y']) != key
+    assert cache.get_key({'series_uid': '1.2.3'}, TOOL, ['-z', 'n']) != key
+
+
+def test_least_recently_used_entry_is_evicted(tmpdir):
+
+    content = 'x' * 4000
+    cache = _conversion_cache(tmpdir, max_bytes=10000)
+    keys = [cache.get_key({'series_uid': uid}, TOOL, []) for uid in ('1', '2', '3')]
+
+    cache.store(keys[0], _convert(tmpdir, 'a', content), 'a')
+    cache.store(keys[1], _convert(tmpdir, 'b', content), 'b')
+
+    # Used again, so the second entry is now the least recently used one
+    assert cache.fetch(keys[0], str(tmpdir), 'out') is not None
+
+    cache.store(keys[2], _convert(tmpdir, 'c', content), 'c')
+
+    assert cache.size <= cache.max_bytes
+    assert cache.fetch(keys[1], str(tmpdir), 'out') is None
+    assert cache.fetch(keys[0], str(tmpdir), 'out') is not None
+    assert cache.fetch(keys[2], str(tmpdir), 'out') is not None
+
+
+def test_entry_stored_by_another_process_is_found(tmpdir):
+
+    reader = _conversion_cache(tmpdir)
+    writer = _conversion_cache(tmpdir)
+    key = writer.get_key({'series_uid': '1.2.3'}, TOOL, [])
+
+    writer.store(key, _convert(tmpdir, 'a', 'nifti a'), 'a')
+
+    assert reader.fetch(key, str(tmpdir), 'out') is not None
+    assert _conversion_cache(tmpdir).size == reader.size
+
+
+def _archive(tmpdir, series_bytes=4000):
+
+    tgz_fpath = os.path.join(str(tmpdir), 'p1-s1-DICOM.tgz')
+
+    with tarfile.open(tgz_fpath, 'w:gz') as tar_file:
+        for series in ('mr_0001', 'mr_0002', 'mr_0003'):
+            member = tarfile.TarInfo('p1/s1/{}/00001.dcm'.format(series))
+            member.size = series_bytes
+            tar_file.addfile(member, io.BytesIO(b'\0' * series_bytes))
+
+    return tgz_fpath
+
+
+def _scratch(tmpdir, max_bytes=10 ** 6):
+    return ExtractedSeriesCache(os.path.join(str(tmpdir), 'scratch'), max_bytes)
+
+
+def test_series_is_extracted_once(tmpdir):
+
+    tgz_fpath = _archive(tmpdir)
+    scratch = _scratch(tmpdir)
+
+    key, series_dir, extracted = scratch.acquire(tgz_fpath, 'p1/s1/mr_0001')
+    scratch.release(key)
+
+    assert extracted
+    assert os.listdir(series_dir) == ['00001.dcm']
+    assert scratch.acquire(tgz_fpath, 'p1/s1/mr_0001') == (key, series_dir, False)
+    assert (scratch.hits, scratch.misses) == (1, 1)
+
+
+def test_series_in_use_are_not_evicted(tmpdir):
+
+    tgz_fpath = _archive(tmpdir)
+    scratch = _scratch(tmpdir, max_bytes=6000)
+
+    first_key, first_dir, _ = scratch.acquire(tgz_fpath, 'p1/s1/mr_0001')
+    second_key, second_dir, _ = scratch.acquire(tgz_fpath, 'p1/s1/mr_0002')
+
+    # Both are still being converted, the scratch directory goes over its bound meanwhile
+    assert os.path.isdir(first_dir) and os.path.isdir(second_dir)
+
+    scratch.release(first_key)
+
+    assert not os.path.isdir(first_dir)
+    assert os.path.isdir(second_dir)
+
+    scratch.release(second_key)
+    scratch.acquire(tgz_fpath, 'p1/s1/mr_0003')
+
+    assert not os.path.isdir(second_dir)
+    assert scratch.acquire(tgz_fpath, 'p1/s1/mr_0001')[2]
+
+
+def test_entries_are_reused_by_later_runs(tmpdir):
+
+    tgz_fpath = _archive(tmpdir)
+    key, _, _ = _scratch(tmpdir).acquire(tgz_fpath, 'p1/s1/mr_0001')
+
+    leftover_dir = os.path.join(str(tmpdir), 'scratch', '{}.tmp'.format(key))
+    os.makedirs(leftover_dir)
+
+    scratch = _scratch(tmpdir)
+
+    assert not os.path.isdir(leftover_dir)
+    assert not scratch.acquire(tgz_fpath, 'p1/s1/mr_0001')[2]
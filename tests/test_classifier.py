@@ -0,0 +1,74 @@
+from __future__ import print_function, unicode_literals
+
+import itertools
+
+from bidsmapper.classifier import BidsClassifier, PresetClassifier
+from common_utils.utils import get_config
+
+
+SERIES_DESCRIPTIONS = ['T1w_MPR', 'T2w acq-highres', 'rest_bold', 'task-nback_bold', 'task-nback_bold_sbref',
+                       'bold rec-norm', 'dwi acq-b1000', 'dwi_sbref', 'fmap_dir-AP', 'localizer', None]
+SEQUENCE_NAMES = ['epfid2d1_64', 'tfl3d1', 'ep_b1000', None]
+STATIONS = [('fmrif3ta', 'GE MEDICAL SYSTEMS'), ('MRC35', 'SIEMENS'), ('unknown', None)]
+
+
+def _tag_values():
+
+    for description, sequence, (station, manufacturer) in itertools.product(SERIES_DESCRIPTIONS, SEQUENCE_NAMES,
+                                                                           STATIONS):
+        yield {'study_date': '20170101', 'station_name': station, 'manufacturer': manufacturer,
+               'series_description': description, 'sequence_name': sequence}
+
+
+def test_cached_classification_matches_the_rules():
+
+    cached = PresetClassifier()
+    uncached = PresetClassifier(cache_size=0)
+
+    # Twice, so the second pass is answered from the cache
+    for tag_values in itertools.chain(_tag_values(), _tag_values()):
+        assert cached.classify(tag_values) == uncached.classify(tag_values)
+
+    assert cached.misses > 0
+    assert cached.hits >= len(list(_tag_values()))
+    assert uncached.hits == uncached.misses == 0
+
+
+def test_tags_not_used_by_the_rules_share_an_entry():
+
+    classifier = BidsClassifier(get_config(None)['BIDS_TAGS'])
+    tag_values = next(_tag_values())
+
+    first = classifier.classify(tag_values)
+    second = classifier.classify(dict(tag_values, study_date='20180101'))
+
+    assert first == second
+    assert (classifier.hits, classifier.misses) == (1, 1)
+
+
+def test_labels_returned_do_not_change_the_cache():
+
+    classifier = BidsClassifier(get_config(None)['BIDS_TAGS'])
+    tag_values = next(_tag_values())
+
+    _, labels = classifier.classify(tag_values)
+    labels['modality'] = 'edited'
+
+    assert classifier.classify(tag_values)[1]['modality'] == 'T1w'
+
+
+def test_least_recently_used_result_is_dropped():
+
+    classifier = BidsClassifier(get_config(None)['BIDS_TAGS'], cache_size=2)
+    t1w, t2w, bold = [dict(next(_tag_values()), series_description=description)
+                      for description in ('T1w_MPR', 'T2w', 'rest_bold')]
+
+    for tag_values in (t1w, t2w, t1w, bold):
+        classifier.classify(tag_values)
+
+    assert (classifier.hits, classifier.misses) == (1, 3)
+
+    classifier.classify(t1w)
+    classifier.classify(t2w)
+
+    assert (classifier.hits, classifier.misses) == (2, 4)
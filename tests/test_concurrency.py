@@ -0,0 +1,99 @@
+from __future__ import print_function, unicode_literals
+
+from common_utils.concurrency import AdaptiveExecutor, AutoThreads, get_executor
+
+
+GB = 1024 ** 3
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def _executor(clock, available=8 * GB, **kwargs):
+    kwargs.setdefault('initial_workers', 4)
+    return AdaptiveExecutor(16, interval=2.0, clock=clock, available_memory=lambda: available, total_memory=16 * GB,
+                            **kwargs)
+
+
+def _run_items(executor, clock, latency, count, gap=0.0):
+    """Run count items taking latency seconds each, one at a time, gap seconds apart."""
+
+    for _ in range(count):
+        executor.submit(clock.advance, latency).result()
+        clock.advance(gap)
+
+
+def test_limit_grows_then_turns_back_when_throughput_stops_improving():
+
+    clock = FakeClock()
+
+    with _executor(clock) as executor:
+
+        _run_items(executor, clock, 1.0, 4)
+        assert executor.limit == 5
+
+        _run_items(executor, clock, 1.0, 5)
+        assert executor.limit == 4
+
+
+def test_limit_is_not_changed_before_the_window_is_full():
+
+    clock = FakeClock()
+
+    with _executor(clock) as executor:
+
+        _run_items(executor, clock, 1.0, 3)
+        assert executor.limit == 4
+        assert executor.adjustments == 0
+
+
+def test_limit_halves_under_memory_pressure():
+
+    clock = FakeClock()
+
+    with _executor(clock, available=GB, initial_workers=8) as executor:
+
+        _run_items(executor, clock, 1.0, 8)
+        assert executor.limit == 4
+
+
+def test_latency_spike_backs_off_even_as_throughput_improves():
+
+    clock = FakeClock()
+
+    with _executor(clock) as executor:
+
+        _run_items(executor, clock, 1.0, 4, gap=10.0)
+        assert executor.limit == 5
+
+        _run_items(executor, clock, 5.0, 5)
+        assert executor.limit == 4
+
+
+def test_latency_is_ignored_without_latency_spike():
+
+    clock = FakeClock()
+
+    with _executor(clock, latency_spike=None) as executor:
+
+        _run_items(executor, clock, 1.0, 4, gap=10.0)
+        _run_items(executor, clock, 5.0, 5)
+        assert executor.limit == 6
+
+
+def test_only_io_bound_pools_back_off_on_latency():
+
+    with get_executor(AutoThreads(4), 'header_parsing', io_bound=True) as executor:
+        assert executor.latency_spike is not None
+
+    with get_executor(AutoThreads(4), 'conversion') as executor:
+        assert executor.latency_spike is None
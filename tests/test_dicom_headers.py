@@ -0,0 +1,81 @@
+from __future__ import print_function, unicode_literals
+
+import io
+import os
+import tarfile
+import pydicom
+import pytest
+
+from pydicom.uid import generate_uid
+from benchmarks.synthetic import make_dicom
+from common_utils.dicom_utils import HEADER_PREFIX_BYTES, get_header_tags, read_dicom_header, \
+    read_compressed_dicom_header
+
+
+PROTOCOL = {'series_description': 'rest_bold', 'sequence_name': 'epi'}
+
+# A tag of the standard groups, and one stored after a vendor blob larger than the header prefix
+DICOM_TAGS = {'series_description': '0x0008,0x103e', 'mr_header': '0x0051,0x1005'}
+
+DCM_NAME = 'p1/s1/mr_0001/00001.dcm'
+
+
+def _dicom_bytes(private_bytes=0, private_elements=0):
+    return make_dicom('p1', '20170101', '100000', ('MRC35', 'SIEMENS'), PROTOCOL, 1, 1, generate_uid(),
+                      generate_uid(), matrix=128, private_bytes=private_bytes, private_elements=private_elements)
+
+
+def _write(tmpdir, dcm_bytes):
+
+    dcm_fpath = os.path.join(str(tmpdir), '00001.dcm')
+    with open(dcm_fpath, 'wb') as dcm_file:
+        dcm_file.write(dcm_bytes)
+
+    tgz_fpath = os.path.join(str(tmpdir), 'p1-s1-DICOM.tgz')
+    with tarfile.open(tgz_fpath, 'w:gz') as tar_file:
+        member = tarfile.TarInfo(DCM_NAME)
+        member.size = len(dcm_bytes)
+        tar_file.addfile(member, io.BytesIO(dcm_bytes))
+
+    return dcm_fpath, tgz_fpath
+
+
+def _values(curr_dcm, header_tags):
+    return [curr_dcm[tag].value if tag in curr_dcm else None for tag in header_tags]
+
+
+def test_prefix_read_matches_a_full_read(tmpdir):
+
+    dcm_bytes = _dicom_bytes()
+    dcm_fpath, tgz_fpath = _write(tmpdir, dcm_bytes)
+    header_tags = get_header_tags({'series_description': DICOM_TAGS['series_description']})
+
+    full_dcm = pydicom.dcmread(dcm_fpath)
+
+    for curr_dcm, bytes_read in (read_dicom_header(dcm_fpath, header_tags),
+                                 read_compressed_dicom_header(tgz_fpath, DCM_NAME, header_tags)):
+        assert bytes_read == HEADER_PREFIX_BYTES < len(dcm_bytes)
+        assert _values(curr_dcm, header_tags) == _values(full_dcm, header_tags)
+
+
+def test_tags_past_the_prefix_are_read_from_the_whole_file(tmpdir):
+
+    dcm_bytes = _dicom_bytes(private_bytes=2 * HEADER_PREFIX_BYTES, private_elements=8)
+    dcm_fpath, tgz_fpath = _write(tmpdir, dcm_bytes)
+    header_tags = get_header_tags(DICOM_TAGS)
+
+    full_dcm = pydicom.dcmread(dcm_fpath)
+
+    for curr_dcm, bytes_read in (read_dicom_header(dcm_fpath, header_tags),
+                                 read_compressed_dicom_header(tgz_fpath, DCM_NAME, header_tags)):
+        assert bytes_read == len(dcm_bytes)
+        assert _values(curr_dcm, header_tags) == _values(full_dcm, header_tags)
+        assert curr_dcm[0x0051, 0x1005].value == 'value_5'
+
+
+def test_missing_member_cannot_be_extracted(tmpdir):
+
+    _, tgz_fpath = _write(tmpdir, _dicom_bytes())
+
+    with pytest.raises(IOError):
+        read_compressed_dicom_header(tgz_fpath, 'p1/s1/mr_0002/00001.dcm', get_header_tags(DICOM_TAGS))
@@ -0,0 +1,104 @@
+from __future__ import print_function, unicode_literals
+
+import os
+
+from glob import glob
+from common_utils.discovery import build_realtime_index, count_series_dirs, get_realtime_files, get_series_size, \
+    iter_uncompressed_series
+
+
+def _touch(fpath, size=0):
+
+    if not os.path.isdir(os.path.dirname(fpath)):
+        os.makedirs(os.path.dirname(fpath))
+
+    with open(fpath, 'wb') as out_file:
+        out_file.write(b'\0' * size)
+
+
+def _tree(tmpdir, n_subjects=1, n_sessions=1):
+
+    dicom_dir = str(tmpdir)
+
+    for subject_idx in range(n_subjects):
+        for session_idx in range(n_sessions):
+
+            session_dir = os.path.join(dicom_dir, 'p{}'.format(subject_idx), 's{}'.format(session_idx))
+
+            for instance_idx in range(3):
+                _touch(os.path.join(session_dir, 'mr_0001', '{:05d}.dcm'.format(instance_idx)), 100)
+                _touch(os.path.join(session_dir, 'mr_0003', '{:05d}.dcm'.format(instance_idx)), 200)
+
+            _touch(os.path.join(session_dir, 'mr_0002', 'notes.txt'))
+            _touch(os.path.join(session_dir, '.hidden', '00000.dcm'))
+            _touch(os.path.join(session_dir, 'realtime', 'ECG_epiRT_scan_0003_phys.1D'))
+            _touch(os.path.join(session_dir, 'realtime', 'Resp_epiRT_scan_0003_phys.1D'))
+
+    return dicom_dir
+
+
+def test_one_dicom_per_series_like_glob(tmpdir):
+
+    dicom_dir = _tree(tmpdir, n_subjects=2, n_sessions=2)
+
+    series = list(iter_uncompressed_series(dicom_dir, nthreads=2))
+    globbed = glob(os.path.join(dicom_dir, '*', '*', '*', '*.dcm'))
+
+    assert len(series) == 8
+    assert set(os.path.dirname(dcm_file) for dcm_file, _, _ in series) == \
+        set(os.path.dirname(dcm_file) for dcm_file in globbed)
+    assert all(dcm_file in globbed for dcm_file, _, _ in series)
+
+
+def test_physio_is_matched_to_its_series(tmpdir):
+
+    dicom_dir = _tree(tmpdir)
+    realtime_dir = os.path.join(dicom_dir, 'p0', 's0', 'realtime')
+
+    physio = dict((os.path.basename(os.path.dirname(dcm_file)), (cardio, resp))
+                  for dcm_file, cardio, resp in iter_uncompressed_series(dicom_dir))
+
+    assert physio == {
+        'mr_0001': (None, None),
+        'mr_0003': (os.path.join(realtime_dir, 'ECG_epiRT_scan_0003_phys.1D'),
+                    os.path.join(realtime_dir, 'Resp_epiRT_scan_0003_phys.1D')),
+    }
+
+
+def test_sessions_are_scanned_only_ahead_of_the_consumer(tmpdir):
+
+    dicom_dir = _tree(tmpdir, n_subjects=20)
+    filtered = []
+
+    def session_filter(session_dir):
+        filtered.append(session_dir)
+        return True
+
+    series = iter_uncompressed_series(dicom_dir, nthreads=1, session_filter=session_filter)
+    next(series)
+    series.close()
+
+    assert 0 < len(filtered) < 20
+
+
+def test_realtime_index():
+
+    rt_index = build_realtime_index(['p0/s0/realtime/ECG_epiRT_scan_0003_phys.1D',
+                                     'p0/s0/realtime/Resp_epiRT_scan_0003_phys.1D',
+                                     'p0/s0/realtime/Resp_epiRT_scan_0005_phys.1D',
+                                     'p0/s0/realtime/notes.1D'])
+
+    assert get_realtime_files(rt_index, 'p0/s0/mr_0003/') == ('p0/s0/realtime/ECG_epiRT_scan_0003_phys.1D',
+                                                             'p0/s0/realtime/Resp_epiRT_scan_0003_phys.1D')
+    assert get_realtime_files(rt_index, 'p0/s0/mr_0005') == (None, 'p0/s0/realtime/Resp_epiRT_scan_0005_phys.1D')
+    assert get_realtime_files(rt_index, 'p0/s0/mr_0001') == (None, None)
+
+
+def test_series_size(tmpdir):
+
+    dicom_dir = _tree(tmpdir)
+    session_dir = os.path.join(dicom_dir, 'p0', 's0')
+
+    assert get_series_size(os.path.join(session_dir, 'mr_0003')) == (3, 600)
+    assert get_series_size(os.path.join(session_dir, 'mr_0002')) == (0, 0)
+    assert count_series_dirs(session_dir) == 4
@@ -0,0 +1,56 @@
+from __future__ import print_function, unicode_literals
+
+import pandas as pd
+
+from bidsmapper.utils import collapse_duplicate_series
+
+
+def _row(scan_dir, n_instances, series_uid='1.2.3', alt_sources=''):
+    return {'scan_dir': scan_dir, 'series_uid': series_uid, 'n_instances': n_instances, 'alt_sources': alt_sources}
+
+
+def test_copy_with_the_most_instances_is_kept():
+
+    mapping_df = pd.DataFrame([_row('/data/p1/s1/mr_0001', 100), _row('p1/s1/mr_0001', 120)])
+
+    collapsed = collapse_duplicate_series(mapping_df)
+
+    assert list(collapsed['scan_dir']) == ['p1/s1/mr_0001']
+    assert list(collapsed['alt_sources']) == ['/data/p1/s1/mr_0001']
+
+
+def test_uncompressed_copy_is_kept_over_a_compressed_one():
+
+    mapping_df = pd.DataFrame([_row('p1/s1/mr_0001', '120'), _row('/data/p1/s1/mr_0001', 120)])
+
+    collapsed = collapse_duplicate_series(mapping_df)
+
+    assert list(collapsed['scan_dir']) == ['/data/p1/s1/mr_0001']
+
+
+def test_first_copy_is_kept_between_equal_ones():
+
+    mapping_df = pd.DataFrame([_row('p1/s1/mr_0001', 120), _row('p2/s1/mr_0001', 120),
+                               _row('p1/s1/mr_0002', 80, series_uid='4.5.6')])
+
+    collapsed = collapse_duplicate_series(mapping_df)
+
+    assert list(collapsed['scan_dir']) == ['p1/s1/mr_0001', 'p1/s1/mr_0002']
+    assert list(collapsed['alt_sources']) == ['p2/s1/mr_0001', '']
+
+
+def test_copies_listed_by_merged_shards_are_kept_in_alt_sources():
+
+    mapping_df = pd.DataFrame([_row('p1/s1/mr_0001', 120, alt_sources='p3/s1/mr_0001'),
+                               _row('p2/s1/mr_0001', 120)])
+
+    collapsed = collapse_duplicate_series(mapping_df)
+
+    assert list(collapsed['alt_sources']) == ['p2/s1/mr_0001;p3/s1/mr_0001']
+
+
+def test_series_without_uid_are_never_collapsed():
+
+    mapping_df = pd.DataFrame([_row('p1/s1/mr_0001', 120, series_uid=''), _row('p2/s1/mr_0001', 120, series_uid='')])
+
+    assert len(collapse_duplicate_series(mapping_df)) == 2
@@ -0,0 +1,72 @@
+from __future__ import print_function, unicode_literals
+
+import pandas as pd
+
+from bidsmapper.mapper import assign_bids_labels
+
+
+def _baseline_assign_bids_labels(mapping_df):
+    """The labelling of the original gen_map loop, whose run labels were assigned to iterrows copies and so never
+    reached the map."""
+
+    unique_ids = mapping_df['patient_id'].unique()
+    curr_subject = 1
+
+    for curr_id in unique_ids:
+        mapping_df.loc[mapping_df['patient_id'] == curr_id,
+                       'subject'] = 'sub-{}'.format(str(curr_subject).rjust(5, '0'))
+        curr_subject += 1
+
+        unique_datetime = mapping_df[mapping_df['patient_id'] == curr_id]['scan_datetime'].unique()
+        curr_session = 1
+
+        for curr_datetime in unique_datetime:
+            mapping_df.loc[(mapping_df['patient_id'] == curr_id) & (mapping_df['scan_datetime'] == curr_datetime),
+                           'session'] = 'ses-{}'.format(str(curr_session).rjust(5, '0'))
+            curr_session += 1
+
+
+def _row(patient_id, scan_datetime, modality, task=''):
+    return {'subject': '', 'session': '', 'bids_type': 'func' if task else 'anat', 'task': task, 'acq': '',
+            'rec': '', 'run': '', 'modality': modality, 'patient_id': patient_id, 'scan_datetime': scan_datetime}
+
+
+def _mapping():
+    return pd.DataFrame([
+        _row('p2', '20170101_1000', 'T1w'),
+        _row('p2', '20170101_1000', 'bold', 'rest'),
+        _row('p1', '20170102_0900', 'bold', 'rest'),
+        _row('p2', '20170101_1000', 'bold', 'rest'),
+        _row('p2', '20170105_1100', 'bold', 'rest'),
+        _row('p1', '20170102_0900', 'T2w'),
+    ] + [_row('p1', '20170102_0900', 'bold', 'nback')] * 10)
+
+
+def test_subjects_and_sessions_match_the_baseline():
+
+    mapping_df = _mapping()
+    baseline_df = _mapping()
+
+    assign_bids_labels(mapping_df)
+    _baseline_assign_bids_labels(baseline_df)
+
+    assert list(mapping_df['subject']) == list(baseline_df['subject'])
+    assert list(mapping_df['session']) == list(baseline_df['session'])
+
+
+def test_only_repeated_series_get_run_labels():
+
+    mapping_df = _mapping()
+    baseline_df = _mapping()
+
+    assign_bids_labels(mapping_df)
+    _baseline_assign_bids_labels(baseline_df)
+
+    repeated = mapping_df.duplicated(['patient_id', 'scan_datetime', 'task', 'acq', 'rec', 'modality'], keep=False)
+
+    # Series acquired once keep the labels of the baseline, and so their BIDS file names
+    assert list(mapping_df['run'][~repeated]) == list(baseline_df['run'][~repeated]) == [''] * 4
+
+    # Repeated series are numbered in order of acquisition, padded to the number of runs, so they do not collide
+    assert list(mapping_df['run'][:4][repeated[:4]]) == ['run-01', 'run-02']
+    assert list(mapping_df['run'][6:]) == ['run-{}'.format(str(run).rjust(3, '0')) for run in range(1, 11)]
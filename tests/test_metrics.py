@@ -0,0 +1,36 @@
+from __future__ import print_function, unicode_literals
+
+from common_utils.metrics import StageMetrics
+
+
+def test_stage_column_fits_the_longest_stage_name():
+
+    metrics = StageMetrics('test')
+
+    long_name = 'a_stage_name_longer_than_the_default_column'
+    width = len(long_name)
+
+    for name in ('listing', long_name):
+        with metrics.stage(name):
+            pass
+
+    header, _, short_row, long_row = metrics.format_summary().splitlines()[3:]
+
+    assert [header[:width + 9], short_row[:width + 9], long_row[:width + 9]] == [
+        'stage'.ljust(width) + '    calls', 'listing'.ljust(width) + '        1', long_name + '        1']
+
+
+def test_summary_counts_calls_per_stage():
+
+    metrics = StageMetrics('test')
+    metrics.incr('series_indexed', 3)
+
+    for _ in range(2):
+        with metrics.stage('listing', items=5):
+            pass
+
+    summary = metrics.summary()
+
+    assert summary['counters'] == {'series_indexed': 3}
+    assert summary['stages']['listing']['calls'] == 2
+    assert summary['stages']['listing']['items'] == 10
@@ -0,0 +1,83 @@
+from __future__ import print_function, unicode_literals
+
+import os
+import time
+import threading
+
+from oxy2bids.prefetch import ArchivePrefetcher
+
+
+def _make_archive(tmpdir, name, size=1024):
+
+    archive_fpath = os.path.join(str(tmpdir), name)
+
+    with open(archive_fpath, 'wb') as archive_file:
+        archive_file.write(os.urandom(size))
+
+    return archive_fpath
+
+
+def _convert(prefetcher, rows):
+    """Read and release the archive of every row in turn, as the conversion workers do, returning the paths read."""
+
+    read = []
+
+    for archive_fpath in rows:
+        read_fpath = prefetcher.get(archive_fpath)
+        assert os.path.isfile(read_fpath)
+        read.append(read_fpath)
+        prefetcher.release(archive_fpath)
+
+    return read
+
+
+def test_interleaved_archives_do_not_deadlock(tmpdir):
+
+    archive_a = _make_archive(tmpdir, 'a.tgz')
+    archive_b = _make_archive(tmpdir, 'b.tgz')
+    rows = [archive_a, archive_b, archive_a]
+
+    prefetcher = ArchivePrefetcher(os.path.join(str(tmpdir), 'prefetch'), max_archives=1).start(rows)
+
+    result = []
+    worker = threading.Thread(target=lambda: result.extend(_convert(prefetcher, rows)))
+    worker.daemon = True
+    worker.start()
+    worker.join(10)
+
+    try:
+        assert not worker.is_alive(), "get() blocked on an archive waiting for room"
+        assert len(result) == 3
+        # B cannot be copied while the second row of A is pending, so it is read from its original location
+        assert result[1] == archive_b
+    finally:
+        prefetcher.close()
+
+    assert os.listdir(os.path.join(str(tmpdir), 'prefetch')) == []
+
+
+def test_grouped_archives_are_read_locally(tmpdir):
+
+    archive_a = _make_archive(tmpdir, 'a.tgz')
+    archive_b = _make_archive(tmpdir, 'b.tgz')
+    rows = [archive_a, archive_a, archive_b]
+
+    prefetcher = ArchivePrefetcher(os.path.join(str(tmpdir), 'prefetch'), max_archives=1).start(rows)
+
+    local_a = os.path.join(str(tmpdir), 'prefetch', 'a.tgz')
+    deadline = time.time() + 10
+
+    try:
+
+        # Rows bypass an archive whose copy has not started yet, and wait for it once it has
+        while prefetcher.get(archive_a) != local_a:
+            assert time.time() < deadline, "a.tgz was never prefetched"
+            time.sleep(0.01)
+
+        read = _convert(prefetcher, rows)
+
+    finally:
+        prefetcher.close()
+
+    assert read[0] == read[1] == local_a
+    assert os.listdir(os.path.join(str(tmpdir), 'prefetch')) == []
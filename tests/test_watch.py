@@ -0,0 +1,77 @@
+from __future__ import print_function, unicode_literals
+
+import os
+import json
+import pandas as pd
+
+from oxy2bids.watch import WatchState
+
+
+def _row(modality, run='', task='', patient_id='p1', scan_datetime='20170101_1000'):
+    return {'subject': 'sub-00001', 'session': 'ses-00001', 'task': task, 'acq': '', 'rec': '', 'run': run,
+            'modality': modality, 'patient_id': patient_id, 'scan_datetime': scan_datetime}
+
+
+def _state(tmpdir):
+    return WatchState(os.path.join(str(tmpdir), 'watch_state.json'), os.path.join(str(tmpdir), 'bids'))
+
+
+def _labels(state, rows, unit_key):
+    mapping_df = pd.DataFrame(rows)
+    state.assign_labels(mapping_df, unit_key)
+    return list(zip(mapping_df['subject'], mapping_df['session'], mapping_df['run']))
+
+
+def test_runs_of_a_new_session_are_kept(tmpdir):
+
+    labels = _labels(_state(tmpdir), [_row('T1w'), _row('bold', 'run-01', 'rest'), _row('bold', 'run-02', 'rest')],
+                     'p1/s1')
+
+    assert labels == [('sub-00001', 'ses-00001', ''), ('sub-00001', 'ses-00001', 'run-01'),
+                      ('sub-00001', 'ses-00001', 'run-02')]
+
+
+def test_runs_added_to_a_converted_session_follow_the_recorded_ones(tmpdir):
+
+    state = _state(tmpdir)
+    _labels(state, [_row('T1w'), _row('bold', 'run-01', 'rest'), _row('bold', 'run-02', 'rest')], 'p1/s1')
+
+    labels = _labels(state, [_row('T1w'), _row('bold', task='rest'), _row('bold', task='nback')], 'p1/s1b')
+
+    assert [run for _, _, run in labels] == ['run-02', 'run-03', '']
+
+
+def test_unit_processed_again_keeps_its_runs(tmpdir):
+
+    state = _state(tmpdir)
+    first = _labels(state, [_row('bold', 'run-01', 'rest'), _row('bold', 'run-02', 'rest')], 'p1/s1')
+    _labels(state, [_row('bold', task='rest')], 'p1/s1b')
+
+    assert _labels(state, [_row('bold', 'run-01', 'rest'), _row('bold', 'run-02', 'rest')], 'p1/s1') == first
+
+
+def test_runs_of_a_seed_map_are_recorded(tmpdir):
+
+    state = _state(tmpdir)
+    state.seed(pd.DataFrame([_row('bold', 'run-01', 'rest'), _row('bold', 'run-02', 'rest')]))
+
+    labels = _labels(state, [_row('bold', task='rest')], 'p1/s1b')
+
+    assert labels == [('sub-00001', 'ses-00001', 'run-03')]
+
+
+def test_runs_are_persisted_and_older_states_load(tmpdir):
+
+    state = _state(tmpdir)
+    _labels(state, [_row('bold', task='rest')], 'p1/s1')
+    state.save()
+
+    assert _labels(_state(tmpdir), [_row('bold', task='rest')], 'p1/s1b')[0][2] == 'run-02'
+
+    with open(state.state_fpath) as state_file:
+        old_state = json.load(state_file)
+    del old_state['runs']
+    with open(state.state_fpath, 'w') as state_file:
+        json.dump(old_state, state_file)
+
+    assert _state(tmpdir).runs == {}
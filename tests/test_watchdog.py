@@ -0,0 +1,67 @@
+from __future__ import print_function, unicode_literals
+
+import os
+import threading
+import subprocess
+import pytest
+
+from subprocess import CalledProcessError
+from oxy2bids.watchdog import ConversionWatchdog, ConversionTimeout, _kill_group
+
+
+def test_completed_run_returns_its_output():
+
+    watchdog = ConversionWatchdog(timeout=10)
+
+    assert watchdog.run(['echo', 'converted'], 0) == "converted\n"
+
+
+def test_failed_run_is_not_a_timeout():
+
+    watchdog = ConversionWatchdog(timeout=10)
+
+    with pytest.raises(CalledProcessError) as excinfo:
+        watchdog.run(['sh', '-c', 'exit 3'], 0)
+
+    assert not isinstance(excinfo.value, ConversionTimeout)
+    assert excinfo.value.returncode == 3
+
+
+def test_hung_run_is_stopped_with_its_children(tmpdir):
+
+    pid_fpath = os.path.join(str(tmpdir), 'child.pid')
+    watchdog = ConversionWatchdog(timeout=0.5, timeout_per_gb=0)
+
+    with pytest.raises(ConversionTimeout):
+        watchdog.run(['sh', '-c', 'sleep 60 & echo $! > {}; wait'.format(pid_fpath)], 0)
+
+    with open(pid_fpath) as pid_file:
+        child_pid = int(pid_file.read())
+
+    # The child was killed along with the shell, only its zombie may be left until it is reaped
+    try:
+        os.kill(child_pid, 0)
+        with open('/proc/{}/stat'.format(child_pid)) as stat_file:
+            assert stat_file.read().split()[2] == 'Z'
+    except (OSError, IOError):
+        pass
+
+
+def test_run_finishing_as_the_timeout_expires_is_kept():
+
+    proc = subprocess.Popen(['true'])
+    proc.wait()
+
+    killed = threading.Event()
+    _kill_group(proc, killed)
+
+    assert not killed.is_set()
+
+
+def test_timeout_scales_with_series_size():
+
+    watchdog = ConversionWatchdog(timeout=60, timeout_per_gb=120)
+
+    assert watchdog.get_timeout(2 * 1024 ** 3) == 60 + 240
+    assert ConversionWatchdog(timeout=0).get_timeout(1024 ** 3) is None
+    assert [watchdog.get_backoff(attempt) for attempt in (1, 2, 3)] == [30, 60, 120]
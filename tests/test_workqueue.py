@@ -0,0 +1,130 @@
+from __future__ import print_function, unicode_literals
+
+import os
+import sys
+import json
+import time
+import signal
+import subprocess
+
+from common_utils.workqueue import FileWorkQueue
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Claims tasks until none is left, recording each one it completes. With hang=1, holds its first task forever instead
+WORKER_SCRIPT = """
+import sys, time
+from common_utils.workqueue import FileWorkQueue
+
+queue_dir, worker_id, record_fpath, hang = sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4] == '1'
+queue = FileWorkQueue(queue_dir, worker_id=worker_id, lease_timeout=2.0, heartbeat=0.2)
+
+while queue.pending():
+
+    lease = queue.claim()
+
+    if lease is None:
+        time.sleep(0.2)
+        continue
+
+    if hang:
+        open(record_fpath + '.holding', 'w').close()
+        while True:
+            time.sleep(1)
+
+    time.sleep(0.05)
+
+    if queue.complete(lease):
+        with open(record_fpath, 'a') as record_file:
+            record_file.write(lease.task_id + '\\n')
+
+queue.close()
+"""
+
+
+def _start_worker(queue_dir, worker_id, record_fpath, hang=False):
+
+    env = dict(os.environ, PYTHONPATH=REPO_DIR)
+
+    return subprocess.Popen([sys.executable, '-c', WORKER_SCRIPT, queue_dir, worker_id, record_fpath,
+                             '1' if hang else '0'], env=env)
+
+
+def test_tasks_of_a_killed_worker_are_done_exactly_once(tmpdir):
+
+    queue_dir = os.path.join(str(tmpdir), 'queue')
+    n_tasks = 30
+    n_workers = 4
+
+    FileWorkQueue(queue_dir, worker_id='populate').populate([{'rows': [idx]} for idx in range(n_tasks)])
+
+    # The first worker claims a task and is killed while it holds the lease
+    victim_record = os.path.join(str(tmpdir), 'victim.txt')
+    victim = _start_worker(queue_dir, 'victim', victim_record, hang=True)
+
+    deadline = time.time() + 30
+    while not os.path.exists(victim_record + '.holding'):
+        assert time.time() < deadline, "the victim worker never claimed a task"
+        time.sleep(0.05)
+
+    os.kill(victim.pid, signal.SIGKILL)
+    victim.wait()
+
+    records = [os.path.join(str(tmpdir), 'worker{}.txt'.format(idx)) for idx in range(n_workers)]
+    workers = [_start_worker(queue_dir, 'worker{}'.format(idx), record_fpath)
+               for idx, record_fpath in enumerate(records)]
+
+    for worker in workers:
+        assert worker.wait(60) == 0
+
+    completed = []
+
+    for record_fpath in records:
+        if os.path.exists(record_fpath):
+            with open(record_fpath) as record_file:
+                completed.extend(record_file.read().split())
+
+    queue = FileWorkQueue(queue_dir, worker_id='check')
+
+    assert sorted(completed) == sorted(queue.tasks().keys())
+    assert queue.pending() == 0
+    assert not os.path.exists(victim_record)
+
+    # The task of the victim was claimed again once its lease expired
+    results = queue.results()
+    assert sorted(result['attempt'] for result in results.values()) == [1] * (n_tasks - 1) + [2]
+    assert os.listdir(queue.leases_dir) and all('.expired-' in name for name in os.listdir(queue.leases_dir))
+
+
+def test_lost_lease_is_left_to_its_new_owner(tmpdir):
+
+    queue_dir = os.path.join(str(tmpdir), 'queue')
+
+    # The heartbeat of the stalled worker never runs before its lease expires
+    stalled = FileWorkQueue(queue_dir, worker_id='stalled', lease_timeout=0.5, heartbeat=3600)
+    stalled.populate([{'rows': [0]}])
+    stale_lease = stalled.claim()
+
+    time.sleep(1)
+
+    owner = FileWorkQueue(queue_dir, worker_id='owner', lease_timeout=0.5, heartbeat=3600)
+    lease = owner.claim()
+
+    try:
+        assert lease.task_id == stale_lease.task_id and lease.attempt == 2
+        assert stalled.lost(stale_lease)
+        assert not owner.lost(lease)
+
+        # Completing the stale lease neither records the task nor removes the lease of its new owner
+        assert not stalled.complete(stale_lease)
+        assert owner.pending() == 1
+
+        with open(owner._lease_fpath(lease.task_id)) as lease_file:
+            assert json.load(lease_file)['worker'] == 'owner'
+
+        assert owner.complete(lease)
+        assert owner.pending() == 0
+
+    finally:
+        stalled.close()
+        owner.close()